@@ -220,3 +220,18 @@ variables = {'Tair': 'm01s16i004',
              'LE': 'm01s03i234',
              'BL_H': 'm01s03i216',
              'z0': 'm01s03i026'}
+
+# for reading premade MODEL files: how each variable is read from the netCDF files
+# the stash code is taken from variables above, and 'levels' or 'surface' from variable_info
+# order is:
+# 0. list of netCDF variable names - the first one present in the file is used (older files use different names)
+# 1. unit conversion as [offset, divisor]: converted value = (value + offset) / divisor
+model_nc_variables = {'Tair': [['air_temperature'], [-273.15, 1.]],
+                      'RH': [['relative_humidity'], [0., 1.]],
+                      'Press': [['air_pressure'], [0., 100.]],
+                      'kdown': [['surface_downwelling_shortwave_flux_in_air'], [0., 1.]],
+                      'ldown': [['surface_downwelling_longwave_flux_in_air'], [0., 1.]],
+                      'lstar': [['surface_net_longwave_flux_in_air'], [0., 1.]],
+                      'H': [['surface_upward_sensible_heat_flux', 'surface_sensible_heat_flux'], [0., 1.]],
+                      'LE': [['surface_upward_latent_heat_flux', 'surface_latent_heat_flux'], [0., 1.]],
+                      'BL_H': [['boundary_layer_heat_fluxes'], [0., 1.]]}
@@ -0,0 +1,247 @@
+import os
+import numpy as np
+import netCDF4 as nc
+
+from model_eval_tools.retrieve_UKV import find_model_files
+from model_eval_tools.retrieve_UKV import read_premade_model_files
+
+# number of hours in each chunk of the store (one chunk holds about a month of one model level)
+store_time_chunk = 24 * 31
+
+
+def consolidate_model_files(DOYstart,
+                            DOYstop,
+                            sitechoice,
+                            model_name,
+                            run,
+                            variable,
+                            store_path,
+                            model_path="/storage/basic/micromet/Tier_processing/rv006011/new_data_storage/",
+                            hoursbeforerepeat=24):
+    """
+    Finds the premade model files for a site and variable over a date range, and adds them to a consolidated store.
+    See find_model_files.find_UKV_files for the following:
+    :param DOYstart:
+    :param DOYstop:
+    :param sitechoice:
+    :param model_name:
+    :param run:
+    :param variable: single stash code variable (see read_premade_model_files.model_variable_registry)
+    :param model_path:
+    :param store_path: path of the store (see build_model_store)
+    :param hoursbeforerepeat: number of hours kept from each file, after spin up
+    :return: number of days added to the store
+    """
+
+    files = find_model_files.find_UKV_files(DOYstart, DOYstop, sitechoice, model_name, run, variable,
+                                            model_path=model_path)
+    files = find_model_files.order_model_stashes(files, variable)
+
+    return build_model_store(files, variable, model_name, sitechoice, run, store_path, hoursbeforerepeat)
+
+
+def build_model_store(files,
+                      variable,
+                      model_name,
+                      sitechoice,
+                      run,
+                      store_path,
+                      hoursbeforerepeat=24):
+    """
+    Copies premade model files (one per day) into one chunked, compressed netCDF4/HDF5 store, so that many days can be
+    read with one file open. Forecast spin up is removed as in read_premade_model_files.handle_model_time, and only
+    hoursbeforerepeat hours are kept from each file.
+    Values are stored as they are in the files (no unit conversion), with the times of all days along one record
+    dimension. Days already in the store are skipped, so a store can be extended by running this again.
+    Read with read_premade_model_files.extract_model_data_from_store.
+    :param files: dictionary of files for one variable {model + year + DOY: path}, from
+        find_model_files.order_model_stashes
+    :param variable: single stash code variable
+    :param model_name: e.g. 'ukv'
+    :param sitechoice: site the files are for
+    :param run: e.g. '21Z'
+    :param store_path: path of the store. Made if it doesn't exist.
+    :param hoursbeforerepeat: number of hours kept from each file, after spin up
+    :return: number of days added to the store
+    """
+
+    variable_registry = read_premade_model_files.model_variable_registry(variable)
+
+    store = open_model_store(store_path, variable, model_name, sitechoice, run, hoursbeforerepeat)
+
+    try:
+        stored_days = set(store.variables['day_key'][:]) if len(store.dimensions['day']) != 0 else set([])
+
+        days_added = 0
+        dodgy_files = []
+
+        for day_key in sorted(files.keys()):
+
+            if day_key in stored_days:
+                continue
+
+            file_path = files[day_key]
+
+            day_values = read_model_day(file_path, variable_registry, hoursbeforerepeat)
+
+            if day_values is None:
+                dodgy_files.append(file_path)
+                continue
+
+            append_model_day(store, day_key, day_values, variable_registry)
+            days_added += 1
+
+    finally:
+        store.close()
+
+    print('Days added to model store: ' + str(days_added))
+    print('number of dodgy model files:', len(dodgy_files))
+    if len(dodgy_files) != 0:
+        print(dodgy_files)
+
+    return days_added
+
+
+def open_model_store(store_path,
+                     variable,
+                     model_name,
+                     sitechoice,
+                     run,
+                     hoursbeforerepeat):
+    """
+    Opens a store for writing, making it if it doesn't exist yet.
+    An existing store has to be for the same variable, model, site, run and hours per day.
+    :return: netCDF4 dataset
+    """
+
+    store_description = {'variable': variable,
+                         'model_name': model_name,
+                         'sitechoice': sitechoice,
+                         'run': run,
+                         'hoursbeforerepeat': hoursbeforerepeat}
+
+    if os.path.isfile(store_path):
+        store = nc.Dataset(store_path, 'a')
+
+        for attribute in store_description:
+            if store.getncattr(attribute) != store_description[attribute]:
+                store.close()
+                raise ValueError('Model store is for a different ' + attribute + ': ', store_path)
+
+        return store
+
+    store = nc.Dataset(store_path, 'w', format='NETCDF4')
+
+    for attribute in store_description:
+        store.setncattr(attribute, store_description[attribute])
+
+    store.createDimension('record', None)
+    store.createDimension('day', None)
+    store.createDimension('grid_latitude', 3)
+    store.createDimension('grid_longitude', 3)
+
+    # seconds since 1970-01-01 of each stored hour
+    store.createVariable('time', 'i8', ('record',), zlib=True, chunksizes=(store_time_chunk,))
+
+    # the days in the store: values for day_key[i] are records [day_start[i]:day_start[i] + day_length[i]]
+    store.createVariable('day_key', str, ('day',))
+    store.createVariable('day_start', 'i8', ('day',))
+    store.createVariable('day_length', 'i4', ('day',))
+
+    return store
+
+
+def read_model_day(file_path,
+                   variable_registry,
+                   hoursbeforerepeat=24):
+    """
+    Reads the values to store from one premade model file: the whole 3x3 block, all levels, for the hours after spin up.
+    :param file_path: premade model file
+    :param variable_registry: from read_premade_model_files.model_variable_registry
+    :param hoursbeforerepeat: number of hours kept
+    :return: None if the file can't be read (dodgy file). Otherwise a dict of 'time' - datetime64[s] array,
+        'values' - array with shape (3, 3, times, levels), 'level_height' - array of level heights (None for surface
+        variables)
+    """
+
+    try:
+        nc_file = nc.Dataset(file_path)
+    except IOError:
+        print('PROBLEM READING FILE:')
+        print(file_path)
+        print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
+        return None
+
+    try:
+        try:
+            decoded_time = read_premade_model_files.decode_model_time(nc_file, file_path, hoursbeforerepeat)
+        except ValueError:
+            return None
+
+        index_to_start = decoded_time['index_to_start']
+        model_time = decoded_time['model_time']
+
+        try:
+            model_vars = read_premade_model_files.find_model_variable(nc_file, variable_registry['nc_names'])
+
+            if variable_registry['dims'] == 'levels':
+                level_height = nc_file.variables['level_height'][:]
+                values = model_vars[:, :, index_to_start:index_to_start + len(model_time), :]
+            else:
+                level_height = None
+                values = model_vars[:, :, index_to_start:index_to_start + len(model_time)][:, :, :, np.newaxis]
+
+        except KeyError as error:
+            print(' ')
+            print('ERROR HERE: ', file_path)
+            print("Could not read in ", error, " as this is not a variable in the file")
+            print(' ')
+            return None
+
+    finally:
+        nc_file.close()
+
+    return {'time': model_time, 'values': values, 'level_height': level_height}
+
+
+def append_model_day(store,
+                     day_key,
+                     day_values,
+                     variable_registry):
+    """
+    Appends one day, from read_model_day, to the end of an open store.
+    The values variable (and level heights) are made when the first day is added, as the number of levels is only
+    known then.
+    """
+
+    number_of_levels = np.shape(day_values['values'])[3]
+
+    if 'values' not in store.variables:
+        store.createDimension('level', number_of_levels)
+
+        store.createVariable('values', day_values['values'].dtype,
+                             ('grid_latitude', 'grid_longitude', 'record', 'level'),
+                             zlib=True, shuffle=True, complevel=4,
+                             chunksizes=(3, 3, store_time_chunk, 1))
+
+        if day_values['level_height'] is not None:
+            store.createVariable('level_height', day_values['level_height'].dtype, ('level',))
+            store.variables['level_height'][:] = day_values['level_height']
+
+    if len(store.dimensions['level']) != number_of_levels:
+        raise ValueError('Number of levels differs from the model store: ', day_key)
+
+    if day_values['level_height'] is not None:
+        if not np.ma.allequal(store.variables['level_height'][:], day_values['level_height']):
+            raise ValueError('Level heights differ from the model store: ', day_key)
+
+    record_start = len(store.dimensions['record'])
+    number_of_times = len(day_values['time'])
+    day_index = len(store.dimensions['day'])
+
+    store.variables['values'][:, :, record_start:record_start + number_of_times, :] = day_values['values']
+    store.variables['time'][record_start:record_start + number_of_times] = day_values['time'].astype(np.int64)
+
+    store.variables['day_key'][day_index] = day_key
+    store.variables['day_start'][day_index] = record_start
+    store.variables['day_length'][day_index] = number_of_times
@@ -0,0 +1,264 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# default size limit of a cache directory. When it's exceeded, least recently used entries are removed.
+cache_max_bytes = 2 * 1024 ** 3
+
+# when entries are removed, the cache is brought down to this fraction of its size limit, so the next few saves don't
+# need another eviction
+cache_evict_fraction = 0.9
+
+# the running size of a cache directory is kept in this file, so the directory isn't listed on every save
+cache_size_name = 'cache_size.json'
+
+# the directory is listed (and the running size corrected) at least this often, as saves from other processes at the
+# same time can be missed from the running size
+cache_saves_per_scan = 1000
+
+
+def cache_key(file_paths,
+              extraction_args):
+    """
+    Makes the key of an extracted result: the files it came from (path, size and modification time, so a file
+    which is changed or replaced gets a new key) and the arguments used to extract from them.
+    :param file_paths: list of the model files read
+    :param extraction_args: list of the other arguments which change what is extracted (variable, grid, target
+        height, hours, model, site...)
+    :return: key string. False if one of the files can't be found (nothing is cached).
+    """
+
+    file_stats = []
+    for file_path in file_paths:
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return False
+        file_stats.append([file_path, file_stat.st_size, file_stat.st_mtime])
+
+    key_string = json.dumps([file_stats, [str(arg) for arg in extraction_args]])
+
+    return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+
+def cache_path(cache_dir,
+               key):
+    """
+    :return: path of the npz file of a cache entry
+    """
+
+    return os.path.join(cache_dir, key + '.npz')
+
+
+def load_result(cache_dir,
+                key):
+    """
+    Loads an extracted result from the cache.
+    :param cache_dir: cache directory
+    :param key: from cache_key
+    :return: result dict (as saved with save_result), or None if it isn't in the cache.
+    """
+
+    if not key:
+        return None
+
+    path = cache_path(cache_dir, key)
+
+    try:
+        with np.load(path, allow_pickle=False) as cached:
+            layout = json.loads(str(cached['__layout__']))
+            result = {}
+            for name in layout:
+                if layout[name] == 'time':
+                    result[name] = cached[name].astype(object).tolist()
+                elif layout[name] == 'tuple':
+                    result[name] = tuple(unpack_array(cached, name + '.' + str(i))
+                                         for i in range(int(cached[name + '.n'])))
+                else:
+                    result[name] = unpack_array(cached, name)
+
+    except (OSError, KeyError, ValueError):
+        # not in the cache, or written by a different version: extract again
+        return None
+
+    # mark as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return result
+
+
+def save_result(cache_dir,
+                key,
+                result,
+                max_bytes=cache_max_bytes):
+    """
+    Saves an extracted result to the cache, as a compressed npz.
+    :param cache_dir: cache directory (made if it doesn't exist)
+    :param key: from cache_key
+    :param result: dict of arrays, scalars, tuples of arrays, and 'model_time' - list of datetimes
+    :param max_bytes: size limit of the cache directory
+    :return:
+    """
+
+    if not key:
+        return
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    layout = {}
+    arrays = {}
+    for name, value in result.items():
+        if name == 'model_time':
+            layout[name] = 'time'
+            arrays[name] = np.asarray(value, dtype='datetime64[s]')
+        elif type(value) == tuple:
+            layout[name] = 'tuple'
+            arrays[name + '.n'] = np.asarray(len(value))
+            for i, item in enumerate(value):
+                pack_array(arrays, name + '.' + str(i), item)
+        else:
+            layout[name] = 'array'
+            pack_array(arrays, name, value)
+
+    arrays['__layout__'] = np.asarray(json.dumps(layout))
+
+    # written to a temporary file first, so other processes never read a half written entry
+    path = cache_path(cache_dir, key)
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        np.savez_compressed(temp_file, **arrays)
+
+    # size of an entry being replaced
+    try:
+        replaced_bytes = os.path.getsize(path)
+    except OSError:
+        replaced_bytes = 0
+
+    os.replace(temp_path, path)
+
+    add_cache_bytes(cache_dir, os.path.getsize(path) - replaced_bytes, max_bytes)
+
+
+def read_cache_size(cache_dir):
+    """
+    :return: running size of a cache directory: dict of 'bytes' - size of the entries, 'saves' - number of saves since
+        the directory was last listed. None if it isn't known.
+    """
+
+    try:
+        with open(os.path.join(cache_dir, cache_size_name)) as size_file:
+            cache_size = json.load(size_file)
+        return {'bytes': int(cache_size['bytes']), 'saves': int(cache_size['saves'])}
+    except (OSError, KeyError, ValueError, TypeError):
+        return None
+
+
+def write_cache_size(cache_dir,
+                     cache_size):
+    """
+    Writes the running size of a cache directory (see read_cache_size).
+    """
+
+    size_path = os.path.join(cache_dir, cache_size_name)
+    temp_path = size_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as size_file:
+        json.dump(cache_size, size_file)
+    os.replace(temp_path, size_path)
+
+
+def add_cache_bytes(cache_dir,
+                    added_bytes,
+                    max_bytes=cache_max_bytes):
+    """
+    Adds a save to the running size of a cache directory. The directory is only listed (see evict_cache) when the
+    running size goes over max_bytes, every cache_saves_per_scan saves, or if the running size isn't known yet.
+    :param cache_dir: cache directory
+    :param added_bytes: change in size from the save
+    :param max_bytes: size limit of the cache directory
+    :return:
+    """
+
+    cache_size = read_cache_size(cache_dir)
+
+    if cache_size is None:
+        evict_cache(cache_dir, max_bytes)
+        return
+
+    cache_size['bytes'] += added_bytes
+    cache_size['saves'] += 1
+
+    if cache_size['bytes'] > max_bytes or cache_size['saves'] >= cache_saves_per_scan:
+        evict_cache(cache_dir, max_bytes)
+    else:
+        write_cache_size(cache_dir, cache_size)
+
+
+def pack_array(arrays,
+               name,
+               value):
+    """
+    Adds the data and mask of a (masked) array to a dict of arrays to save.
+    """
+
+    value = np.ma.asarray(value)
+    arrays[name] = np.ma.getdata(value)
+    arrays[name + '.mask'] = np.ma.getmaskarray(value)
+
+
+def unpack_array(cached,
+                 name):
+    """
+    Rebuilds a masked array saved with pack_array. 0-d arrays are returned as scalars.
+    """
+
+    value = np.ma.masked_array(cached[name], mask=cached[name + '.mask'])
+
+    if value.ndim == 0:
+        return value[()]
+
+    return value
+
+
+def evict_cache(cache_dir,
+                max_bytes=cache_max_bytes):
+    """
+    Removes the least recently used entries from the cache if it is over its size limit, until it is down to
+    cache_evict_fraction of the limit. Lists the whole directory: save_result only calls this when needed.
+    The running size of the cache (see read_cache_size) is reset from the listing.
+    :param cache_dir: cache directory
+    :param max_bytes: size limit of the cache directory
+    :return: number of entries removed
+    """
+
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith('.npz'):
+            continue
+        try:
+            file_stat = os.stat(os.path.join(cache_dir, filename))
+        except OSError:
+            continue
+        entries.append((file_stat.st_mtime, file_stat.st_size, filename))
+
+    total_bytes = sum(entry[1] for entry in entries)
+
+    removed = 0
+    if total_bytes > max_bytes:
+        for entry_mtime, entry_size, filename in sorted(entries):
+            if total_bytes <= max_bytes * cache_evict_fraction:
+                break
+            try:
+                os.remove(os.path.join(cache_dir, filename))
+            except OSError:
+                continue
+            total_bytes -= entry_size
+            removed += 1
+
+    write_cache_size(cache_dir, {'bytes': total_bytes, 'saves': 0})
+
+    return removed
@@ -1,9 +1,12 @@
 import os.path
 import datetime as dt
 from calendar import isleap
-import sys
+import time as timer
+from concurrent.futures import ThreadPoolExecutor
 
 from model_eval_tools import look_up
+from model_eval_tools.retrieve_UKV import model_file_catalog
+from model_eval_tools.retrieve_UKV import model_file_names
 
 
 def find_UKV_files(DOYstart,
@@ -12,7 +15,9 @@ def find_UKV_files(DOYstart,
                    model_name,
                    run,
                    variable,
-                   model_path="/storage/basic/micromet/Tier_processing/rv006011/new_data_storage/"):
+                   model_path="/storage/basic/micromet/Tier_processing/rv006011/new_data_storage/",
+                   catalog_path=False,
+                   max_workers=1):
     """
     :param DOYstart:
     :param DOYstop:
@@ -21,12 +26,208 @@ def find_UKV_files(DOYstart,
     :param run: what model run: should be a string, '06Z' or '21Z'.
     :param variable:
     :param model_path:
+    :param catalog_path: path to a local sqlite catalog of the model store (see model_file_catalog). If given, files
+        are found with an indexed query on the catalog instead of listing and checking paths on the model store.
+    :param max_workers: number of threads used to list directories on the model store. If more than 1, the DAY
+        directories of all years and then the wanted DOY directories are listed concurrently, and file existence is
+        checked against these listings rather than with one stat per file. Timings of each phase are printed.
     :return:
     """
 
     # make sure that the model request given is an option.
     assert model_name in look_up.model_options.keys()
 
+    if catalog_path:
+        return model_file_catalog.find_UKV_files_catalog(DOYstart, DOYstop, sitechoice, model_name, run, variable,
+                                                         catalog_path, model_path)
+
+    # years, and DOYs for each year, in the chosen range
+    year_list, DOYlist = find_DOY_list(DOYstart, DOYstop)
+
+    # prints out DOYs chosen in terminal
+    print('DOYs chosen:')
+    for key in sorted(DOYlist.keys()):
+        print('year:', key)
+        print(DOYlist[key])
+
+    # creates dictionaries to append model files to
+    ukvdict = {}
+
+    # time spent in each phase of finding files
+    phase_times = {'list DAY directories': 0.0, 'check files exist': 0.0, 'group by DOY': 0.0}
+
+    if max_workers > 1:
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        pool = None
+
+    # the pool is shut down even if a directory can't be listed
+    try:
+        if max_workers > 1:
+            # list the DAY directories of all years at once
+            phase_start = timer.time()
+            DAY_listings = dict(zip(year_list, pool.map(os.listdir, [model_path + year + '/London/L2/MetOffice/DAY'
+                                                                      for year in year_list])))
+            phase_times['list DAY directories'] += timer.time() - phase_start
+
+        # finding model files year by year.
+        for year in year_list:
+            print(' ')
+            print('For year: ', year)
+            # finding all model DOYs which exists
+            modmainpath = model_path + year + '/London/L2/MetOffice/DAY'
+            phase_start = timer.time()
+            if max_workers > 1:
+                DOYoptionsmod = DAY_listings[year]
+            else:
+                DOYoptionsmod = os.listdir(modmainpath)
+            phase_times['list DAY directories'] += timer.time() - phase_start
+            # List of all matches between avalible DOYs and wanted DOYs
+            DOYmatchesmod = []
+            for item in DOYoptionsmod:
+                if item in DOYlist[year]:
+                    DOYmatchesmod.append(item)
+            modmissingDOY = []
+            if len(DOYmatchesmod) == len(DOYlist[year]):
+                print('All model DOYs found')
+            else:
+                print('There is a missing DOY/DOYs for the model:')
+                for item in DOYlist[year]:
+                    if item in DOYmatchesmod:
+                        pass
+                    else:
+                        print(item)
+                        modmissingDOY.append(item)
+
+            ukvfilepaths = []
+            for item in DOYmatchesmod:
+
+                # (Changed to see if I can get more relevant missing files to work)
+                if variable == 'wind' or variable == 'RH_q' or variable == 'kup':
+                    # requires more than one stash code.
+                    codes = look_up.variables[variable]
+                    dateobject = dt.datetime.strptime(str(year) + ' ' + item, '%Y %j')
+                    for code in codes:
+                        # where model_options[model_name][0] is the model filename preface
+                        filename = look_up.model_options[model_name][0] + dateobject.strftime(
+                            '%Y%m%d') + run + '_' + code + '_' + look_up.premade_model_site_codes[
+                                       sitechoice] + '.nc'
+
+                        pathto = modmainpath + '/' + item + '/'
+                        path = pathto + filename
+                        ukvfilepaths.append(path)
+
+                else:
+                    # requires only one stash code
+                    code = look_up.variables[variable]
+                    dateobject = dt.datetime.strptime(str(year) + ' ' + item, '%Y %j')
+
+                    # where model_options[model_name][0] is the model filename preface
+                    filename = look_up.model_options[model_name][0] + dateobject.strftime(
+                        '%Y%m%d') + run + '_' + code + '_' + look_up.premade_model_site_codes[
+                                   sitechoice] + '.nc'
+
+                    pathto = modmainpath + '/' + item + '/'
+                    path = pathto + filename
+                    ukvfilepaths.append(path)
+
+            phase_start = timer.time()
+            if max_workers > 1:
+                # prefetch the listing of every wanted DOY directory, then check paths against these listings
+                # one listing per DOY rather than one stat per file
+                DOY_dirs = [modmainpath + '/' + item + '/' for item in DOYmatchesmod]
+                DOY_listings = dict(zip(DOY_dirs, pool.map(list_directory, DOY_dirs)))
+                paths_exist = [os.path.basename(item) in DOY_listings[os.path.dirname(item) + '/']
+                               for item in ukvfilepaths]
+            else:
+                paths_exist = [os.path.exists(item) for item in ukvfilepaths]
+            phase_times['check files exist'] += timer.time() - phase_start
+
+            # Changed to see if I can get more relevant missing files to work
+            ukvexist = 0
+            ukvexistlist = []
+            ukvdontexistlist = []
+            for item, item_exists in zip(ukvfilepaths, paths_exist):
+                if item_exists == True:
+                    ukvexist += 1
+                    ukvexistlist.append(item)
+                else:
+                    ukvdontexistlist.append(item)
+
+            if len(ukvdontexistlist) == 0:
+                print('all ' + str(len(ukvexistlist)) + ' files exist from ' + str(len(DOYlist[year])) + ' DOYs')
+            else:
+                totalleng = len(ukvexistlist) + len(ukvdontexistlist)
+                print(str(ukvexist) + ' out of ' + str(totalleng) + ' files found. Missing:')
+                ukvmissinglist = modmissingDOY + ukvdontexistlist
+                print(ukvmissinglist)
+
+            phase_start = timer.time()
+
+            # DOY of each file, parsed from the filenames in one pass
+            ukvDOYs = model_file_names.parse_model_filenames(ukvexistlist)['doy'].tolist()
+
+            # Making a list of the index where the DOY changes
+            doychangeukv = []
+            for i in range(1, len(ukvDOYs)):
+                if ukvDOYs[i - 1] == ukvDOYs[i]:
+                    pass
+                else:
+                    doychangeukv.append(i)
+
+            if len(doychangeukv) == 0:
+                if len(ukvDOYs) == 0:
+                    print('No files for: ' + model_name)
+                else:
+                    ukvlistdoy0 = ukvDOYs
+                    ukvlist0 = ukvexistlist
+                    ukvdict[model_name + year + str(ukvlistdoy0[0])] = ukvlist0
+
+            else:
+                # Creating a dictionary for the values of each DOY
+                # first item
+                ukvlistdoy0 = ukvDOYs[0:doychangeukv[0]]
+                ukvlist0 = ukvexistlist[0:doychangeukv[0]]
+                ukvdict[model_name + year + str(ukvlistdoy0[0])] = ukvlist0
+
+                # middle items
+                ukvi = 1
+                for item in range(1, len(doychangeukv)):
+                    listdoy = ukvDOYs[doychangeukv[ukvi - 1]:doychangeukv[ukvi]]
+                    list = ukvexistlist[doychangeukv[ukvi - 1]:doychangeukv[ukvi]]
+                    ukvdict[model_name + year + str(listdoy[0])] = list
+                    ukvi += 1
+
+                # final item
+                ukvlistdoyend = ukvDOYs[doychangeukv[-1]:len(ukvDOYs)]
+                ukvlistend = ukvexistlist[doychangeukv[-1]:len(ukvexistlist)]
+                ukvdict[model_name + year + str(ukvlistdoyend[0])] = ukvlistend
+
+            phase_times['group by DOY'] += timer.time() - phase_start
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if max_workers > 1:
+        print(' ')
+        print('Time taken finding files (' + str(max_workers) + ' threads):')
+        for phase in phase_times:
+            print(phase + ': %.3f s' % phase_times[phase])
+
+    print(' ')
+    return ukvdict
+
+
+def find_DOY_list(DOYstart,
+                  DOYstop):
+    """
+    Finds all years and DOYs in between a start and stop DOY.
+    :param DOYstart: start of date range, as YYYYDOY (e.g. 2016126)
+    :param DOYstop: end of date range, as YYYYDOY
+    :return year_list: list of year strings included
+    :return DOYlist: dictionary of lists of zero-padded DOY strings (e.g. '005') for each year included
+    """
+
     # finding start and stop years, and start and stop DOYs
     # (has been re-done to include the option to run more than one year at once)
     # makes into string
@@ -115,145 +316,135 @@ def find_UKV_files(DOYstart,
                     else:
                         DOYlist[year].append(str(item))
 
-    # prints out DOYs chosen in terminal
-    print('DOYs chosen:')
-    for key in sorted(DOYlist.keys()):
-        print('year:', key)
-        print(DOYlist[key])
+    return year_list, DOYlist
 
-    # creates dictionaries to append model files to
-    ukvdict = {}
 
-    # finding model files year by year.
+def list_directory(path):
+    """
+    Lists a directory as a set of names - returns an empty set if the directory doesn't exist.
+    :param path: path to the directory
+    :return: set of names in the directory
+    """
+
+    try:
+        return set(os.listdir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return set([])
+
+
+def find_UKV_files_batch(DOYstart,
+                         DOYstop,
+                         sites,
+                         model_name,
+                         run,
+                         variables,
+                         model_path="/storage/basic/micromet/Tier_processing/rv006011/new_data_storage/",
+                         max_workers=1):
+    """
+    Finds files for many sites and variables at once. Every wanted DOY directory on the model store is listed only
+    once, and all files for all sites and stash codes are picked out of that listing - rather than calling
+    find_UKV_files once per site and per variable.
+    :param DOYstart: see find_UKV_files
+    :param DOYstop: see find_UKV_files
+    :param sites: list of site choices (keys of look_up.premade_model_site_codes)
+    :param model_name: see find_UKV_files
+    :param run: see find_UKV_files
+    :param variables: list of variables (keys of look_up.variables)
+    :param model_path: see find_UKV_files
+    :param max_workers: number of threads used to list the DOY directories.
+    :return: nested dictionary of found files: {site: {stash: {model + year + DOY: path}}}
+    """
+
+    # make sure that the model request given is an option.
+    assert model_name in look_up.model_options.keys()
+
+    # all stash codes needed for the chosen variables
+    stashes = set([])
+    for variable in variables:
+        codes = look_up.variables[variable]
+        if type(codes) == list:
+            stashes.update(codes)
+        else:
+            stashes.add(codes)
+
+    year_list, DOYlist = find_DOY_list(DOYstart, DOYstop)
+
+    # every wanted DOY directory which exists
+    DOY_dirs = []
     for year in year_list:
-        print(' ')
-        print('For year: ', year)
-        # finding all model DOYs which exists
         modmainpath = model_path + year + '/London/L2/MetOffice/DAY'
-        DOYoptionsmod = os.listdir(modmainpath)
-        # List of all matches between avalible DOYs and wanted DOYs
-        DOYmatchesmod = []
-        for item in DOYoptionsmod:
+        for item in sorted(list_directory(modmainpath)):
             if item in DOYlist[year]:
-                DOYmatchesmod.append(item)
-        modmissingDOY = []
-        if len(DOYmatchesmod) == len(DOYlist[year]):
-            print('All model DOYs found')
-        else:
-            print('There is a missing DOY/DOYs for the model:')
-            for item in DOYlist[year]:
-                if item in DOYmatchesmod:
-                    pass
-                else:
-                    print(item)
-                    modmissingDOY.append(item)
-
-        ukvfilepaths = []
-        for item in DOYmatchesmod:
-
-            # (Changed to see if I can get more relevant missing files to work)
-            if variable == 'wind' or variable == 'RH_q' or variable == 'kup':
-                # requires more than one stash code.
-                codes = look_up.variables[variable]
-                dateobject = dt.datetime.strptime(str(year) + ' ' + item, '%Y %j')
-                for code in codes:
-                    # where model_options[model_name][0] is the model filename preface
-                    filename = look_up.model_options[model_name][0] + dateobject.strftime(
-                        '%Y%m%d') + run + '_' + code + '_' + look_up.premade_model_site_codes[
-                                   sitechoice] + '.nc'
+                DOY_dirs.append((year, item, modmainpath + '/' + item + '/'))
 
-                    pathto = modmainpath + '/' + item + '/'
-                    path = pathto + filename
-                    ukvfilepaths.append(path)
+    # one listing per DOY directory
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            listings = list(pool.map(list_directory, [DOY_dir[2] for DOY_dir in DOY_dirs]))
+    else:
+        listings = [list_directory(DOY_dir[2]) for DOY_dir in DOY_dirs]
+
+    batch_index = {}
+    for site in sites:
+        batch_index[site] = {}
+        for stash in stashes:
+            batch_index[site][stash] = {}
+
+    # parse every file name found in one pass, and keep the ones wanted
+    paths = []
+    keys = []
+    for (year, item, pathto), listing in zip(DOY_dirs, listings):
+        for filename in sorted(listing):
+            paths.append(pathto + filename)
+            keys.append(model_name + year + item)
+
+    records = model_file_names.parse_model_filenames(paths)
+    records['key'] = keys
+    wanted = records[(records['model'] == model_name) &
+                     (records['run'] == run) &
+                     (records['site'].isin(sites)) &
+                     (records['stash'].isin(stashes)) &
+                     (records['year'] + records['doy'] == records['key'].str[len(model_name):])]
+
+    for site, stash, key, path in zip(wanted['site'], wanted['stash'], wanted['key'], wanted['path']):
+        batch_index[site][stash][key] = path
 
-            else:
-                # requires only one stash code
-                code = look_up.variables[variable]
-                dateobject = dt.datetime.strptime(str(year) + ' ' + item, '%Y %j')
-
-                # where model_options[model_name][0] is the model filename preface
-                filename = look_up.model_options[model_name][0] + dateobject.strftime(
-                    '%Y%m%d') + run + '_' + code + '_' + look_up.premade_model_site_codes[
-                               sitechoice] + '.nc'
-
-                pathto = modmainpath + '/' + item + '/'
-                path = pathto + filename
-                ukvfilepaths.append(path)
-
-        # Changed to see if I can get more relevant missing files to work
-        ukvexist = 0
-        ukvexistlist = []
-        ukvdontexistlist = []
-        for item in ukvfilepaths:
-            if os.path.exists(item) == True:
-                ukvexist += 1
-                ukvexistlist.append(item)
-            else:
-                ukvdontexistlist.append(item)
+    print(' ')
+    print('Batch of files found for ' + str(len(DOY_dirs)) + ' DOYs:')
+    for site in sorted(batch_index):
+        print(site + ': ' + ', '.join(stash + ' (' + str(len(batch_index[site][stash])) + ')'
+                                      for stash in sorted(batch_index[site])))
+    print(' ')
 
-        if len(ukvdontexistlist) == 0:
-            print('all ' + str(len(ukvexistlist)) + ' files exist from ' + str(len(DOYlist[year])) + ' DOYs')
-        else:
-            totalleng = len(ukvexistlist) + len(ukvdontexistlist)
-            print(str(ukvexist) + ' out of ' + str(totalleng) + ' files found. Missing:')
-            ukvmissinglist = modmissingDOY + ukvdontexistlist
-            print(ukvmissinglist)
-
-        ukvDOYs = []
-        for item in ukvexistlist:
-
-            # KSSW is a site with more letters than others, so it's handled differently when finding the date:
-            if sitechoice == 'KSSW':
-                strip = item[-34:-26]
-            elif sitechoice == 'BFCL':
-                strip = item[-34:-26]
-            elif sitechoice == 'MR':
-                strip = item[-32:-24]
-            elif sitechoice == 'NK':
-                strip = item[-32:-24]
-            else:
-                strip = item[-33:-25]
-            time = dt.datetime.strptime(strip, '%Y%m%d')
-            DOY = time.strftime('%j')
-            ukvDOYs.append(DOY)
-
-        # Making a list of the index where the DOY changes
-        doychangeukv = []
-        for i in range(1, len(ukvDOYs)):
-            if ukvDOYs[i - 1] == ukvDOYs[i]:
-                pass
-            else:
-                doychangeukv.append(i)
+    return batch_index
 
-        if len(doychangeukv) == 0:
-            if len(ukvDOYs) == 0:
-                print('No files for: ' + model_name)
-            else:
-                ukvlistdoy0 = ukvDOYs
-                ukvlist0 = ukvexistlist
-                ukvdict[model_name + year + str(ukvlistdoy0[0])] = ukvlist0
 
-        else:
-            # Creating a dictionary for the values of each DOY
-            # first item
-            ukvlistdoy0 = ukvDOYs[0:doychangeukv[0]]
-            ukvlist0 = ukvexistlist[0:doychangeukv[0]]
-            ukvdict[model_name + year + str(ukvlistdoy0[0])] = ukvlist0
-
-            # middle items
-            ukvi = 1
-            for item in range(1, len(doychangeukv)):
-                listdoy = ukvDOYs[doychangeukv[ukvi - 1]:doychangeukv[ukvi]]
-                list = ukvexistlist[doychangeukv[ukvi - 1]:doychangeukv[ukvi]]
-                ukvdict[model_name + year + str(listdoy[0])] = list
-                ukvi += 1
-
-            # final item
-            ukvlistdoyend = ukvDOYs[doychangeukv[-1]:len(ukvDOYs)]
-            ukvlistend = ukvexistlist[doychangeukv[-1]:len(ukvexistlist)]
-            ukvdict[model_name + year + str(ukvlistdoyend[0])] = ukvlistend
+def batch_file_dict(batch_index,
+                    site,
+                    variable):
+    """
+    Takes the files for one site and variable from the output of find_UKV_files_batch, in the same format as returned
+    by find_UKV_files.
+    :param batch_index: output of find_UKV_files_batch
+    :param site: site choice
+    :param variable: variable choice
+    :return: dictionary of found files: {model + year + DOY: [paths]}, with paths in the stash order of look_up
+    """
+
+    codes = look_up.variables[variable]
+    if type(codes) != list:
+        codes = [codes]
+
+    ukvdict = {}
+    for code in codes:
+        for key, path in batch_index[site][code].items():
+            if key not in ukvdict:
+                ukvdict[key] = []
+            ukvdict[key].append(path)
+
+    # keep the days in order
+    ukvdict = {key: ukvdict[key] for key in sorted(ukvdict)}
 
-    print(' ')
     return ukvdict
 
 
@@ -264,9 +455,11 @@ def order_model_stashes(files,
     Also needs to be done for variables with one stash code - as file paths are produced as lists from the other
     finding files function at the moment. This in the future could be moved to the other function (like how the obs
     have been handled).
-    :param files:
+    :param files: dictionary of found files, as returned by find_UKV_files: {model + year + DOY: [paths]}
     :param variable:
-    :return:
+    :return: for variables with one stash code, a dictionary {model + year + DOY: path}. For variables with more than
+        one stash code, a list of these dictionaries, one per stash code (in the order of look_up.variables), all with
+        the same keys.
     """
 
     print(' ')
@@ -274,109 +467,65 @@ def order_model_stashes(files,
     print('Ordering Model files: ')
     print(' ')
 
+    return align_stash_files(group_files_by_stash(files), variable)
+
+
+def group_files_by_stash(files):
+    """
+    Groups found files by their stash code, in a single pass over all paths.
+    :param files: dictionary of found files, as returned by find_UKV_files: {model + year + DOY: [paths]}
+    :return: dictionary {stash: {model + year + DOY: path}} - the same layout as one site of find_UKV_files_batch
+    """
+
+    stash_index = {}
+
+    for key in files.keys():
+        for item in files[key]:
+            record = model_file_names.parse_model_filename(item)
+            if record is None:
+                print('Not a premade model file: ', item)
+                continue
+
+            if record.stash not in stash_index:
+                stash_index[record.stash] = {}
+            stash_index[record.stash][key] = item
+
+    return stash_index
+
+
+def align_stash_files(stash_index,
+                      variable):
+    """
+    Picks the stash code(s) of a variable out of a stash index, making sure that variables which need more than one
+    stash code have a file for every stash code on every day.
+    :param stash_index: dictionary {stash: {model + year + DOY: path}}, from group_files_by_stash or one site of
+        find_UKV_files_batch (batch_index[site])
+    :param variable:
+    :return: see order_model_stashes
+    """
+
     # finds the stash code of the variable I am looking at
     stash = look_up.variables[variable]
+
+    # for variables which only use one stash code:
+    if type(stash) != list:
+        stash_files = stash_index.get(stash, {})
+        return {key: stash_files[key] for key in sorted(stash_files)}
+
     # if there is more than one stash code involved in this variable:
-    if type(stash) == list:
-        print('Variable: ', variable, ' uses more than one stash code.')
-
-        if variable == 'RH_q':
-            RH_stash = look_up.variables[variable]
-            T_stash = RH_stash[0]
-            P_stash = RH_stash[1]
-            Q_stash = RH_stash[2]
-
-            new_ukv_T = {}
-            new_ukv_P = {}
-            new_ukv_Q = {}
-
-            # T
-            for key in files.keys():
-                for item in files[key]:
-                    if T_stash in item:
-                        new_ukv_T[key] = item
-            # P
-            for key in files.keys():
-                for item in files[key]:
-                    if P_stash in item:
-                        new_ukv_P[key] = item
-            # Q
-            for key in files.keys():
-                for item in files[key]:
-                    if Q_stash in item:
-                        new_ukv_Q[key] = item
-
-            list_to_return = [new_ukv_T, new_ukv_P, new_ukv_Q]
-            return list_to_return
-
-        elif variable == 'wind':
-            wind_stash = look_up.variables[variable]
-            u_stash = wind_stash[0]
-            v_stash = wind_stash[1]
-
-            new_ukv_u = {}
-            new_ukv_v = {}
-
-            # u
-            for key in files.keys():
-                for item in files[key]:
-                    if u_stash in item:
-                        new_ukv_u[key] = item
-            # v
-            for key in files.keys():
-                for item in files[key]:
-                    if v_stash in item:
-                        new_ukv_v[key] = item
-
-            list_to_return = [new_ukv_u, new_ukv_v]
-            return list_to_return
-
-        elif variable == 'kup':
-            up_stash = look_up.variables[variable]
-            down_stash = up_stash[0]
-            star_stash = up_stash[1]
-
-            new_ukv_down = {}
-            new_ukv_star = {}
-
-            for key in files.keys():
-                for item in files[key]:
-                    if down_stash in item:
-                        new_ukv_down[key] = item
-
-            for key in files.keys():
-                for item in files[key]:
-                    if star_stash in item:
-                        new_ukv_star[key] = item
-
-            # making sure both stash codes needed have the same amount of files
-            for down_item in new_ukv_down.keys():
-                if down_item in new_ukv_star:
-                    pass
-                else:
-                    del new_ukv_down[down_item]
-            for star_item in new_ukv_star.keys():
-                if star_item in new_ukv_down:
-                    pass
-                else:
-                    del new_ukv_star[star_item]
-            # Test if the keys are now the same
-            if sorted(new_ukv_star.keys()) == sorted(new_ukv_down.keys()):
-                if len(new_ukv_down) == len(new_ukv_star):
-                    pass
-            else:
-                print("ERROR: The keys between both stash codes are different")
-                sys.exit()
+    print('Variable: ', variable, ' uses more than one stash code.')
 
-            list_to_return = [new_ukv_down, new_ukv_star]
-            return list_to_return
+    stash_files = [stash_index.get(code, {}) for code in stash]
 
-    # for variables which only use one stash code:
-    else:
-        # define a dictionary
-        new_model = {}
-        for key in files.keys():
-            for item in files[key]:
-                if stash in item:
-                    new_model[key] = item
-        return new_model
+    # only keep days which have files for all stash codes
+    all_keys = set([])
+    for code_files in stash_files:
+        all_keys.update(code_files.keys())
+    common_keys = sorted(set.intersection(*[set(code_files.keys()) for code_files in stash_files]))
+
+    if len(common_keys) != len(all_keys):
+        print('Days without files for all stash codes (not used): ', sorted(all_keys.difference(common_keys)))
+
+    list_to_return = [{key: code_files[key] for key in common_keys} for code_files in stash_files]
+
+    return list_to_return
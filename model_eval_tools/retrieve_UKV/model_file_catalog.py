@@ -0,0 +1,170 @@
+import os
+import sqlite3
+
+from model_eval_tools import look_up
+from model_eval_tools.retrieve_UKV import model_file_names
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    model TEXT NOT NULL,
+    date TEXT NOT NULL,
+    yeardoy INTEGER NOT NULL,
+    run TEXT NOT NULL,
+    stash TEXT NOT NULL,
+    site TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_lookup ON files (model, run, site, stash, yeardoy);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+"""
+
+
+def open_catalog(catalog_path):
+    """
+    Opens (and creates, if it doesn't exist yet) the sqlite catalog of premade model files.
+    :param catalog_path: path to the local sqlite file.
+    :return: sqlite3 connection
+    """
+
+    connection = sqlite3.connect(catalog_path)
+    connection.executescript(catalog_schema)
+
+    return connection
+
+
+def refresh_catalog(catalog_path,
+                    model_path="/storage/basic/micromet/Tier_processing/rv006011/new_data_storage/",
+                    years=False):
+    """
+    Scans the model store and records every premade model file found in the catalog.
+    Only DOY directories whose mtime has changed since the last refresh are re-listed, so after the first scan a
+    refresh costs one stat per DOY directory rather than one per file.
+    :param catalog_path: path to the local sqlite file.
+    :param model_path: root of the model store (same as given to find_UKV_files).
+    :param years: list of year strings to scan. If False, all 4 digit directories in model_path are scanned.
+    :return: number of DOY directories which were (re-)listed
+    """
+
+    if not years:
+        years = sorted(item for item in os.listdir(model_path) if item.isdigit() and len(item) == 4)
+
+    connection = open_catalog(catalog_path)
+    known_dirs = dict(connection.execute('SELECT path, mtime FROM dirs'))
+
+    rescanned = 0
+
+    with connection:
+        for year in years:
+            modmainpath = model_path + year + '/London/L2/MetOffice/DAY'
+
+            if not os.path.isdir(modmainpath):
+                print('No model directory for year: ', year)
+                continue
+
+            seen_dirs = set([])
+
+            for doy in os.listdir(modmainpath):
+                pathto = modmainpath + '/' + doy + '/'
+
+                try:
+                    dir_mtime = os.stat(pathto).st_mtime
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+
+                seen_dirs.add(pathto)
+
+                # directory hasn't changed since it was last listed
+                if known_dirs.get(pathto) == dir_mtime:
+                    continue
+
+                rows = []
+                for filename in os.listdir(pathto):
+                    record = model_file_names.parse_model_filename(filename)
+                    if record is None:
+                        continue
+
+                    path = pathto + filename
+                    file_stat = os.stat(path)
+                    rows.append((path, pathto, record.model, record.date.strftime('%Y%m%d'), int(year + doy),
+                                 record.run, record.stash, record.site, file_stat.st_size, file_stat.st_mtime))
+
+                connection.execute('DELETE FROM files WHERE dir = ?', (pathto,))
+                connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (pathto, dir_mtime))
+                rescanned += 1
+
+            # forget about DOY directories which have been removed from the store
+            for pathto in known_dirs:
+                if pathto.startswith(modmainpath + '/') and pathto not in seen_dirs:
+                    connection.execute('DELETE FROM files WHERE dir = ?', (pathto,))
+                    connection.execute('DELETE FROM dirs WHERE path = ?', (pathto,))
+
+    connection.close()
+
+    print('Catalog refreshed: ' + str(rescanned) + ' DOY directories listed')
+
+    return rescanned
+
+
+def find_UKV_files_catalog(DOYstart,
+                           DOYstop,
+                           sitechoice,
+                           model_name,
+                           run,
+                           variable,
+                           catalog_path,
+                           model_path="/storage/basic/micromet/Tier_processing/rv006011/new_data_storage/",
+                           refresh=True):
+    """
+    Catalog version of find_model_files.find_UKV_files: finds files with one indexed query rather than
+    checking every path on the model store.
+    :param DOYstart: see find_UKV_files
+    :param DOYstop: see find_UKV_files
+    :param sitechoice: see find_UKV_files
+    :param model_name: see find_UKV_files
+    :param run: see find_UKV_files
+    :param variable: see find_UKV_files
+    :param catalog_path: path to the local sqlite file.
+    :param model_path: see find_UKV_files
+    :param refresh: if True, the years in the date range are refreshed in the catalog before querying.
+    :return: dictionary of found files, in the same format as find_UKV_files: {model + year + DOY: [paths]}
+    """
+
+    # make sure that the model request given is an option.
+    assert model_name in look_up.model_options.keys()
+
+    if refresh:
+        years = [str(year) for year in range(int(str(DOYstart)[:4]), int(str(DOYstop)[:4]) + 1)]
+        refresh_catalog(catalog_path, model_path, years)
+
+    codes = look_up.variables[variable]
+    if type(codes) != list:
+        codes = [codes]
+
+    connection = open_catalog(catalog_path)
+    rows = connection.execute('SELECT yeardoy, stash, path FROM files '
+                              'WHERE model = ? AND run = ? AND site = ? AND yeardoy BETWEEN ? AND ? '
+                              'AND stash IN (' + ', '.join('?' * len(codes)) + ') ',
+                              [model_name, run, sitechoice, int(DOYstart), int(DOYstop)] + codes).fetchall()
+    connection.close()
+
+    # order paths within each day by stash code, in the order they are listed in look_up (same as find_UKV_files)
+    rows = sorted(rows, key=lambda row: (row[0], codes.index(row[1])))
+
+    ukvdict = {}
+    for yeardoy, stash, path in rows:
+        key = model_name + str(yeardoy)
+        if key not in ukvdict:
+            ukvdict[key] = []
+        ukvdict[key].append(path)
+
+    print(str(len(rows)) + ' files found in catalog for ' + str(len(ukvdict)) + ' DOYs')
+
+    return ukvdict
@@ -0,0 +1,82 @@
+import re
+import datetime as dt
+from collections import namedtuple
+from functools import lru_cache
+
+import pandas as pd
+
+from model_eval_tools import look_up
+
+# premade model files are named like: MOUKV_FC2016050521Z_m01s03i217_LON_KSSW.nc
+# groups are: model filename preface, date (YYYYMMDD), run, stash code, site code
+model_filename_regex = r'(MO[A-Z]+_FC)(\d{8})(\d{2}Z)_(m\d{2}s\d{2}i\d{3})_([^/\\]+)\.nc$'
+model_filename_pattern = re.compile(model_filename_regex)
+
+# lookups to go from the filename back to the names used in look_up
+model_prefaces = {look_up.model_options[key][0]: key for key in look_up.model_options}
+site_codes = {look_up.premade_model_site_codes[key]: key for key in look_up.premade_model_site_codes}
+
+# model - key of look_up.model_options (e.g. 'ukv')
+# date - datetime.date of the forecast run
+# year, doy - strings, doy zero-padded to 3 digits (as used in the model store directories)
+# run - e.g. '21Z'
+# stash - stash code
+# site - key of look_up.premade_model_site_codes (e.g. 'KSSW')
+ModelFile = namedtuple('ModelFile', ['model', 'date', 'year', 'doy', 'run', 'stash', 'site'])
+
+
+@lru_cache(maxsize=None)
+def parse_model_filename(file_path):
+    """
+    Parses the name of a premade model file, rather than recovering the date with site-dependant string slicing.
+    Results are cached, so repeated calls for the same path are free.
+    :param file_path: path (or filename) of a premade model file.
+    :return: ModelFile record, or None if the filename doesn't follow the premade model file scheme.
+    """
+
+    match = model_filename_pattern.search(file_path)
+
+    if match is None:
+        return None
+
+    preface, date_string, run, stash, site_code = match.groups()
+
+    if preface not in model_prefaces or site_code not in site_codes:
+        return None
+
+    date = dt.date(int(date_string[:4]), int(date_string[4:6]), int(date_string[6:]))
+
+    return ModelFile(model_prefaces[preface],
+                     date,
+                     date_string[:4],
+                     str(date.timetuple().tm_yday).zfill(3),
+                     run,
+                     stash,
+                     site_codes[site_code])
+
+
+def parse_model_filenames(file_paths):
+    """
+    Parses many premade model file paths at once, with vectorised string and date operations.
+    :param file_paths: list of paths of premade model files.
+    :return: DataFrame with one row per path (same order) and columns path + the fields of ModelFile.
+        Paths which don't follow the premade model file scheme have NaN fields.
+    """
+
+    paths = pd.Series(list(file_paths), dtype=object)
+
+    parts = paths.str.extract(model_filename_regex)
+    parts.columns = ['preface', 'date', 'run', 'stash', 'site_code']
+
+    dates = pd.to_datetime(parts['date'], format='%Y%m%d')
+
+    df = pd.DataFrame({'path': paths,
+                       'model': parts['preface'].map(model_prefaces),
+                       'date': dates.dt.date,
+                       'year': parts['date'].str[:4],
+                       'doy': dates.dt.strftime('%j'),
+                       'run': parts['run'],
+                       'stash': parts['stash'],
+                       'site': parts['site_code'].map(site_codes)})
+
+    return df
@@ -0,0 +1,143 @@
+import os
+import json
+import numpy as np
+
+# series saved for each extraction, and their types
+memmap_series = {'time': 'datetime64[s]',
+                 'centre': np.float32,
+                 'mean_3x3': np.float32,
+                 'below': np.float32,
+                 'above': np.float32}
+
+
+def series_name(sitechoice,
+                variable,
+                grid_choice,
+                model_name,
+                DOYstart,
+                DOYstop):
+    """
+    Name of the memory-mapped files of one extraction (one site, variable and grid, for a date range).
+    """
+
+    return '_'.join([sitechoice, variable, str(grid_choice), model_name, str(DOYstart), str(DOYstop)])
+
+
+def series_path(memmap_dir,
+                name,
+                series):
+    """
+    :return: path of the .npy file of one series of an extraction
+    """
+
+    return os.path.join(memmap_dir, name + '_' + series + '.npy')
+
+
+def sidecar_path(memmap_dir,
+                 name):
+    """
+    :return: path of the json file holding the length, day index and heights of an extraction
+    """
+
+    return os.path.join(memmap_dir, name + '.json')
+
+
+def write_model_series(memmap_dir,
+                       name,
+                       day_keys,
+                       file_paths,
+                       file_results,
+                       max_times):
+    """
+    Writes the results of extract_model_file for many files (days) to memory-mapped .npy files as they are produced,
+    so that the whole series is never held in memory. Same layout as read_premade_model_files.model_series.
+    :param memmap_dir: directory of the memory-mapped files (made if it doesn't exist)
+    :param name: from series_name
+    :param day_keys: list of keys of each file (e.g. 'ukv2016126'), in the same order as file_paths
+    :param file_paths: list of file paths
+    :param file_results: iterable of outputs of extract_model_file for each file (None for dodgy files). Can be a
+        generator, or the results of a pool as they arrive.
+    :param max_times: most times there can be (number of files x hours per file). Files are made this long, and only
+        the part which is written is used.
+    :return: columnar result with memory-mapped arrays (see open_model_series)
+    """
+
+    if not os.path.isdir(memmap_dir):
+        os.makedirs(memmap_dir, exist_ok=True)
+
+    # np.memmap can't map an empty file
+    maps = {series: np.lib.format.open_memmap(series_path(memmap_dir, name, series), mode='w+',
+                                              dtype=memmap_series[series], shape=(max(max_times, 1),))
+            for series in memmap_series}
+
+    included_keys = []
+    day_offsets = [0]
+    dodgy_files = []
+    heights = {'height_value': [], 'height_value_0': [], 'height_value_2': []}
+
+    for day_key, file_path, file_result in zip(day_keys, file_paths, file_results):
+
+        # file couldn't be read
+        if file_result is None:
+            dodgy_files.append(file_path)
+            continue
+
+        start = day_offsets[-1]
+        number_of_times = len(file_result['model_time_64'])
+
+        maps['time'][start:start + number_of_times] = file_result['model_time_64']
+        for series in memmap_series:
+            if series == 'time':
+                continue
+            values = np.ma.asarray(file_result[series][:number_of_times], dtype=np.float32)
+            maps[series][start:start + number_of_times] = np.ma.filled(values, np.nan)
+
+        included_keys.append(day_key)
+        day_offsets.append(start + number_of_times)
+
+        for height in heights:
+            heights[height] = float(file_result[height])
+
+    for series in maps:
+        maps[series].flush()
+    del maps
+
+    sidecar = {'length': day_offsets[-1],
+               'day_keys': included_keys,
+               'day_offsets': day_offsets,
+               'dodgy_files': dodgy_files}
+    sidecar.update(heights)
+
+    # the sidecar is written last, so a series is only opened once it is complete
+    with open(sidecar_path(memmap_dir, name), 'w') as sidecar_file:
+        json.dump(sidecar, sidecar_file)
+
+    return open_model_series(memmap_dir, name)
+
+
+def open_model_series(memmap_dir,
+                      name):
+    """
+    Opens memory-mapped series written by write_model_series, read only. Nothing is read into memory until used, and
+    other processes opening the same series share the same pages.
+    :param memmap_dir: directory of the memory-mapped files
+    :param name: from series_name
+    :return: columnar result, as read_premade_model_files.model_series, with views of the memory-mapped files
+    """
+
+    with open(sidecar_path(memmap_dir, name)) as sidecar_file:
+        sidecar = json.load(sidecar_file)
+
+    length = sidecar['length']
+
+    result = {series: np.load(series_path(memmap_dir, name, series), mmap_mode='r')[:length]
+              for series in memmap_series}
+
+    result['day_keys'] = sidecar['day_keys']
+    result['day_offsets'] = np.asarray(sidecar['day_offsets'])
+    result['dodgy_files'] = sidecar['dodgy_files']
+    result['height_value'] = sidecar['height_value']
+    result['height_value_0'] = sidecar['height_value_0']
+    result['height_value_2'] = sidecar['height_value_2']
+
+    return result
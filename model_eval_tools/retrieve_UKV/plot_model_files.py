@@ -0,0 +1,194 @@
+import json
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.dates import DateFormatter
+import pylab
+from matplotlib import pyplot
+
+from model_eval_tools import look_up
+
+
+def plot_model_data(time_list,
+                    var_list,
+                    variable,
+                    model_name,
+                    height_value,
+                    sitechoice,
+                    DOYstart,
+                    DOYstop,
+                    savestring):
+    """
+    Plots a time series of extracted model data, one line per day, and saves the figure.
+    :param time_list: list of times for each day
+    :param var_list: list of values for each day
+    See read_premade_model_files.extract_model_data for the following:
+    :param variable:
+    :param model_name:
+    :param height_value:
+    :param sitechoice:
+    :param DOYstart:
+    :param DOYstop:
+    :param savestring:
+    :return:
+    """
+
+    label_string = look_up.variable_info[variable][0]
+
+    # plotting the differences between 3x3 averaged and centre grid
+    plt.figure(figsize=(20, 10))
+    ax = pyplot.subplot(1, 1, 1)
+
+    mod_colour = look_up.model_options[model_name][1]
+
+    # for temp, time in zip(key_names_vars_9, key_name_times):
+    #     plotCollection(ax, time_dict[time][:hoursbeforerepeat], var_dict_9[temp][:hoursbeforerepeat], 'g',
+    #                    label="3x3 averaged %s @ %d m" % (model, height_value))
+
+    for day_times, day_vals in zip(time_list, var_list):
+        # plotCollection calling the function that sorts out repeated
+        # labels in the legend, defined in the observations section
+        plotCollection(ax, day_times[:], day_vals[:], mod_colour,
+                       label="%s @ %d m" % (model_name, height_value))
+
+    plt.xlabel('DOY')
+    plt.ylabel(label_string)
+    plt.gcf().autofmt_xdate()
+    ax.xaxis.set_major_formatter(DateFormatter('%j'))
+
+    date_for_title = 'DOY ' + str(DOYstart) + ' - ' + str(DOYstop)
+    plt.title(sitechoice + ': ' + date_for_title)
+
+    pylab.savefig(savestring + str(variable) + '_' + str(model_name) + '_' + sitechoice + '_' +
+                  str(DOYstart) + '_' + str(DOYstop) + '.png', bbox_inches='tight')
+
+    plt.close('all')
+
+
+def plot_model_wind(time_list,
+                    wind_list,
+                    dir_list,
+                    variable,
+                    model_name,
+                    height_value,
+                    sitechoice,
+                    DOYstart,
+                    DOYstop,
+                    savestring):
+    """
+    Plots time series of extracted model wind speed and direction, one line per day, and saves the figure.
+    :param time_list: list of times for each day
+    :param wind_list: list of wind speeds for each day
+    :param dir_list: list of wind directions for each day
+    See read_premade_model_files.extract_model_data_wind for the following:
+    :param variable:
+    :param model_name:
+    :param height_value:
+    :param sitechoice:
+    :param DOYstart:
+    :param DOYstop:
+    :param savestring:
+    :return: True if the plot was made, False if not.
+    """
+
+    label_string = look_up.variable_info[variable][0]
+
+    # plotting the differences between 3x3 averaged and centre grid
+    plt.figure(figsize=(20, 15))
+
+    ax1 = pyplot.subplot(2, 1, 1)
+    ax2 = pyplot.subplot(2, 1, 2)
+
+    mod_colour = look_up.model_options[model_name][1]
+
+    # for wind, time, direction in zip(key_name_winds_9, key_name_times, key_name_dirs_9):
+    #     if len(wind_dict_9[wind]) > 0:
+    #         plotCollection(ax1, time_dict[time][:], wind_dict_9[wind][0][:],
+    #                        'g')
+    #
+    #         plotCollection(ax2, time_dict[time][:],
+    #                        dir_dict_9[direction][0][:],
+    #                        'g', label="3x3 averaged %s @ %d m" % (model, height_value))
+
+    for day_times, day_winds, day_dirs in zip(time_list, wind_list, dir_list):
+        if len(day_winds) > 0:
+            plotCollection(ax1, day_times[:], day_winds[:],
+                           mod_colour)
+            plotCollection(ax2, day_times[:], day_dirs[:],
+                           mod_colour, label="%s @ %d m" % (model_name, height_value))
+
+    # Try here because if one stash code is missing, plot can't be made (I think)
+    # throws an error because 0 is not a date
+    try:
+        ax2.set_xlabel('DOY')
+        ax1.set_ylabel(label_string[0])
+        ax2.set_ylabel(label_string[1])
+        ax2.xaxis.set_major_formatter(DateFormatter('%j'))
+
+        date_for_title = 'DOY ' + str(DOYstart) + ' - ' + str(DOYstop)
+        plt.title(sitechoice + ': ' + date_for_title)
+
+        plt.gcf().autofmt_xdate()
+
+        pylab.savefig(savestring + str(variable) + '_' + str(model_name) + '_' + sitechoice + '_' +
+                      str(DOYstart) + '_' + str(DOYstop) + '.png', bbox_inches='tight')
+
+        plt.close('all')
+
+    except:
+        print('WIND PLOTS NOT MADE!!!')
+        plt.close('all')
+        return False
+
+    return True
+
+
+def render_deferred(npz_path):
+    """
+    Renders a plot saved for later with plot='defer' (see read_premade_model_files.save_deferred_plot).
+    This can be done in a different process from the extraction, any time after it.
+    :param npz_path: path to the saved plot data
+    :return: output of the plotting function
+    """
+
+    with np.load(npz_path) as plot_data:
+        plot_kind = str(plot_data['plot_kind'])
+        plot_args = json.loads(str(plot_data['plot_args']))
+
+        day_offsets = plot_data['day_offsets']
+        day_slices = [slice(day_offsets[i], day_offsets[i + 1]) for i in range(len(day_offsets) - 1)]
+
+        time_list = [plot_data['time'][day].astype(object) for day in day_slices]
+        value_lists = []
+        for i in range(int(plot_data['n_series'])):
+            values = plot_data['values_' + str(i)]
+            value_lists.append([values[day] for day in day_slices])
+
+    if plot_kind == 'wind':
+        return plot_model_wind(time_list, value_lists[0], value_lists[1], **plot_args)
+    else:
+        return plot_model_data(time_list, value_lists[0], **plot_args)
+
+
+def plotCollection(ax, xs, ys, *args, **kwargs):
+    """
+    function to group labels in the plots -- otherwise, the same label will appear multiple times
+    as it gives one to each file/day being looped over
+    :param ax:
+    :param xs:
+    :param ys:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+
+    ax.plot(xs, ys, *args, **kwargs)
+    if "label" in kwargs.keys():
+        # remove duplicates
+        handles, labels = plt.gca().get_legend_handles_labels()
+        newLabels, newHandles = [], []
+        for handle, label in zip(handles, labels):
+            if label not in newLabels:
+                newLabels.append(label)
+                newHandles.append(handle)
+        # pyplot.legend(newHandles, newLabels, loc='upper left', bbox_to_anchor=(1, 0.5), fontsize=12)
+        plt.legend(newHandles, newLabels, bbox_to_anchor=(1, 0.5), fontsize=15, loc='center left')
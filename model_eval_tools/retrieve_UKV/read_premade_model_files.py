@@ -1,12 +1,18 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
-from matplotlib.dates import DateFormatter
+import os
+import json
 import netCDF4 as nc
-import pylab
-from matplotlib import pyplot
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from model_eval_tools import look_up
+from model_eval_tools.retrieve_UKV import model_file_names
+from model_eval_tools.retrieve_UKV import extraction_cache
+from model_eval_tools.retrieve_UKV import model_series_memmap
+
+# letters of the grids in the 3x3 of each premade model file (see grid_choice_indexes)
+grid_letters = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I']
 
 
 def extract_model_data(files,
@@ -18,7 +24,13 @@ def extract_model_data(files,
                        sitechoice,
                        savestring,
                        grid_choice=0,
-                       hoursbeforerepeat=24):
+                       hoursbeforerepeat=24,
+                       n_workers=1,
+                       columnar=False,
+                       plot=True,
+                       cache_dir=False,
+                       memmap_dir=False,
+                       file_results=None):
     """
     Read premade model files, and extract wanted data from them.
 
@@ -37,6 +49,19 @@ def extract_model_data(files,
     :param hoursbeforerepeat: this is used to get rid of the repeated items in the model plots - as, in each time,
         datetimes are repeated (as the model files aren't 24 hours, they're 37 hours, and are run again every 24 hours,
         leaving 13 hours of repeat each time). Entered as a number. Typically 24
+    :param n_workers: number of processes used to read the files. If 1, files are read one after the other.
+    :param columnar: if True, a columnar result of contiguous arrays is returned (see model_series) instead of the
+        tuple of dictionaries described below.
+    :param plot: True - plot is made and saved as a png in savestring. False - no plot is made (matplotlib isn't
+        touched). 'defer' - the data needed for the plot is saved as a npz in savestring, to be made later with
+        plot_model_files.render_deferred.
+    :param cache_dir: directory of the cache of extracted values from each file (see extraction_cache). If False,
+        nothing is cached, and every file is read.
+    :param memmap_dir: if given, values are written to memory-mapped files in this directory as each file is read
+        (one set per site, variable and grid - see model_series_memmap), and a columnar result of views of these files
+        is returned. Long extractions then don't need to fit in memory, and can be opened by other processes.
+    :param file_results: if given, outputs of extract_model_file for this grid for each file (in the order of
+        sorted(files.values())), already read - e.g. with extract_model_file_all_grids. Files aren't read again.
 
     :return time_dict: Dictionary of lists of time values for each file.
     :return var_dict: Dictionary of lists of variable chosen values for each file.
@@ -65,6 +90,10 @@ def extract_model_data(files,
     # if there are no model files
     if len(files) == 0:
         print('No files for model:', model_name)
+
+        if columnar or memmap_dir:
+            return model_series([], [], [])
+
         time_dict = []
         var_dict = []
         var_dict_9 = []
@@ -95,8 +124,66 @@ def extract_model_data(files,
                 height_value_2,
                 all_times)
 
-    # choices dependent on variable choice
-    label_string = look_up.variable_info[variable][0]
+    # make sure the variable can be read from the files, before reading any
+    model_variable_registry(variable)
+
+    # reads each model file: one file per day, done in date order. Results are produced lazily, one file at a time.
+    # if more than one worker is asked for, files are read in parallel by a pool of processes
+    file_paths = sorted(files.values())
+
+    if file_results is not None:
+        pool = None
+    elif n_workers > 1:
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+        file_results = pool.map(extract_model_file,
+                                file_paths,
+                                repeat(variable),
+                                repeat(model_name),
+                                repeat(target_height),
+                                repeat(sitechoice),
+                                repeat(grid_choice),
+                                repeat(hoursbeforerepeat),
+                                repeat(cache_dir))
+    else:
+        pool = None
+        file_results = (extract_model_file(file_path, variable, model_name, target_height, sitechoice, grid_choice,
+                                           hoursbeforerepeat, cache_dir) for file_path in file_paths)
+
+    try:
+        if memmap_dir:
+            # written to the memory-mapped files as they are produced
+            result = model_series_memmap.write_model_series(memmap_dir,
+                                                            model_series_memmap.series_name(sitechoice, variable,
+                                                                                            grid_choice, model_name,
+                                                                                            DOYstart, DOYstop),
+                                                            sorted(files.keys()),
+                                                            file_paths,
+                                                            file_results,
+                                                            len(file_paths) * hoursbeforerepeat)
+        else:
+            file_results = list(file_results)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if columnar or memmap_dir:
+        if not memmap_dir:
+            result = model_series(sorted(files.keys()), file_paths, file_results)
+
+        # print out any dodgy model files with huge time array lengths...
+        print('number of dodgy model files:', len(result['dodgy_files']))
+        if len(result['dodgy_files']) != 0:
+            print(result['dodgy_files'])
+
+        print(' ')
+        print('Finding any duplicate times:')
+        duplicate_time_report(series_by_day(result, 'time'), [files[key] for key in result['day_keys']])
+
+        output_plot(plot, 'data', series_by_day(result, 'time'), [series_by_day(result, 'centre')],
+                    {'variable': variable, 'model_name': model_name, 'height_value': result['height_value'],
+                     'sitechoice': sitechoice, 'DOYstart': DOYstart, 'DOYstop': DOYstop, 'savestring': savestring})
+
+        return result
 
     ####################################################################################################################
     #                                                     SORT MODELS
@@ -136,246 +223,43 @@ def extract_model_data(files,
         var_dict_2[varname] = []
         var_dict_2[varname].append('placeholder')
 
-    # loops over the model file paths in the model filepath dictionary (to import the data each time), and the empty
+    # loops over the results for each file in the model filepath dictionary, and the empty
     # lists ready in var_dict, var_dict_9 (for 3x3 average) and time_dict
     # these will be dictionaries including lists full of values and time respectively,
     # one list for each day/ file in the observation files
-    for item, var, time, var_9, var_0, var_2 in zip(sorted(files.values()),
-                                                    sorted(var_dict),
-                                                    sorted(time_dict),
-                                                    sorted(var_dict_9),
-                                                    sorted(var_dict_0),
-                                                    sorted(var_dict_2)):
-        # assigns model .nc file
-        file_path = item
-
-        # CHANGED 06/08/18 AS ONE OF THE FILES WAS CORRUPTED, AND COULDN'T BE READ BY NETCDF
-        try:
-            nc_file = nc.Dataset(file_path)
-
-        except IOError:
-            print('PROBLEM READING FILE:')
-            print(file_path)
-            print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
-            dodgy_files.append(file_path)
-            continue
-
-        # reads in model height
-        # Read in the model data heights. As data is 3x3 grid, take the central
-        # cell which overlays the observation location.
-
-        # finding the altitude from the model
-        site_format = look_up.premade_model_site_codes[sitechoice]
-        # finds altitude from function
-        altitude = find_altitude(site_format, model_name)
-
-        if variable == 'BL_H':
-
-            # ToDo: whats going on here? Why am I missing some lines which other level stash codes have?
-            # why am I not including altitude here?
-            model_heights = nc_file.variables['level_height'][:] + altitude
-
-        else:
-            # model level variables
-            if variable == 'Tair' or variable == 'RH' or variable == 'Press':
-
-                try:
-                    model_heights = nc_file.variables['level_height'][:] + altitude
-                except KeyError as error:
-                    dodgy_files.append(file_path)
-                    print(' ')
-                    print('ERROR HERE: ', file_path)
-                    print("Could not read in ", error, " as this is not a variable in the file")
-                    print(' ')
-                    continue
-
-            # surface level variables
-            elif variable == 'kdown' or variable == 'kup' or variable == 'ldown' or variable == 'lup' or variable == 'H' or variable == 'LE' or variable == 'lstar':
-                model_heights = np.zeros(70)[:] + altitude
-
-            else:
-                raise ValueError('Variable: ', variable, ' not an option.')
-
-        # finds the closest value of model height to observation, and saves the index
-        # if there is no observation files, disheight will be returned as an empty list. So this list is replaced by
-        # 10 m, in order to still plot model files if they exist.
-        if target_height == []:
-            target_height = 10
-
-        # ToDo: check these methods - old (using z0) and new (using target_height)
-        # where model_options[model][2] is z0_index
-        # z0_index = look_up.model_options[model][2]
-        # height_index = np.abs(model_heights - (disheight + z0zd[z0_index])).argmin()
-
-        height_index = np.abs(model_heights - target_height).argmin()
-
-        # if 1D, won't have to unravel: heightindex = np.unravel_index(heightindex, np.shape(modheight))
-        height_value = model_heights[height_index]
-
-        # taking the next closest heights
-        height_index_0 = height_index - 1
-        height_index_2 = height_index + 1
-        height_value_0 = model_heights[height_index_0]
-        height_value_2 = model_heights[height_index_2]
-
-        # Handle model time
-        try:
-            time_dict_returns = handle_model_time(nc_file, file_path, sitechoice, hoursbeforerepeat)
-        except ValueError:
+    for file_path, file_result, var, time, var_9, var_0, var_2 in zip(file_paths,
+                                                                       file_results,
+                                                                       sorted(var_dict),
+                                                                       sorted(time_dict),
+                                                                       sorted(var_dict_9),
+                                                                       sorted(var_dict_0),
+                                                                       sorted(var_dict_2)):
+
+        # file couldn't be read
+        if file_result is None:
             dodgy_files.append(file_path)
             continue
 
-        index_to_start = time_dict_returns['index_to_start']
-        model_time = time_dict_returns['model_time']
-
-        # Makes a choice about which grid to use
-        grid_choice_dict = grid_choice_indexes(grid_choice)
-        index_lat = grid_choice_dict['index_lat']
-        index_lon = grid_choice_dict['index_lon']
-
-        # READS IN VALUES
-        if variable == 'Tair':
-            # reads in temperatures
-            model_vars = nc_file.variables['air_temperature']
-            # finds temperature values at the closest model height to obs
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index] - 273.15
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_0] - 273.15
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_2] - 273.15
-
-        elif variable == 'RH':
-            # reads in relative humidity
-            model_vars = nc_file.variables['relative_humidity']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index]
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_0]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_2]
-
-        elif variable == 'Press':
-            # reads in Press
-            model_vars = nc_file.variables['air_pressure']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index] / 100.
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_0] / 100.
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_2] / 100.
-
-        elif variable == 'kdown':
-            # reads in incoming shortwave radiation
-            model_vars = nc_file.variables['surface_downwelling_shortwave_flux_in_air']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-            # taking the next closest heights
-            # ToDo: this step is unnecessary for all surface stash codes
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-        elif variable == 'ldown':
-            # reads in outgoing shortwave radiation
-            model_vars = nc_file.variables['surface_downwelling_longwave_flux_in_air']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-        elif variable == 'lstar':
-            model_vars = nc_file.variables['surface_net_longwave_flux_in_air']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-        elif variable == 'H':
-            try:
-                model_vars = nc_file.variables['surface_upward_sensible_heat_flux']
-            except:
-                model_vars = nc_file.variables['surface_sensible_heat_flux']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-        elif variable == 'BL_H':
-            model_vars = nc_file.variables['boundary_layer_heat_fluxes']
-            # finds temperature values at the closest model height to obs
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index]
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_0]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                         height_index_2]
-
-        elif variable == 'LE':
-            try:
-                model_vars = nc_file.variables['surface_upward_latent_heat_flux']
-            except:
-                model_vars = nc_file.variables['surface_latent_heat_flux']
-            var_vals = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-            # taking the next closest heights
-            var_vals_0 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-            var_vals_2 = model_vars[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat]
-
-        else:
-            raise ValueError('variable choice not an option')
+        height_value = file_result['height_value']
+        height_value_0 = file_result['height_value_0']
+        height_value_2 = file_result['height_value_2']
 
         # append times to a list to plot outside of the for loop
-        for timevalue in model_time:
+        for timevalue in file_result['model_time']:
             time_dict[time].append(timevalue)
         # append temps to a list to plot outside of the for loop
-        for value in var_vals:
+        for value in file_result['centre']:
             var_dict[var].append(value)
 
         # 3x3 grid average
-        shape_number = 2
-
-        for i in range(index_to_start, np.shape(model_vars)[shape_number]):
-            if variable == 'Tair':
-                var_vals_mean = np.mean(model_vars[:, :, i, height_index] - 273.15)
-
-            elif variable == 'RH':
-                var_vals_mean = np.mean(model_vars[:, :, i, height_index])
-
-            elif variable == 'BL_H':
-                var_vals_mean = np.mean(model_vars[:, :, i, height_index])
-
-            elif variable == 'Press':
-                var_vals_mean = np.mean(model_vars[:, :, i, height_index]) / 100.
-
-            elif variable == 'kdown' or variable == 'kup' or variable == 'ldown' or variable == 'lup' or variable == 'lstar':
-                var_vals_mean = np.mean(model_vars[:, :, i])
-
-            elif variable == 'H' or variable == 'LE':
-                var_vals_mean = np.mean(model_vars[:, :, i])
-
-            else:
-                raise ValueError('variable choice not an option.')
-
-            # append temps9 to a list to plot outside of the for loop
+        # append temps9 to a list to plot outside of the for loop
+        for var_vals_mean in file_result['mean_3x3']:
             var_dict_9[var_9].append(var_vals_mean)
 
-        # fromliam: [np.mean(model_vars[0,i,height_index,:,:] -273.15) for i in range(37)]
-
         # taking the next closest heights
-        for item0 in var_vals_0:
+        for item0 in file_result['below']:
             var_dict_0[var_0].append(item0)
-        for item2 in var_vals_2:
+        for item2 in file_result['above']:
             var_dict_2[var_2].append(item2)
 
     # ToDo: a check on height value - to make sure it's consistent through the loop and that it is properly defined.
@@ -433,12 +317,8 @@ def extract_model_data(files,
             all_times.append(time)
     print(' ')
     print('Finding any dupulate times:')
-    if len(set([x for x in all_times if all_times.count(x) > 1])) == 0:
-        print('No duplicates')
-    else:
-        print(len(set([x for x in all_times if all_times.count(x) > 1])), 'Duplicates')
-        repeats = list(set([x for x in all_times if all_times.count(x) > 1]))
-        print(repeats)
+    duplicate_time_report([time_dict[item][:hoursbeforerepeat] for item in key_name_times],
+                          [files[item[len('time_'):]] for item in key_name_times])
 
     # dodgy files dealing with skipping times still for some reason appending the string name to string list. So here,
     # I am being lazy and manually removing any lists with time length 0 before plotting
@@ -459,35 +339,10 @@ def extract_model_data(files,
             del var_dict[temp]
             del var_dict_9[var_all]
 
-    # ToDo: option for not plotting here
-    # plotting the differences between 3x3 averaged and centre grid
-    plt.figure(figsize=(20, 10))
-    ax = pyplot.subplot(1, 1, 1)
-
-    mod_colour = look_up.model_options[model_name][1]
-
-    # for temp, time in zip(key_names_vars_9, key_name_times):
-    #     plotCollection(ax, time_dict[time][:hoursbeforerepeat], var_dict_9[temp][:hoursbeforerepeat], 'g',
-    #                    label="3x3 averaged %s @ %d m" % (model, height_value))
-
-    for temp, time in zip(key_names_vars, key_name_times):
-        # plotCollection calling the function that sorts out repeated
-        # labels in the legend, defined in the observations section
-        plotCollection(ax, time_dict[time][:], var_dict[temp][:], mod_colour,
-                       label="%s @ %d m" % (model_name, height_value))
-
-    plt.xlabel('DOY')
-    plt.ylabel(label_string)
-    plt.gcf().autofmt_xdate()
-    ax.xaxis.set_major_formatter(DateFormatter('%j'))
-
-    date_for_title = 'DOY ' + str(DOYstart) + ' - ' + str(DOYstop)
-    plt.title(sitechoice + ': ' + date_for_title)
-
-    pylab.savefig(savestring + str(variable) + '_' + str(model_name) + '_' + sitechoice + '_' +
-                  str(DOYstart) + '_' + str(DOYstop) + '.png', bbox_inches='tight')
-
-    plt.close('all')
+    output_plot(plot, 'data', [time_dict[time] for time in key_name_times],
+                [[var_dict[temp] for temp in key_names_vars]],
+                {'variable': variable, 'model_name': model_name, 'height_value': height_value,
+                 'sitechoice': sitechoice, 'DOYstart': DOYstart, 'DOYstop': DOYstop, 'savestring': savestring})
 
     # ToDo: check if all these returns are needed
     # ToDo: return as a dict
@@ -507,6 +362,748 @@ def extract_model_data(files,
             all_times)
 
 
+def extract_model_data_all_grids(files,
+                                 DOYstart,
+                                 DOYstop,
+                                 variable,
+                                 model_name,
+                                 target_height,
+                                 sitechoice,
+                                 savestring,
+                                 hoursbeforerepeat=24,
+                                 n_workers=1,
+                                 columnar=True,
+                                 cache_dir=False):
+    """
+    Extracts model data for all 9 grids of a site's premade model files, reading each file only once.
+    See extract_model_data for the parameters.
+    :return: dictionary of {grid number (see look_up.grid_dict): output of extract_model_data for that grid}.
+        Grids of the site which aren't in look_up.grid_dict are left out.
+    """
+
+    # make sure the variable can be read from the files, before reading any
+    model_variable_registry(variable)
+
+    file_paths = sorted(files.values())
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            all_grid_results = list(pool.map(extract_model_file_all_grids,
+                                             file_paths,
+                                             repeat(variable),
+                                             repeat(model_name),
+                                             repeat(target_height),
+                                             repeat(sitechoice),
+                                             repeat(hoursbeforerepeat),
+                                             repeat(cache_dir)))
+    else:
+        all_grid_results = [extract_model_file_all_grids(file_path, variable, model_name, target_height, sitechoice,
+                                                         hoursbeforerepeat, cache_dir) for file_path in file_paths]
+
+    grid_numbers = site_grid_numbers(sitechoice)
+
+    grid_outputs = {}
+    for grid_letter in sorted(grid_numbers):
+        file_results = [grid_results[grid_letter] if grid_results is not None else None
+                        for grid_results in all_grid_results]
+
+        grid_outputs[grid_numbers[grid_letter]] = extract_model_data(files,
+                                                                     DOYstart,
+                                                                     DOYstop,
+                                                                     variable,
+                                                                     model_name,
+                                                                     target_height,
+                                                                     sitechoice,
+                                                                     savestring,
+                                                                     grid_choice=grid_letter,
+                                                                     hoursbeforerepeat=hoursbeforerepeat,
+                                                                     columnar=columnar,
+                                                                     plot=False,
+                                                                     file_results=file_results)
+
+    return grid_outputs
+
+
+def model_series(day_keys,
+                 file_paths,
+                 file_results):
+    """
+    Packs the results of extract_model_file for many files (days) into one columnar result: each series is one
+    contiguous array for all days, with an offset index to find each day.
+    :param day_keys: list of keys of each file (e.g. 'ukv2016126'), in the same order as file_paths
+    :param file_paths: list of file paths
+    :param file_results: list of outputs of extract_model_file for each file (None for dodgy files)
+    :return: dict of:
+        'time' - datetime64[s] array of all times,
+        'centre', 'mean_3x3', 'below', 'above' - float32 arrays of values at each time (see block_values), with
+            NaN for missing values. The 3x3 average is only kept for the times in 'time'.
+        'day_keys' - list of keys of the days included,
+        'day_offsets' - int array: values for day_keys[i] are [day_offsets[i]:day_offsets[i + 1]],
+        'height_value', 'height_value_0', 'height_value_2' - model level heights,
+        'dodgy_files' - list of files which couldn't be read.
+    """
+
+    series_names = ['centre', 'mean_3x3', 'below', 'above']
+
+    included_keys = []
+    day_offsets = [0]
+    dodgy_files = []
+    times = []
+    series = {name: [] for name in series_names}
+    heights = {'height_value': [], 'height_value_0': [], 'height_value_2': []}
+
+    for day_key, file_path, file_result in zip(day_keys, file_paths, file_results):
+
+        # file couldn't be read
+        if file_result is None:
+            dodgy_files.append(file_path)
+            continue
+
+        number_of_times = len(file_result['model_time'])
+
+        included_keys.append(day_key)
+        day_offsets.append(day_offsets[-1] + number_of_times)
+
+        times.append(file_result['model_time_64'])
+        for name in series_names:
+            values = np.ma.asarray(file_result[name][:number_of_times], dtype=np.float32)
+            series[name].append(np.ma.filled(values, np.nan))
+
+        for name in heights:
+            heights[name] = file_result[name]
+
+    result = {'time': np.concatenate(times) if len(times) != 0 else np.array([], dtype='datetime64[s]'),
+              'day_keys': included_keys,
+              'day_offsets': np.asarray(day_offsets),
+              'dodgy_files': dodgy_files}
+
+    for name in series_names:
+        if len(series[name]) != 0:
+            result[name] = np.concatenate(series[name])
+        else:
+            result[name] = np.array([], dtype=np.float32)
+
+    result.update(heights)
+
+    return result
+
+
+def series_by_day(result,
+                  series_name):
+    """
+    Splits one series of a columnar result (from model_series) into a list of arrays, one per day. The arrays are
+    views on the result, not copies.
+    :param result: columnar result, from model_series
+    :param series_name: e.g. 'time' or 'centre'
+    :return: list of arrays, in the order of result['day_keys']
+    """
+
+    day_offsets = result['day_offsets']
+
+    return [result[series_name][day_offsets[i]:day_offsets[i + 1]] for i in range(len(day_offsets) - 1)]
+
+
+def duplicate_time_report(time_lists,
+                          sources=None,
+                          verbose=True):
+    """
+    Finds times which appear more than once in an extracted series, by sorting all times once (rather than
+    counting each time against every other).
+    Can be used on any extracted series: e.g. the per-day time lists of extract_model_data, or
+    series_by_day(result, 'time') for a columnar result.
+    :param time_lists: list of sequences of times (datetimes or datetime64), one per file/ day
+    :param sources: list of labels for each sequence in time_lists (e.g. file paths). Default is the list index.
+    :param verbose: if True, prints what was found
+    :return: dict of:
+        'n_times' - total number of times,
+        'duplicate_times' - datetime64[s] array of the times found more than once (sorted),
+        'counts' - number of times each duplicate time is found,
+        'sources' - dict of {duplicate time (datetime): list of the sources it is found in},
+        'overlapping_sources' - list of sources with at least one duplicate time.
+    """
+
+    if sources is None:
+        sources = list(range(len(time_lists)))
+
+    time_arrays = [np.asarray(times, dtype='datetime64[s]') for times in time_lists]
+    lengths = [len(times) for times in time_arrays]
+
+    if sum(lengths) == 0:
+        all_times = np.array([], dtype='datetime64[s]')
+    else:
+        all_times = np.concatenate(time_arrays)
+
+    # which source each time came from
+    source_index = np.repeat(np.arange(len(time_arrays)), lengths)
+
+    unique_times, inverse, counts = np.unique(all_times, return_inverse=True, return_counts=True)
+    is_duplicate = counts > 1
+
+    duplicate_sources = {}
+    overlapping = set([])
+    for i in np.flatnonzero(is_duplicate[inverse]):
+        time = all_times[i].astype(object)
+        if time not in duplicate_sources:
+            duplicate_sources[time] = []
+        source = sources[source_index[i]]
+        if source not in duplicate_sources[time]:
+            duplicate_sources[time].append(source)
+        overlapping.add(source_index[i])
+
+    report = {'n_times': len(all_times),
+              'duplicate_times': unique_times[is_duplicate],
+              'counts': counts[is_duplicate],
+              'sources': duplicate_sources,
+              'overlapping_sources': [sources[i] for i in sorted(overlapping)]}
+
+    if verbose:
+        if len(report['duplicate_times']) == 0:
+            print('No duplicates')
+        else:
+            print(len(report['duplicate_times']), 'Duplicates')
+            print(report['duplicate_times'].astype(object).tolist())
+            print('Found in files:')
+            for source in report['overlapping_sources']:
+                print(source)
+
+    return report
+
+
+def output_plot(plot,
+                plot_kind,
+                time_list,
+                value_lists,
+                plot_args):
+    """
+    Makes, defers or skips the plot of extracted model data.
+    matplotlib is only imported if a plot is made here.
+    :param plot: True, False or 'defer' (see extract_model_data)
+    :param plot_kind: 'data' (plot_model_files.plot_model_data) or 'wind' (plot_model_files.plot_model_wind)
+    :param time_list: list of times for each day
+    :param value_lists: list of series to plot, each a list of values for each day.
+        One series for 'data', wind speed and direction for 'wind'.
+    :param plot_args: dict of the other arguments of the plotting function
+    :return: output of the plotting function. None if no plot was made here.
+    """
+
+    if plot == 'defer':
+        save_deferred_plot(plot_kind, time_list, value_lists, plot_args)
+        return None
+
+    elif plot:
+        from model_eval_tools.retrieve_UKV import plot_model_files
+
+        if plot_kind == 'wind':
+            return plot_model_files.plot_model_wind(time_list, value_lists[0], value_lists[1], **plot_args)
+        else:
+            return plot_model_files.plot_model_data(time_list, value_lists[0], **plot_args)
+
+    return None
+
+
+def save_deferred_plot(plot_kind,
+                       time_list,
+                       value_lists,
+                       plot_args):
+    """
+    Saves the data needed to make a plot later, to a npz next to where the png would be saved.
+    See output_plot for the parameters. Rendered with plot_model_files.render_deferred.
+    :return: path of the npz file
+    """
+
+    day_offsets = np.cumsum([0] + [len(times) for times in time_list])
+
+    if len(time_list) != 0:
+        times = np.concatenate([np.asarray(times, dtype='datetime64[s]') for times in time_list])
+    else:
+        times = np.array([], dtype='datetime64[s]')
+
+    series = {}
+    for i, value_list in enumerate(value_lists):
+        if len(value_list) != 0:
+            values = np.concatenate([np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+                                     for values in value_list])
+        else:
+            values = np.array([], dtype=np.float64)
+        series['values_' + str(i)] = values
+
+    # json can't hold numpy numbers
+    plot_args = dict(plot_args)
+    if np.size(plot_args['height_value']) == 1:
+        plot_args['height_value'] = float(plot_args['height_value'])
+    else:
+        plot_args['height_value'] = 0
+
+    npz_path = (plot_args['savestring'] + str(plot_args['variable']) + '_' + str(plot_args['model_name']) + '_' +
+                plot_args['sitechoice'] + '_' + str(plot_args['DOYstart']) + '_' + str(plot_args['DOYstop']) + '.npz')
+
+    np.savez(npz_path,
+             plot_kind=plot_kind,
+             plot_args=json.dumps(plot_args),
+             time=times,
+             day_offsets=day_offsets,
+             n_series=len(value_lists),
+             **series)
+
+    print('Plot deferred: ' + npz_path)
+
+    return npz_path
+
+
+def extract_model_file(file_path,
+                       variable,
+                       model_name,
+                       target_height,
+                       sitechoice,
+                       grid_choice=0,
+                       hoursbeforerepeat=24,
+                       cache_dir=False):
+    """
+    Reads one premade model file (one day), and extracts the wanted data from it.
+    This is the work done for each file in extract_model_data - it is a separate function so that files can be read
+    in parallel by a pool of processes.
+    See extract_model_data for the following:
+    :param file_path:
+    :param variable:
+    :param model_name:
+    :param target_height:
+    :param sitechoice:
+    :param grid_choice:
+    :param hoursbeforerepeat:
+    :param cache_dir:
+    :return: None if the file can't be read (dodgy file). Otherwise a dict of: 'model_time' - list of times,
+        'model_time_64' - the same times as a datetime64[s] array,
+        'centre', 'mean_3x3', 'below', 'above' - arrays of values (see block_values), 'height_value',
+        'height_value_0', 'height_value_2' - chosen model level height, and the heights below and above.
+    """
+
+    # served from the cache if this file has been extracted in the same way before
+    if cache_dir:
+        cache_key = extraction_cache.cache_key([file_path], [variable, model_name, target_height, sitechoice,
+                                                             grid_choice, hoursbeforerepeat])
+        file_result = extraction_cache.load_result(cache_dir, cache_key)
+
+        if file_result is None:
+            file_result = extract_model_file(file_path, variable, model_name, target_height, sitechoice,
+                                             grid_choice, hoursbeforerepeat)
+            if file_result is not None:
+                extraction_cache.save_result(cache_dir, cache_key, file_result)
+
+        return file_result
+
+    file_block = read_model_file(file_path, variable, model_name, target_height, sitechoice, hoursbeforerepeat)
+
+    if file_block is None:
+        return None
+
+    return grid_values(file_block, grid_choice, hoursbeforerepeat)
+
+
+def extract_model_file_all_grids(file_path,
+                                 variable,
+                                 model_name,
+                                 target_height,
+                                 sitechoice,
+                                 hoursbeforerepeat=24,
+                                 cache_dir=False):
+    """
+    Reads one premade model file (one day) once, and extracts the wanted data for all 9 grids of its 3x3.
+    See extract_model_file for the parameters.
+    :return: None if the file can't be read (dodgy file). Otherwise a dict of {grid letter: output of
+        extract_model_file for this grid}, for grid letters A - I.
+    """
+
+    # served from the cache if all grids of this file have been extracted in the same way before
+    # (one entry holds all 9 grids, so a file is one load or one save)
+    if cache_dir:
+        cache_key = extraction_cache.cache_key([file_path], [variable, model_name, target_height, sitechoice,
+                                                             'all_grids', hoursbeforerepeat])
+        cached_result = extraction_cache.load_result(cache_dir, cache_key)
+
+        if cached_result is not None:
+            return unpack_grid_results(cached_result)
+
+        grid_results = extract_model_file_all_grids(file_path, variable, model_name, target_height, sitechoice,
+                                                    hoursbeforerepeat)
+        if grid_results is not None:
+            extraction_cache.save_result(cache_dir, cache_key, pack_grid_results(grid_results))
+
+        return grid_results
+
+    file_block = read_model_file(file_path, variable, model_name, target_height, sitechoice, hoursbeforerepeat)
+
+    if file_block is None:
+        return None
+
+    return {grid_letter: grid_values(file_block, grid_letter, hoursbeforerepeat) for grid_letter in grid_letters}
+
+
+def pack_grid_results(grid_results):
+    """
+    Puts the results of all grids of a file (from extract_model_file_all_grids) into one dict, to be saved as one
+    cache entry. Times are the same for all grids, so are kept once.
+    :return: dict of 'model_time', and '<grid letter>.<name>' for every other item of each grid's result
+    """
+
+    packed = {'model_time': grid_results[grid_letters[0]]['model_time']}
+
+    for grid_letter in grid_letters:
+        for name, value in grid_results[grid_letter].items():
+            if name != 'model_time':
+                packed[grid_letter + '.' + name] = value
+
+    return packed
+
+
+def unpack_grid_results(packed):
+    """
+    Opposite of pack_grid_results.
+    :return: dict of {grid letter: result}
+    """
+
+    grid_results = {grid_letter: {'model_time': packed['model_time']} for grid_letter in grid_letters}
+
+    for packed_name, value in packed.items():
+        if packed_name != 'model_time':
+            grid_letter, name = packed_name.split('.', 1)
+            grid_results[grid_letter][name] = value
+
+    return grid_results
+
+
+def read_model_file(file_path,
+                    variable,
+                    model_name,
+                    target_height,
+                    sitechoice,
+                    hoursbeforerepeat=24):
+    """
+    Reads the 3x3 block of values needed from one premade model file (one day), with its times and model heights.
+    See extract_model_file for the parameters.
+    :return: None if the file can't be read (dodgy file). Otherwise a dict of: 'block' - array with shape
+        (3, 3, times, levels) after unit conversion (see read_model_block), 'model_time', 'model_time_64',
+        'height_value', 'height_value_0', 'height_value_2' (see extract_model_file)
+    """
+
+    # how this variable is read from the files
+    variable_registry = model_variable_registry(variable)
+
+    # CHANGED 06/08/18 AS ONE OF THE FILES WAS CORRUPTED, AND COULDN'T BE READ BY NETCDF
+    try:
+        nc_file = nc.Dataset(file_path)
+
+    except IOError:
+        print('PROBLEM READING FILE:')
+        print(file_path)
+        print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
+        return None
+
+    try:
+        # reads in model height
+        # Read in the model data heights. As data is 3x3 grid, take the central
+        # cell which overlays the observation location.
+
+        # finding the altitude from the model
+        site_format = look_up.premade_model_site_codes[sitechoice]
+        # finds altitude from function
+        altitude = find_altitude(site_format, model_name)
+
+        # model level variables
+        if variable_registry['dims'] == 'levels':
+
+            try:
+                model_heights = nc_file.variables['level_height'][:] + altitude
+            except KeyError as error:
+                print(' ')
+                print('ERROR HERE: ', file_path)
+                print("Could not read in ", error, " as this is not a variable in the file")
+                print(' ')
+                return None
+
+        # surface level variables
+        else:
+            model_heights = np.zeros(70)[:] + altitude
+
+        # finds the closest value of model height to observation, and saves the index
+        # if there is no observation files, disheight will be returned as an empty list. So this list is replaced by
+        # 10 m, in order to still plot model files if they exist.
+        if target_height == []:
+            target_height = 10
+
+        # ToDo: check these methods - old (using z0) and new (using target_height)
+        # where model_options[model][2] is z0_index
+        # z0_index = look_up.model_options[model][2]
+        # height_index = np.abs(model_heights - (disheight + z0zd[z0_index])).argmin()
+
+        height_index = np.abs(model_heights - target_height).argmin()
+
+        # if 1D, won't have to unravel: heightindex = np.unravel_index(heightindex, np.shape(modheight))
+        height_value = model_heights[height_index]
+
+        # taking the next closest heights
+        height_index_0 = height_index - 1
+        height_index_2 = height_index + 1
+        height_value_0 = model_heights[height_index_0]
+        height_value_2 = model_heights[height_index_2]
+
+        # Handle model time
+        try:
+            time_dict_returns = handle_model_time(nc_file, file_path, sitechoice, hoursbeforerepeat)
+        except ValueError:
+            return None
+
+        index_to_start = time_dict_returns['index_to_start']
+        model_time = time_dict_returns['model_time']
+        model_time_64 = time_dict_returns['model_time_64']
+
+        # READS IN VALUES
+        try:
+            model_vars = find_model_variable(nc_file, variable_registry['nc_names'])
+        except KeyError as error:
+            print(' ')
+            print('ERROR HERE: ', file_path)
+            print("Could not read in ", error, " as this is not a variable in the file")
+            print(' ')
+            return None
+
+        # reads the whole 3x3 block needed from this file in one go - all times after spin up, and the chosen model
+        # level with the levels either side of it (surface variables have no levels)
+        if variable_registry['dims'] == 'levels':
+            block = read_model_block(model_vars, index_to_start, height_index)
+        else:
+            block = read_model_block(model_vars, index_to_start)
+
+    finally:
+        nc_file.close()
+
+    # unit conversions
+    if variable_registry['offset'] != 0 or variable_registry['divisor'] != 1:
+        block = (block + variable_registry['offset']) / variable_registry['divisor']
+
+    return {'block': block,
+            'model_time': model_time,
+            'model_time_64': model_time_64,
+            'height_value': height_value,
+            'height_value_0': height_value_0,
+            'height_value_2': height_value_2}
+
+
+def grid_values(file_block,
+                grid_choice,
+                hoursbeforerepeat=24):
+    """
+    Takes the values for one grid from a block read with read_model_file, without reading the file again.
+    :param file_block: output of read_model_file
+    :param grid_choice: grid letter (see grid_choice_indexes)
+    :param hoursbeforerepeat: number of hours taken from each file
+    :return: output of extract_model_file for this grid
+    """
+
+    # Makes a choice about which grid to use
+    grid_choice_dict = grid_choice_indexes(grid_choice)
+
+    # all values wanted are taken from the block in memory
+    file_result = block_values(file_block['block'], grid_choice_dict['index_lat'], grid_choice_dict['index_lon'],
+                               hoursbeforerepeat)
+
+    file_result['model_time'] = file_block['model_time']
+    file_result['model_time_64'] = file_block['model_time_64']
+    file_result['height_value'] = file_block['height_value']
+    file_result['height_value_0'] = file_block['height_value_0']
+    file_result['height_value_2'] = file_block['height_value_2']
+
+    return file_result
+
+
+def extract_model_data_from_store(store_path,
+                                  DOYstart,
+                                  DOYstop,
+                                  variable,
+                                  model_name,
+                                  target_height,
+                                  sitechoice,
+                                  grid_choice=0,
+                                  hoursbeforerepeat=24):
+    """
+    Extracts model data from a consolidated store (see consolidate_model_files.build_model_store), rather than from
+    one premade model file per day. All days are read with one open of the store, by slicing along time.
+    See extract_model_data for the following:
+    :param store_path: path of the store
+    :param DOYstart:
+    :param DOYstop:
+    :param variable:
+    :param model_name:
+    :param target_height:
+    :param sitechoice:
+    :param grid_choice:
+    :param hoursbeforerepeat: number of hours taken from each day. Can't be more than the store was made with.
+    :return: columnar result, as extract_model_data with columnar=True (see model_series)
+    """
+
+    variable_registry = model_variable_registry(variable)
+
+    store = nc.Dataset(store_path)
+
+    try:
+        if store.getncattr('variable') != variable or store.getncattr('model_name') != model_name or \
+                store.getncattr('sitechoice') != sitechoice:
+            raise ValueError('Model store is not for this variable, model and site: ', store_path)
+
+        if hoursbeforerepeat > store.getncattr('hoursbeforerepeat'):
+            raise ValueError('Model store only has ' + str(store.getncattr('hoursbeforerepeat')) + ' hours per day')
+
+        if len(store.dimensions['day']) == 0:
+            return model_series([], [], [])
+
+        # the days in the chosen range
+        day_keys = np.asarray(store.variables['day_key'][:], dtype=object)
+        day_numbers = np.array([int(day_key[len(model_name):]) for day_key in day_keys])
+        chosen_days = np.flatnonzero((day_numbers >= int(DOYstart)) & (day_numbers <= int(DOYstop)))
+        chosen_days = chosen_days[np.argsort(day_keys[chosen_days])]
+
+        if len(chosen_days) == 0:
+            return model_series([], [], [])
+
+        day_start = store.variables['day_start'][:][chosen_days]
+        day_length = np.minimum(store.variables['day_length'][:][chosen_days], hoursbeforerepeat)
+
+        # model heights, as in extract_model_file
+        altitude = find_altitude(look_up.premade_model_site_codes[sitechoice], model_name)
+        if variable_registry['dims'] == 'levels':
+            model_heights = store.variables['level_height'][:] + altitude
+            number_of_levels = len(model_heights)
+        else:
+            model_heights = np.zeros(70)[:] + altitude
+            number_of_levels = 1
+
+        if target_height == []:
+            target_height = 10
+
+        height_index = np.abs(model_heights - target_height).argmin()
+
+        # chosen level with the levels either side of it (the level below the lowest level is the top level, as in
+        # read_model_block)
+        if variable_registry['dims'] == 'levels':
+            levels = [(height_index - 1) % number_of_levels, height_index, height_index + 1]
+        else:
+            levels = [0]
+
+        # one read of all the records needed, for each level
+        first_record = day_start.min()
+        last_record = (day_start + day_length).max()
+        store_values = store.variables['values']
+        block = np.ma.stack([store_values[:, :, first_record:last_record, level] for level in levels], axis=3)
+        store_times = store.variables['time'][first_record:last_record].astype('datetime64[s]')
+
+    finally:
+        store.close()
+
+    # unit conversions
+    if variable_registry['offset'] != 0 or variable_registry['divisor'] != 1:
+        block = (block + variable_registry['offset']) / variable_registry['divisor']
+
+    grid_choice_dict = grid_choice_indexes(grid_choice)
+
+    file_results = []
+    for start, length in zip(day_start - first_record, day_length):
+        file_result = block_values(block[:, :, start:start + length], grid_choice_dict['index_lat'],
+                                   grid_choice_dict['index_lon'], hoursbeforerepeat)
+        file_result['model_time_64'] = store_times[start:start + length]
+        file_result['model_time'] = file_result['model_time_64'].astype(object).tolist()
+        file_result['height_value'] = model_heights[height_index]
+        file_result['height_value_0'] = model_heights[height_index - 1]
+        file_result['height_value_2'] = model_heights[height_index + 1]
+        file_results.append(file_result)
+
+    return model_series(list(day_keys[chosen_days]), [store_path] * len(chosen_days), file_results)
+
+
+def model_variable_registry(variable):
+    """
+    Describes how a variable is read from premade model files, from the look_up tables.
+    New (single stash code) variables are added to look_up.variables, look_up.variable_info and
+    look_up.model_nc_variables, rather than here.
+    :param variable: choice of variable, e.g. 'Tair'
+    :return: dict of: 'stash' - stash code, 'nc_names' - list of netCDF variable names to try in order,
+        'dims' - 'levels' or 'surface', 'offset' and 'divisor' - unit conversion (value + offset) / divisor
+    """
+
+    if variable not in look_up.model_nc_variables:
+        raise ValueError('Variable: ', variable, ' not an option.')
+
+    nc_names, conversion = look_up.model_nc_variables[variable]
+
+    return {'stash': look_up.variables[variable],
+            'nc_names': nc_names,
+            'dims': look_up.variable_info[variable][1],
+            'offset': conversion[0],
+            'divisor': conversion[1]}
+
+
+def find_model_variable(nc_file,
+                        nc_names):
+    """
+    Finds a variable in a netCDF file, trying each of the possible names in turn.
+    :param nc_file: open netCDF dataset
+    :param nc_names: list of possible variable names
+    :return: netCDF variable
+    """
+
+    for nc_name in nc_names:
+        if nc_name in nc_file.variables:
+            return nc_file.variables[nc_name]
+
+    raise KeyError(' or '.join(nc_names))
+
+
+def read_model_block(model_vars,
+                     index_to_start,
+                     height_index=None):
+    """
+    Reads all of the values needed from a premade model file variable in one read: the full 3x3 grid, for all times
+    from index_to_start, at the chosen model level and the levels either side of it.
+    :param model_vars: netCDF variable, with dimensions (lat, lon, time) for surface variables, or
+        (lat, lon, time, level) for variables on model levels.
+    :param index_to_start: time index to start from (after spin up)
+    :param height_index: index of the chosen model level. None for surface variables.
+    :return: array with shape (3, 3, times, levels). levels is 3 (below, chosen, above) for model level variables,
+        and 1 for surface variables.
+    """
+
+    if height_index is None:
+        return model_vars[:, :, index_to_start:][:, :, :, np.newaxis]
+
+    if 1 <= height_index < np.shape(model_vars)[3] - 1:
+        return model_vars[:, :, index_to_start:, height_index - 1:height_index + 2]
+
+    # chosen level at the edge of the model levels: the level below of the lowest level is the top level
+    # (as it always has been when indexing with height_index - 1)
+    return np.ma.stack([model_vars[:, :, index_to_start:, level] for level in
+                        (height_index - 1, height_index, height_index + 1)], axis=3)
+
+
+def block_values(block,
+                 index_lat,
+                 index_lon,
+                 hoursbeforerepeat=24):
+    """
+    Takes the values wanted from a block read with read_model_block, without reading the file again.
+    :param block: array with shape (3, 3, times, levels), from read_model_block
+    :param index_lat: lat index of the chosen grid (see grid_choice_indexes)
+    :param index_lon: lon index of the chosen grid (see grid_choice_indexes)
+    :param hoursbeforerepeat: number of hours taken from each file
+    :return: dict of arrays: 'centre' - chosen grid at chosen level, 'mean_3x3' - average of all 9 grids at chosen level
+        (for all times in the block), 'below' and 'above' - chosen grid at the level below and above.
+    """
+
+    chosen_level = np.shape(block)[3] // 2
+
+    return {'centre': block[index_lat, index_lon, :hoursbeforerepeat, chosen_level],
+            'mean_3x3': block[:, :, :, chosen_level].mean(axis=(0, 1)),
+            'below': block[index_lat, index_lon, :hoursbeforerepeat, 0],
+            'above': block[index_lat, index_lon, :hoursbeforerepeat, -1]}
+
+
 def extract_model_data_wind(files,
                             DOYstart,
                             DOYstop,
@@ -516,7 +1113,10 @@ def extract_model_data_wind(files,
                             sitechoice,
                             savestring,
                             grid_choice=0,
-                            hoursbeforerepeat=24):
+                            hoursbeforerepeat=24,
+                            plot=True,
+                            n_workers=1,
+                            cache_dir=False):
     """
     Read premade model files, and extract wanted data from them.
     See extract_model_data for the following:
@@ -530,6 +1130,9 @@ def extract_model_data_wind(files,
     :param savestring:
     :param grid_choice:
     :param hoursbeforerepeat:
+    :param plot:
+    :param n_workers:
+    :param cache_dir:
     :return:
     """
 
@@ -588,352 +1191,141 @@ def extract_model_data_wind(files,
 
     assert variable == 'wind'
 
-    # choices dependent on variable choice
-    label_string = look_up.variable_info[variable][0]
-
-    ####################################################################################################################
-    #                                                     WIND
     ####################################################################################################################
-    # MORE THAN ONE STASH CODE INCLUDED FOR THIS VARIABLE
-    u_index_for_files = 0
-    v_index_for_files = 1
-
-    # creates lists to plot outside of the for loop
-    time_dict = {}
-    for item in files[0].keys():
-        varname = "time_" + str(item)
-        time_dict[varname] = []
-        time_dict[varname].append('placeholder')
-    # speed
-    wind_dict = {}
-    for item in files[0].keys():
-        varname = "wind_" + str(item)
-        wind_dict[varname] = []
-        wind_dict[varname].append('placeholder')
-    # dir
-    dir_dict = {}
-    for item in files[0].keys():
-        varname = "dir_" + str(item)
-        dir_dict[varname] = []
-        dir_dict[varname].append('placeholder')
-
-    # Creating a list to keep track of any dodgy model files with large time arrays when converting to datetime
-    dodgy_files = []
-
-    # all 9 grids temp - to average all the grids, rather than just take the centre grid
-    # all variables associated with this include '9' in the variable name, due to there being 9 grids
-    wind_dict_9 = {}
-    for item in files[0].keys():
-        varname = "wind_9_" + str(item)
-        wind_dict_9[varname] = []
-        wind_dict_9[varname].append('placeholder')
-
-    dir_dict_9 = {}
-    for item in files[0].keys():
-        varname = "dir_9_" + str(item)
-        dir_dict_9[varname] = []
-        dir_dict_9[varname].append('placeholder')
-
-    # adding the height above and below:
-    wind_dict_0 = {}
-    for item in files[0].keys():
-        varname = "wind_0_" + str(item)
-        wind_dict_0[varname] = []
-        wind_dict_0[varname].append('placeholder')
-    wind_dict_2 = {}
-    for item in files[0].keys():
-        varname = "wind_2_" + str(item)
-        wind_dict_2[varname] = []
-        wind_dict_2[varname].append('placeholder')
-
-    dir_dict_0 = {}
-    for item in files[0].keys():
-        varname = "dir0" + str(item)
-        dir_dict_0[varname] = []
-        dir_dict_0[varname].append('placeholder')
-    dir_dict_2 = {}
-    for item in files[0].keys():
-        varname = "dir2" + str(item)
-        dir_dict_2[varname] = []
-        dir_dict_2[varname].append('placeholder')
-
-    # loops over the london model file paths in obvsdict (to import the data each time), and the empty
-    # lists ready in lonswinddict,and time_dict, dir_dict (plus 3x3 average and 2nd height lists)
-    # these will be dictionaries including lists full of values and time respectively,
-    # one list for each day/ file in the observation files
-    for uitem, vitem, wind, time, direction, wind_9, dir_9, wind_0, wind_2, dir_0, dir_2 in zip(
-            sorted(files[u_index_for_files].values()),
-            sorted(files[v_index_for_files].values()),
-            sorted(wind_dict),
-            sorted(time_dict),
-            sorted(dir_dict),
-            sorted(wind_dict_9),
-            sorted(dir_dict_9),
-            sorted(wind_dict_0),
-            sorted(wind_dict_2),
-            sorted(dir_dict_0),
-            sorted(dir_dict_2)):
-
-        # assigns model .nc file
-        file_path_u = uitem
-        file_path_v = vitem
-
-        # CHANGED 06/08/18 AS ONE OF THE FILES WAS CORRUPTED, AND COULDN'T BE READ BY NETCDF
-        # nc_file_u = nc.Dataset(file_path_u)
-        # nc_file_v = nc.Dataset(file_path_v)
-        try:
-            nc_file_u = nc.Dataset(file_path_u)
-        except IOError:
-            print('PROBLEM READING FILE:')
-            print(file_path_u)
-            print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
-            dodgy_files.append(file_path_u)
-            continue
-
-        try:
-            nc_file_v = nc.Dataset(file_path_v)
-        except IOError:
-            print('PROBLEM READING FILE:')
-            print(file_path_v)
-            print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
-            dodgy_files.append(file_path_v)
-            continue
-
-        # reads in model height
-        # Read in the model data heights. As data is 3x3 grid, take the central
-        # cell which overlays the observation location.
-
-        # finding the altitude from the model
-        site_format = look_up.premade_model_site_codes[sitechoice]
-        # finds altitude from function
-        altitude = find_altitude(site_format, model)
-
-        try:
-            model_heights_u = nc_file_u.variables['level_height'][:] + altitude
-
-        except KeyError as error:
-            dodgy_files.append(file_path_u)
-            print(' ')
-            print('ERROR HERE: ', file_path_u)
-            print("Could not read in ", error, " as this is not a variable in the file")
-            print(' ')
-            continue
-
-        # tests to make sure all files with just one variable (and not time/ height) are caught
-        try:
-            model_heights_v = nc_file_v.variables['level_height'][:] + altitude
-        except KeyError as error:
-            dodgy_files.append(file_path_v)
-            print(' ')
-            print('ERROR HERE: ', file_path_v)
-            print("Could not read in ", error, " as this is not a variable in the file")
-            print(' ')
-            continue
-
-        # check that the heights are the same between stash codes
-        assert model_heights_u.all() == model_heights_v.all()
-
-        # finds the closest value of model height to observation, and saves the index
-        # if there is no observation files, disheight will be returned as an empty list. So this list is replaced by
-        # 10 m, in order to still plot model files if they exist.
-        if target_height == []:
-            target_height = 10
-
-        # why am I doing this in this function?
-        # should be removed and done outside
-
-        # where model_options[model][2] is z0_index
-        # z0_index = look_up.model_options[model][2]
-        # height_index = np.abs(model_heights_u - (disheight + z0zd[z0_index])).argmin()
-
-        height_index = np.abs(model_heights_u - target_height).argmin()
-
-        # if 1D, won't have to unravel
-        height_value = model_heights_u[height_index]
-
-        # taking the next closest heights
-        height_index_0 = height_index - 1
-        height_index_2 = height_index + 1
-        height_value_0 = model_heights_u[height_index_0]
-        height_value_2 = model_heights_u[height_index_2]
-
-        # Handle model time
-        # u stash code
-        try:
-            time_dict_returns_u = handle_model_time(nc_file_u, file_path_u, sitechoice, hoursbeforerepeat)
-        except ValueError:
-            dodgy_files.append(file_path_u)
-            continue
+    #                                                     WIND
+    ####################################################################################################################
+    # MORE THAN ONE STASH CODE INCLUDED FOR THIS VARIABLE
+    u_index_for_files = 0
+    v_index_for_files = 1
 
-        index_to_start = time_dict_returns_u['index_to_start']
-        model_time_u = time_dict_returns_u['model_time']
+    # creates lists to plot outside of the for loop
+    time_dict = {}
+    for item in files[0].keys():
+        varname = "time_" + str(item)
+        time_dict[varname] = []
+        time_dict[varname].append('placeholder')
+    # speed
+    wind_dict = {}
+    for item in files[0].keys():
+        varname = "wind_" + str(item)
+        wind_dict[varname] = []
+        wind_dict[varname].append('placeholder')
+    # dir
+    dir_dict = {}
+    for item in files[0].keys():
+        varname = "dir_" + str(item)
+        dir_dict[varname] = []
+        dir_dict[varname].append('placeholder')
 
-        # v stash code
-        try:
-            time_dict_returns_v = handle_model_time(nc_file_v, file_path_v, sitechoice, hoursbeforerepeat)
-        except ValueError:
-            dodgy_files.append(file_path_v)
-            continue
+    # Creating a list to keep track of any dodgy model files with large time arrays when converting to datetime
+    dodgy_files = []
 
-        index_to_startv = time_dict_returns_v['index_to_start']
-        model_time_v = time_dict_returns_v['model_time']
+    # all 9 grids temp - to average all the grids, rather than just take the centre grid
+    # all variables associated with this include '9' in the variable name, due to there being 9 grids
+    wind_dict_9 = {}
+    for item in files[0].keys():
+        varname = "wind_9_" + str(item)
+        wind_dict_9[varname] = []
+        wind_dict_9[varname].append('placeholder')
 
-        # ----------------------------------------------------------------------------------------------------------
-        # TIME TESTS BETWEEN THE TWO LISTS TO SEE IF THEY ARE THE SAME
-        # if the 2 time lists start at the same time:
-        if model_time_u[0] == model_time_v[0]:
-            # if the 2 lists are the same length
-            if len(model_time_u) == len(model_time_v):
-                time_test_pass = True
-            # if the two lists are not the same length
-            else:
-                time_test_pass = False
-                # find all the indexes of items that are in one list but not the other
-                # first way round
-                index_list_uv = []
-                for i, item in enumerate(model_time_u):
-                    if item in model_time_v:
-                        pass
-                    else:
-                        index_list_uv.append(i)
-                # second way round
-                index_list_vu = []
-                for i, item in enumerate(model_time_v):
-                    if item in model_time_u:
-                        pass
-                    else:
-                        index_list_vu.append(i)
-
-                # if both lists have items in the index list, there is a problem
-                if len(index_list_uv) != 0 and len(index_list_vu) != 0:
-                    raise ValueError("Both time lists have items that the other one doesn't!")
-
-                # define the first index of an item that is on one and not the other
-                if len(index_list_uv) == 0:
-                    pass
-                else:
-                    index_diff = index_list_uv[0]
-
-                if len(index_list_vu) == 0:
-                    pass
-                else:
-                    index_diff = index_list_vu[0]
+    dir_dict_9 = {}
+    for item in files[0].keys():
+        varname = "dir_9_" + str(item)
+        dir_dict_9[varname] = []
+        dir_dict_9[varname].append('placeholder')
 
-        else:
-            raise ValueError('The two time lists do not start with the same time!', model_time_u[0], model_time_v[0])
+    # adding the height above and below:
+    wind_dict_0 = {}
+    for item in files[0].keys():
+        varname = "wind_0_" + str(item)
+        wind_dict_0[varname] = []
+        wind_dict_0[varname].append('placeholder')
+    wind_dict_2 = {}
+    for item in files[0].keys():
+        varname = "wind_2_" + str(item)
+        wind_dict_2[varname] = []
+        wind_dict_2[varname].append('placeholder')
 
-        # ----------------------------------------------------------------------------------------------------------
-        # Makes a choice about which grid to use.
-        grid_choice_dict = grid_choice_indexes(grid_choice)
-        index_lat = grid_choice_dict['index_lat']
-        index_lon = grid_choice_dict['index_lon']
+    dir_dict_0 = {}
+    for item in files[0].keys():
+        varname = "dir0" + str(item)
+        dir_dict_0[varname] = []
+        dir_dict_0[varname].append('placeholder')
+    dir_dict_2 = {}
+    for item in files[0].keys():
+        varname = "dir2" + str(item)
+        dir_dict_2[varname] = []
+        dir_dict_2[varname].append('placeholder')
 
-        # ----------------------------------------------------------------------------------------------------------
+    # reads each pair of u and v model files: one pair per day, done in date order
+    # if more than one worker is asked for, days are read in parallel by a pool of processes
+    # (netCDF4 isn't thread safe, so u and v files are read together in the same process)
+    file_paths_u = sorted(files[u_index_for_files].values())
+    file_paths_v = sorted(files[v_index_for_files].values())
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            file_results = list(pool.map(extract_wind_files,
+                                         file_paths_u,
+                                         file_paths_v,
+                                         repeat(model),
+                                         repeat(target_height),
+                                         repeat(sitechoice),
+                                         repeat(grid_choice),
+                                         repeat(hoursbeforerepeat),
+                                         repeat(cache_dir)))
+    else:
+        file_results = [extract_wind_files(file_path_u, file_path_v, model, target_height, sitechoice, grid_choice,
+                                           hoursbeforerepeat, cache_dir) for file_path_u, file_path_v in
+                        zip(file_paths_u, file_paths_v)]
 
-        # READS IN VALUES
-        # reads in u and v components of wind speed and direction
-        model_vars_u = nc_file_u.variables['eastward_wind']
-        model_vars_v = nc_file_v.variables['northward_wind']
+    # loops over the results for each pair of files, and the empty
+    # lists ready in wind_dict, time_dict, dir_dict (plus 3x3 average and 2nd height lists)
+    # these will be dictionaries including lists full of values and time respectively,
+    # one list for each day/ file in the observation files
+    for file_result, wind, time, direction, wind_9, dir_9, wind_0, wind_2, dir_0, dir_2 in zip(
+            file_results,
+            sorted(wind_dict),
+            sorted(time_dict),
+            sorted(dir_dict),
+            sorted(wind_dict_9),
+            sorted(dir_dict_9),
+            sorted(wind_dict_0),
+            sorted(wind_dict_2),
+            sorted(dir_dict_0),
+            sorted(dir_dict_2)):
 
-        # finds wind values at the closest model height to obs
-        var_vals_u = model_vars_u[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                     height_index]
-        var_vals_v = model_vars_v[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                     height_index]
+        # file couldn't be read
+        if 'dodgy_file' in file_result:
+            dodgy_files.append(file_result['dodgy_file'])
+            continue
 
-        # taking the next closest heights
-        var_vals_u_0 = model_vars_u[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index_0]
-        var_vals_u_2 = model_vars_u[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index_2]
-        var_vals_v_0 = model_vars_v[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index_0]
-        var_vals_v_2 = model_vars_v[index_lat, index_lon, index_to_start:index_to_start + hoursbeforerepeat,
-                       height_index_2]
-
-        # calculates wind speed and direction from u and v componants
-        if time_test_pass:
-            pass
-        else:
-            var_vals_v = var_vals_v[:index_diff - 1]
-            var_vals_u = var_vals_u[:index_diff - 1]
-
-        var_vals_wind = ((var_vals_u ** 2) + (var_vals_v ** 2)) ** 0.5
-        # http://weatherclasses.com/uploads/4/2/8/6/4286089/computing_wind_direction_and_speed_from_u_and_v.pdf
-        var_vals_dir = np.arctan2(var_vals_u, var_vals_v) * (180.0 / np.pi) + 180.0
-
-        # Ensuring the direction is between 0 and 360 degrees
-        for i in range(len(var_vals_dir)):
-            if var_vals_dir[i] < 0.0:
-                var_vals_dir[i] = var_vals_dir[i] + 360.0
-            if var_vals_dir[i] > 360.0:
-                var_vals_dir[i] = var_vals_dir[i] - 360.0
-
-        # other heights:
-        var_vals_wind_0 = ((var_vals_u_0 ** 2) + (var_vals_v_0 ** 2)) ** 0.5
-        var_vals_dir_0 = np.arctan2(var_vals_u_0, var_vals_v_0) * (180.0 / np.pi) + 180.0
-        for i in range(len(var_vals_dir_0)):
-            if var_vals_dir_0[i] < 0.0:
-                var_vals_dir_0[i] = var_vals_dir_0[i] + 360.0
-            if var_vals_dir_0[i] > 360.0:
-                var_vals_dir_0[i] = var_vals_dir_0[i] - 360.0
-
-        var_vals_wind_2 = ((var_vals_u_2 ** 2) + (var_vals_v_2 ** 2)) ** 0.5
-        var_vals_dir_2 = np.arctan2(var_vals_u_2, var_vals_v_2) * (180.0 / np.pi) + 180.0
-        for i in range(len(var_vals_dir_2)):
-            if var_vals_dir_2[i] < 0.0:
-                var_vals_dir_2[i] = var_vals_dir_2[i] + 360.0
-            if var_vals_dir_2[i] > 360.0:
-                var_vals_dir_2[i] = var_vals_dir_2[i] - 360.0
+        height_value = file_result['height_value']
+        height_value_0 = file_result['height_value_0']
+        height_value_2 = file_result['height_value_2']
 
         # append times to a list to plot outside of the for loop
-        for item in model_time_u:
+        for item in file_result['model_time']:
             time_dict[time].append(item)
         # append winds to a list to plot outside of the for loop
-        for item in var_vals_wind:
+        for item in file_result['centre'][0]:
             wind_dict[wind].append(item)
         # append direction to a list to plot outside of the for loop
-        for item in var_vals_dir:
+        for item in file_result['centre'][1]:
             dir_dict[direction].append(item)
 
-        # 3x3 grid average
-        shape_number = 2
-
-        u_means = []
-        v_means = []
-        for i in range(index_to_start, np.shape(model_vars_u)[shape_number]):
-            u_mean = np.mean(model_vars_u[:, :, i, height_index])
-            v_mean = np.mean(model_vars_v[:, :, i, height_index])
-            u_means.append(u_mean)
-            v_means.append(v_mean)
-
-        # calculates wind speed and direction from u and v components
-        wind_means = []
-        dir_means = []
-        for umean, vmean in zip(u_means, v_means):
-            wind_means_i = ((umean ** 2) + (vmean ** 2)) ** 0.5
-            dir_means_i = np.arctan2(umean, vmean) * (180.0 / np.pi) + 180.0
-            # Ensuring the direction is between 0 and 360 degrees
-            if dir_means_i < 0.0:
-                dir_means_i = dir_means_i + 360.0
-            if dir_means_i > 360.0:
-                dir_means_i = dir_means_i - 360.0
-
-            wind_means.append(wind_means_i)
-            dir_means.append(dir_means_i)
-
         # append averages to a list to plot outside of the for loop
-        wind_dict_9[wind_9].append(wind_means)
-        dir_dict_9[dir_9].append(dir_means)
+        wind_dict_9[wind_9].append(list(file_result['mean_3x3'][0]))
+        dir_dict_9[dir_9].append(list(file_result['mean_3x3'][1]))
 
         # taking the next closest heights
-        for item0 in var_vals_wind_0:
+        for item0 in file_result['below'][0]:
             wind_dict_0[wind_0].append(item0)
-        for item2 in var_vals_wind_2:
+        for item2 in file_result['above'][0]:
             wind_dict_2[wind_2].append(item2)
-        for item0 in var_vals_dir_0:
+        for item0 in file_result['below'][1]:
             dir_dict_0[dir_0].append(item0)
-        for item2 in var_vals_dir_2:
+        for item2 in file_result['above'][1]:
             dir_dict_2[dir_2].append(item2)
 
     # print out any dodgy model files with huge time array lengths...
@@ -1010,11 +1402,8 @@ def extract_model_data_wind(files,
             all_times.append(time)
     print(' ')
     print('Finding any duplicate times:')
-    if len(set([x for x in all_times if all_times.count(x) > 1])) == 0:
-        print('No duplicates')
-    else:
-        print(len(set([x for x in all_times if all_times.count(x) > 1])), 'Duplicates')
-        print(set([x for x in all_times if all_times.count(x) > 1]))
+    duplicate_time_report([time_dict[item][:hoursbeforerepeat] for item in key_name_times],
+                          [files[0][item[len('time_'):]] for item in key_name_times])
 
     # dodgy files dealing with skipping times still for some reason appending the string name to string list. So here,
     # I am being lazy and manually removing any lists with time length 0 before plotting
@@ -1039,50 +1428,15 @@ def extract_model_data_wind(files,
             del dir_dict[dir]
             del dir_dict_9[dirall]
 
-    # plotting the differences between 3x3 averaged and centre grid
-    plt.figure(figsize=(20, 15))
-
-    ax1 = pyplot.subplot(2, 1, 1)
-    ax2 = pyplot.subplot(2, 1, 2)
-
-    mod_colour = look_up.model_options[model][1]
-
-    # for wind, time, direction in zip(key_name_winds_9, key_name_times, key_name_dirs_9):
-    #     if len(wind_dict_9[wind]) > 0:
-    #         plotCollection(ax1, time_dict[time][:], wind_dict_9[wind][0][:],
-    #                        'g')
-    #
-    #         plotCollection(ax2, time_dict[time][:],
-    #                        dir_dict_9[direction][0][:],
-    #                        'g', label="3x3 averaged %s @ %d m" % (model, height_value))
+    plot_made = output_plot(plot, 'wind', [time_dict[time] for time in key_name_times],
+                            [[wind_dict[wind] for wind in key_name_winds],
+                             [dir_dict[direction] for direction in key_name_dirs]],
+                            {'variable': variable, 'model_name': model, 'height_value': height_value,
+                             'sitechoice': sitechoice, 'DOYstart': DOYstart, 'DOYstop': DOYstop,
+                             'savestring': savestring})
 
-    for wind, time, direction in zip(key_name_winds, key_name_times, key_name_dirs):
-        if len(wind_dict[wind]) > 0:
-            plotCollection(ax1, time_dict[time][:], wind_dict[wind][:],
-                           mod_colour)
-            plotCollection(ax2, time_dict[time][:], dir_dict[direction][:],
-                           mod_colour, label="%s @ %d m" % (model, height_value))
-
-    # Try here because if one stash code is missing, plot can't be made (I think)
-    # throws an error because 0 is not a date
-    try:
-        ax2.set_xlabel('DOY')
-        ax1.set_ylabel(label_string[0])
-        ax2.set_ylabel(label_string[1])
-        ax2.xaxis.set_major_formatter(DateFormatter('%j'))
-
-        date_for_title = 'DOY ' + str(DOYstart) + ' - ' + str(DOYstop)
-        plt.title(sitechoice + ': ' + date_for_title)
-
-        plt.gcf().autofmt_xdate()
-
-        pylab.savefig(savestring + str(variable) + '_' + str(model) + '_' + sitechoice + '_' +
-                      str(DOYstart) + '_' + str(DOYstop) + '.png', bbox_inches='tight')
-
-        plt.close('all')
-
-    except:
-        print('WIND PLOTS NOT MADE!!!')
+    # if one stash code is missing, plot can't be made
+    if plot_made is False:
         height_value = 0
         height_value_0 = 0
         height_value_2 = 0
@@ -1114,11 +1468,17 @@ def extract_model_data_wind(files,
 def retrieve_arrays_model(included_models, model_grid_choice):
     """
     Return arrays of model data after extract_model_data process
-    :param included_models:
+    :param included_models: dictionary of model outputs. Each is either a list of
+        [key_name_times, key_names_vars, time_dict, var_dict, height_value], or a columnar result (see model_series).
     :param model_grid_choice:
     :return:
     """
 
+    # columnar results already hold contiguous arrays: return them as they are (no copies)
+    if type(included_models.get(model_grid_choice)) == dict:
+        included_model = included_models[model_grid_choice]
+        return included_model['time'], included_model['centre']
+
     try:
         included_model = included_models[model_grid_choice]
 
@@ -1171,6 +1531,229 @@ def find_altitude(site,
     return altitude
 
 
+def extract_wind_files(file_path_u,
+                       file_path_v,
+                       model,
+                       target_height,
+                       sitechoice,
+                       grid_choice=0,
+                       hoursbeforerepeat=24,
+                       cache_dir=False):
+    """
+    Reads one pair of premade u and v model files (one day), and calculates wind speed and direction from them.
+    This is the work done for each day in extract_model_data_wind - it is a separate function so that days can be read
+    in parallel by a pool of processes.
+    See extract_model_data_wind for the following:
+    :param file_path_u: u stash code file
+    :param file_path_v: v stash code file
+    :param model:
+    :param target_height:
+    :param sitechoice:
+    :param grid_choice:
+    :param hoursbeforerepeat:
+    :param cache_dir:
+    :return: {'dodgy_file': path} if a file can't be read. Otherwise a dict of: 'model_time' - list of times,
+        'centre', 'mean_3x3', 'below', 'above' - (speed, direction) arrays (see wind_block_values), 'height_value',
+        'height_value_0', 'height_value_2' - chosen model level height, and the heights below and above.
+    """
+
+    # served from the cache if these files have been extracted in the same way before
+    if cache_dir:
+        cache_key = extraction_cache.cache_key([file_path_u, file_path_v], ['wind', model, target_height, sitechoice,
+                                                                            grid_choice, hoursbeforerepeat])
+        file_result = extraction_cache.load_result(cache_dir, cache_key)
+
+        if file_result is None:
+            file_result = extract_wind_files(file_path_u, file_path_v, model, target_height, sitechoice,
+                                             grid_choice, hoursbeforerepeat)
+            if 'dodgy_file' not in file_result:
+                extraction_cache.save_result(cache_dir, cache_key, file_result)
+
+        return file_result
+
+    # CHANGED 06/08/18 AS ONE OF THE FILES WAS CORRUPTED, AND COULDN'T BE READ BY NETCDF
+    try:
+        nc_file_u = nc.Dataset(file_path_u)
+    except IOError:
+        print('PROBLEM READING FILE:')
+        print(file_path_u)
+        print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
+        return {'dodgy_file': file_path_u}
+
+    try:
+        nc_file_v = nc.Dataset(file_path_v)
+    except IOError:
+        nc_file_u.close()
+        print('PROBLEM READING FILE:')
+        print(file_path_v)
+        print("It's size may be 0, and netCDF may have troubles opening corrupted file.")
+        return {'dodgy_file': file_path_v}
+
+    try:
+        # reads in model height
+        # Read in the model data heights. As data is 3x3 grid, take the central
+        # cell which overlays the observation location.
+
+        # finding the altitude from the model
+        site_format = look_up.premade_model_site_codes[sitechoice]
+        # finds altitude from function
+        altitude = find_altitude(site_format, model)
+
+        try:
+            model_heights_u = nc_file_u.variables['level_height'][:] + altitude
+        except KeyError as error:
+            print(' ')
+            print('ERROR HERE: ', file_path_u)
+            print("Could not read in ", error, " as this is not a variable in the file")
+            print(' ')
+            return {'dodgy_file': file_path_u}
+
+        # tests to make sure all files with just one variable (and not time/ height) are caught
+        try:
+            model_heights_v = nc_file_v.variables['level_height'][:] + altitude
+        except KeyError as error:
+            print(' ')
+            print('ERROR HERE: ', file_path_v)
+            print("Could not read in ", error, " as this is not a variable in the file")
+            print(' ')
+            return {'dodgy_file': file_path_v}
+
+        # check that the heights are the same between stash codes
+        assert model_heights_u.all() == model_heights_v.all()
+
+        # finds the closest value of model height to observation, and saves the index
+        # if there is no observation files, disheight will be returned as an empty list. So this list is replaced by
+        # 10 m, in order to still plot model files if they exist.
+        if target_height == []:
+            target_height = 10
+
+        height_index = np.abs(model_heights_u - target_height).argmin()
+
+        # if 1D, won't have to unravel
+        height_value = model_heights_u[height_index]
+
+        # taking the next closest heights
+        height_value_0 = model_heights_u[height_index - 1]
+        height_value_2 = model_heights_u[height_index + 1]
+
+        # Handle model time
+        # u stash code
+        try:
+            time_dict_returns_u = handle_model_time(nc_file_u, file_path_u, sitechoice, hoursbeforerepeat)
+        except ValueError:
+            return {'dodgy_file': file_path_u}
+
+        index_to_start = time_dict_returns_u['index_to_start']
+        model_time_u = time_dict_returns_u['model_time_64']
+
+        # v stash code
+        try:
+            time_dict_returns_v = handle_model_time(nc_file_v, file_path_v, sitechoice, hoursbeforerepeat)
+        except ValueError:
+            return {'dodgy_file': file_path_v}
+
+        model_time_v = time_dict_returns_v['model_time_64']
+
+        # ----------------------------------------------------------------------------------------------------------
+        # TIME TESTS BETWEEN THE TWO LISTS TO SEE IF THEY ARE THE SAME
+        # if the 2 time lists start at the same time:
+        if model_time_u[0] != model_time_v[0]:
+            raise ValueError('The two time lists do not start with the same time!',
+                             model_time_u[0].astype(object), model_time_v[0].astype(object))
+
+        # if the two lists are not the same length, the values are cut just before the first time
+        # that is in one list but not the other
+        index_diff = None
+        if len(model_time_u) != len(model_time_v):
+            # find all the indexes of items that are in one list but not the other (both ways round)
+            index_list_uv = np.flatnonzero(~np.isin(model_time_u, model_time_v))
+            index_list_vu = np.flatnonzero(~np.isin(model_time_v, model_time_u))
+
+            # if both lists have items in the index list, there is a problem
+            if len(index_list_uv) != 0 and len(index_list_vu) != 0:
+                raise ValueError("Both time lists have items that the other one doesn't!")
+
+            if len(index_list_uv) != 0:
+                index_diff = index_list_uv[0]
+            if len(index_list_vu) != 0:
+                index_diff = index_list_vu[0]
+
+        # ----------------------------------------------------------------------------------------------------------
+        # Makes a choice about which grid to use.
+        grid_choice_dict = grid_choice_indexes(grid_choice)
+        index_lat = grid_choice_dict['index_lat']
+        index_lon = grid_choice_dict['index_lon']
+
+        # READS IN VALUES
+        # reads the whole 3x3 block of u and v components needed in one go - all times after spin up, and the chosen
+        # model level with the levels either side of it
+        block_u = read_model_block(nc_file_u.variables['eastward_wind'], index_to_start, height_index)
+        block_v = read_model_block(nc_file_v.variables['northward_wind'], index_to_start, height_index)
+
+    finally:
+        nc_file_u.close()
+        nc_file_v.close()
+
+    file_result = wind_block_values(block_u, block_v, index_lat, index_lon, hoursbeforerepeat, index_diff)
+
+    file_result['model_time'] = model_time_u.astype(object).tolist()
+    file_result['height_value'] = height_value
+    file_result['height_value_0'] = height_value_0
+    file_result['height_value_2'] = height_value_2
+
+    return file_result
+
+
+def wind_block_values(block_u,
+                      block_v,
+                      index_lat,
+                      index_lon,
+                      hoursbeforerepeat=24,
+                      index_diff=None):
+    """
+    Wind speed and direction from blocks of u and v read with read_model_block, for all times and levels at once.
+    :param block_u: u component array with shape (3, 3, times, levels), from read_model_block
+    :param block_v: v component array with the same shape as block_u
+    :param index_lat: lat index of the chosen grid (see grid_choice_indexes)
+    :param index_lon: lon index of the chosen grid (see grid_choice_indexes)
+    :param hoursbeforerepeat: number of hours taken from each file
+    :param index_diff: index of the first time that is in only one of the u and v files. If given, values for the
+        chosen grid at the chosen level are cut before it.
+    :return: dict of (speed, direction) arrays: 'centre' - chosen grid at chosen level, 'mean_3x3' - from the average u
+        and v of all 9 grids at chosen level (for all times in the block), 'below' and 'above' - chosen grid at the
+        level below and above.
+    """
+
+    values_u = block_values(block_u, index_lat, index_lon, hoursbeforerepeat)
+    values_v = block_values(block_v, index_lat, index_lon, hoursbeforerepeat)
+
+    if index_diff is not None:
+        values_u['centre'] = values_u['centre'][:index_diff - 1]
+        values_v['centre'] = values_v['centre'][:index_diff - 1]
+
+    return {key: wind_speed_direction(values_u[key], values_v[key]) for key in values_u}
+
+
+def wind_speed_direction(u,
+                         v):
+    """
+    calculates wind speed and direction from u and v components
+    http://weatherclasses.com/uploads/4/2/8/6/4286089/computing_wind_direction_and_speed_from_u_and_v.pdf
+    :param u: array of u components
+    :param v: array of v components
+    :return: wind speed array, wind direction array (degrees, between 0 and 360)
+    """
+
+    wind_speed = ((u ** 2) + (v ** 2)) ** 0.5
+    wind_direction = np.arctan2(u, v) * (180.0 / np.pi) + 180.0
+
+    # Ensuring the direction is between 0 and 360 degrees
+    wind_direction = np.ma.where(wind_direction < 0.0, wind_direction + 360.0, wind_direction)
+    wind_direction = np.ma.where(wind_direction > 360.0, wind_direction - 360.0, wind_direction)
+
+    return wind_speed, wind_direction
+
+
 def time_to_datetime(tstr,
                      timeRaw):
     """
@@ -1183,51 +1766,38 @@ def time_to_datetime(tstr,
     """
     # sort out times and turn into datetimes
     # tstr = datafile.variables['time'].units
-    tstr = tstr.replace('-', ' ')
-    tstr = tstr.split(' ')
-    # Datetime
-    # ---------------
-    # create list of datetimes for export
-    # start date in netCDF file
-    start = dt.datetime(int(tstr[2]), int(tstr[3]), int(tstr[4]))
-    if tstr[0] == 'seconds':
-        # get delta times from the start date
-        # time: time in minutes since the start time (taken from netCDF file)
-        delta = [dt.timedelta(seconds=int(timeRaw[i])) for i in range(0, len(timeRaw))]
-    elif tstr[0] == 'minutes':
-        delta = [dt.timedelta(seconds=int(timeRaw[i] * 60)) for i in range(0, len(timeRaw))]
-    elif tstr[0] == 'hours':
-        delta = [dt.timedelta(seconds=int(timeRaw[i] * 3600)) for i in range(0, len(timeRaw))]
-    if 'delta' in locals():
-        return [start + delta[i] for i in np.arange(0, len(timeRaw))]
-    else:
+    start, unit_seconds = time_units_to_datetime64(tstr)
+
+    if start is None:
         print('Raw time not in seconds, minutes or hours. No processed time created.')
         return
 
+    # get delta times from the start date, all at once
+    # (whole seconds, truncated as before)
+    delta = (np.asarray(timeRaw, dtype=np.float64) * unit_seconds).astype(np.int64).astype('timedelta64[s]')
+
+    return (start + delta).astype(object).tolist()
 
-def plotCollection(ax, xs, ys, *args, **kwargs):
+
+def time_units_to_datetime64(tstr):
     """
-    function to group labels in the plots -- otherwise, the same label will appear multiple times
-    as it gives one to each file/day being looped over
-    :param ax:
-    :param xs:
-    :param ys:
-    :param args:
-    :param kwargs:
-    :return:
+    Reads the units string of a netCDF time variable.
+    :param tstr: string along the lines of 'secs/mins/hours since YYYY-MM-DD ........'
+    :return: start date as a numpy datetime64[s], and the number of seconds in one time unit.
+        (None, None) if the units are not seconds, minutes or hours.
     """
 
-    ax.plot(xs, ys, *args, **kwargs)
-    if "label" in kwargs.keys():
-        # remove duplicates
-        handles, labels = plt.gca().get_legend_handles_labels()
-        newLabels, newHandles = [], []
-        for handle, label in zip(handles, labels):
-            if label not in newLabels:
-                newLabels.append(label)
-                newHandles.append(handle)
-        # pyplot.legend(newHandles, newLabels, loc='upper left', bbox_to_anchor=(1, 0.5), fontsize=12)
-        plt.legend(newHandles, newLabels, bbox_to_anchor=(1, 0.5), fontsize=15, loc='center left')
+    tstr = tstr.replace('-', ' ')
+    tstr = tstr.split(' ')
+
+    unit_seconds = {'seconds': 1, 'minutes': 60, 'hours': 3600}
+
+    if tstr[0] not in unit_seconds:
+        return None, None
+
+    start = np.datetime64(dt.datetime(int(tstr[2]), int(tstr[3]), int(tstr[4])), 's')
+
+    return start, unit_seconds[tstr[0]]
 
 
 def grid_choice_indexes(grid_choice):
@@ -1276,103 +1846,121 @@ def grid_choice_indexes(grid_choice):
             'index_lon': index_lon}
 
 
+def site_grid_numbers(sitechoice):
+    """
+    Finds the grid number (see look_up.grid_dict) of each grid in a site's 3x3.
+    :param sitechoice: site, e.g. 'KSSW'
+    :return: dictionary of {grid letter: grid number}. Only grids in look_up.grid_dict are included.
+    """
+
+    grid_numbers = {}
+
+    for grid_number in look_up.grid_dict:
+        for item in look_up.grid_dict[grid_number]:
+            site, grid_letter = item.split(' ')
+            if site == sitechoice:
+                grid_numbers[grid_letter] = grid_number
+
+    return grid_numbers
+
+
 def handle_model_time(nc_file,
                       file_path,
                       sitechoice,
                       hoursbeforerepeat=24):
     """
     Function to handle reading model forecast time.
-    :return:
+    :return: dict of 'index_to_start' - number of spin up hours skipped, 'model_time' - list of datetimes, and
+        'model_time_64' - the same times as a datetime64[s] array.
+    """
+
+    decoded_time = decode_model_time(nc_file, file_path, hoursbeforerepeat)
+
+    return {'index_to_start': decoded_time['index_to_start'],
+            'model_time': decoded_time['model_time'].astype(object).tolist(),
+            'model_time_64': decoded_time['model_time']}
+
+
+# decoded time axes, per file: {(file_path, mtime, hoursbeforerepeat): decode_model_time output}
+decoded_time_cache = {}
+
+
+def decode_model_time(nc_file,
+                      file_path,
+                      hoursbeforerepeat=24):
+    """
+    Decodes the forecast time axis of a premade model file with array operations: forecast_reference_time plus
+    forecast_period, rounded to the hour, with the spin up hours found and removed, and checked for gaps.
+    Results are cached for each file (by path and modification time).
+    :param nc_file: open netCDF4 dataset
+    :param file_path: path of the file (used for the file date, and the cache)
+    :param hoursbeforerepeat: number of hours taken from each file
+    :return: dict of 'index_to_start' - number of spin up hours skipped, and 'model_time' - datetime64[s] array
     """
 
+    try:
+        cache_key = (file_path, os.path.getmtime(file_path), hoursbeforerepeat)
+    except OSError:
+        cache_key = None
+
+    if cache_key in decoded_time_cache:
+        return decoded_time_cache[cache_key]
+
     # reads in time
     # get time units for time conversion and start time
     unit_start_time = nc_file.variables['time'].units
 
-    # Read in minutes since the start time and add it on
-    # Note: time_to_datetime needs time_since to be a list. Hence put value inside a single element list first
-    time_since_start = [np.squeeze(nc_file.variables['forecast_reference_time'])]
+    # minutes (or seconds, hours) since the start time
+    time_since_start = np.ravel(np.ma.getdata(nc_file.variables['forecast_reference_time'][:]))
 
-    # create start time for model data
-    # time_to_datetime outputs a list of datetimes, so remove the single element from the list.
-    # time to datetime is an imported function
-    # Having to put a try/except in here, because some of the model files are dodgy and give huge time arrays
-    # when converting to datetime
-    try:
-        run_start_time = time_to_datetime(unit_start_time, time_since_start)[0]
-    except:
-        raise ValueError('DODGY FILE: TIME ARRAY NOT AS EXPECTED: ', np.shape(unit_start_time))
-
-    # get number of forecast hours to add onto time_start
-    run_len_hours = np.squeeze(nc_file.variables['forecast_period'][:])
-
-    run_times = [run_start_time + dt.timedelta(seconds=hr * 3600) for hr in run_len_hours]
-
-    # KSSW is a site with more letters than others, so it's handled differently when finding the date:
-    if sitechoice == 'KSSW':
-        start_index = -34
-        end_index = -26
-    elif sitechoice == 'BFCL':
-        start_index = -34
-        end_index = -26
-    elif sitechoice == 'MR':
-        start_index = -32
-        end_index = -24
-    elif sitechoice == 'NK':
-        start_index = -32
-        end_index = -24
-    else:
-        start_index = -33
-        end_index = -25
+    # Some of the model files are dodgy and give huge time arrays
+    if time_since_start.size != 1:
+        raise ValueError('DODGY FILE: TIME ARRAY NOT AS EXPECTED: ', np.shape(time_since_start))
+
+    start, unit_seconds = time_units_to_datetime64(unit_start_time)
+    if start is None:
+        raise ValueError('DODGY FILE: TIME UNITS NOT AS EXPECTED: ', unit_start_time)
 
-    # DIFFERENT LENGTHS OF FILES...
+    run_start_time = start + np.timedelta64(int(time_since_start[0] * unit_seconds), 's')
 
-    # constructing midnight
-    # seen in ukv files
-    midnight_date = dt.datetime.strptime(str(file_path[start_index:end_index]), '%Y%m%d') + dt.timedelta(
-        days=1)
-    midnight = dt.time(0, 0)
-    midnight_datetime = dt.datetime.combine(midnight_date, midnight)
+    # get number of forecast hours to add onto time_start (to the microsecond, to be rounded below)
+    run_len_hours = np.ravel(np.ma.getdata(nc_file.variables['forecast_period'][:]))
+    run_times = run_start_time + np.round(run_len_hours * 3600e6).astype(np.int64).astype('timedelta64[us]')
 
-    # constructing 21 Z
-    correct_date = dt.datetime.strptime(str(file_path[start_index:end_index]), '%Y%m%d')
-    correct_time = dt.time(21, 0)
-    correct_datetime = dt.datetime.combine(correct_date, correct_time)
+    # date of the forecast run, from the file name
+    file_record = model_file_names.parse_model_filename(file_path)
+    if file_record is None:
+        raise ValueError('ERROR: DODGY FILE: file name not as expected: ', file_path)
+    file_date = np.datetime64(file_record.date, 's')
 
-    # constructing 10 pm
-    # seen in lon files
-    ten_date = dt.datetime.strptime(str(file_path[start_index:end_index]), '%Y%m%d')
-    ten_time = dt.time(22, 0)
-    ten_datetime = dt.datetime.combine(ten_date, ten_time)
+    one_hour = np.timedelta64(1, 'h')
 
     # if the time isn't exactly on the hour
-    if run_times[0].minute != 0 or run_times[0].second != 0 or run_times[0].microsecond != 0:
-        for i, item in enumerate(run_times):
-            # Rounds to nearest hour by adding a timedelta hour if minute >= 30
-            new_t = item.replace(second=0, microsecond=0, minute=0, hour=item.hour) + dt.timedelta(
-                hours=item.minute // 30)
-
-            # if the difference between the time and the nearest hour is less than a minute and a half:
-            if abs(item - new_t) < dt.timedelta(minutes=1.5):
-                run_times[i] = new_t
-            else:
-                raise ValueError('THERE IS A TIME WITH A LARGER DIFFERENCE THAN 1.5 MINUTES TO THE HOUR: ', item)
+    if run_times[0] != run_times[0].astype('datetime64[h]'):
+        # Rounds to nearest hour (half an hour or more rounds up)
+        rounded_times = (run_times + np.timedelta64(30, 'm')).astype('datetime64[h]')
+
+        # the difference between each time and the nearest hour should be less than a minute and a half
+        too_far = np.abs(run_times - rounded_times) >= np.timedelta64(90, 's')
+        if too_far.any():
+            raise ValueError('THERE IS A TIME WITH A LARGER DIFFERENCE THAN 1.5 MINUTES TO THE HOUR: ',
+                             run_times[np.argmax(too_far)])
+
+        run_times = rounded_times
+
+    run_times = run_times.astype('datetime64[s]')
 
     # Do the model times start where they should? should start at 2100, and I want to take all values from after
     # the first 3 hours (allowing for spin up) - so ideally times should start at midnight for a perfect file
-    if run_times[0] == correct_datetime:
-        # index to start defined here, as different situations have a different start index.
-        # and these need to be considered when taking values, too. Otherwise, list lengths will be different.
-        index_to_start = 3
-    # if the file starts at midnight, don't need to adjust for spin up (as this is already not taking first
-    # 3 hours)
-    elif run_times[0] == midnight_datetime:
-        index_to_start = 0
-    # some files start at 10 pm? so therefore neglect forst 2 hours instead of 3 hours
-    elif run_times[0] == ten_datetime:
-        index_to_start = 2
+    # 21Z: skip 3 hours. midnight (seen in ukv files): don't need to adjust for spin up. 10 pm (seen in lon files):
+    # skip 2 hours
+    spin_up_starts = {file_date + 21 * one_hour: 3,
+                      file_date + 24 * one_hour: 0,
+                      file_date + 22 * one_hour: 2}
 
-    else:
+    index_to_start = spin_up_starts.get(run_times[0])
+
+    if index_to_start is None:
         print(' ')
         print(len(run_times), 'start:', run_times[0], 'end:', run_times[-1])
         raise ValueError('ERROR: DODGY FILE: previously unseen time length in this file: ', file_path)
@@ -1380,17 +1968,18 @@ def handle_model_time(nc_file,
     model_time = run_times[index_to_start:index_to_start + hoursbeforerepeat]
 
     # check to see if all hours are consecutive by 1 hour...
-    flag = 0
-    for i in range(0, len(model_time) - 1):
-        if model_time[i + 1] == model_time[i] + dt.timedelta(hours=1):
-            pass
-        else:
+    jumps = np.flatnonzero(np.diff(model_time) != one_hour)
+    if len(jumps) != 0:
+        for i in jumps:
             print(' ')
             print('ERROR: There is a jump in hours: ')
             print(model_time[i], model_time[i + 1])
             print('For file: ' + file_path)
-            flag = 1
-    if flag == 1:
         raise ValueError('Times are not consecutive by 1 hour')
 
-    return {'index_to_start': index_to_start, 'model_time': model_time}
+    decoded_time = {'index_to_start': index_to_start, 'model_time': model_time}
+
+    if cache_key is not None:
+        decoded_time_cache[cache_key] = decoded_time
+
+    return decoded_time
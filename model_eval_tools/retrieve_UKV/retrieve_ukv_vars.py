@@ -1,4 +1,5 @@
 import datetime as dt
+import numpy as np
 import pandas as pd
 import os
 
@@ -12,8 +13,17 @@ from model_eval_tools.retrieve_UKV import find_model_files
 def retrieve_UKV(run_choices,
                  DOYstart,
                  DOYstop,
-                 sa_analysis=True):
+                 sa_analysis=True,
+                 cache_dir=False,
+                 memmap_dir=False,
+                 sa_store_dir=False):
     """
+    cache_dir: directory of the cache of values extracted from model files (see extraction_cache). If given, files
+    which have been extracted in the same way before aren't read again. If False, nothing is cached.
+    memmap_dir: if given, site model series are written to memory-mapped files in this directory (see
+    model_series_memmap), and the returned arrays are views of them.
+    sa_store_dir: if given, SA grid percentages are kept in sqlite stores in this directory (see sa_percentages_store),
+    one for each csv, instead of in the csvs.
     """
 
     scint_path = run_choices['scint_path']
@@ -35,6 +45,28 @@ def retrieve_UKV(run_choices,
     model_grid_vals = {}
     model_grid_time = {}
 
+    model_path = "//rdg-home.ad.rdg.ac.uk/research-nfs/basic/micromet/Tier_processing/rv006011/new_data_storage/"
+    # model_path = 'C:/Users/beths/OneDrive - University of Reading/local_runs_data/data_wifi_problems/data/'
+
+    # variables which need files finding for this site (the source area analysis finds its own files for all grids)
+    site_variables = []
+    if (variable == 'H' or variable == 'kdown') and sa_analysis != True:
+        site_variables.append(variable)
+    if variable == 'H' or variable == 'BL_H':
+        site_variables.append('BL_H')
+    if variable == 'wind':
+        site_variables.append(variable)
+
+    # finds the files for all of these variables in one pass of the model store
+    if len(site_variables) != 0:
+        batch_index = find_model_files.find_UKV_files_batch(DOYstart_mod,
+                                                            DOYstop_mod,
+                                                            [site],
+                                                            'ukv',
+                                                            run,
+                                                            site_variables,
+                                                            model_path=model_path)
+
     if variable == 'H' or variable == 'kdown':
 
         if sa_analysis == True:
@@ -55,7 +87,8 @@ def retrieve_UKV(run_choices,
                 time=time,
                 sa_list=sa_list,
                 savepath=savepath,
-                csv_path=csv_dir)
+                csv_path=csv_dir,
+                store_path=sa_store_path(sa_store_dir, csv_dir))
 
             # hardcoding disheight here as 0. This is ok for now - as it's a surface stash code
             included_grids, model_site = ukv_values_from_SA_analysis.determine_which_model_files(model_site_dict,
@@ -64,7 +97,8 @@ def retrieve_UKV(run_choices,
                                                                                                  run,
                                                                                                  variable,
                                                                                                  0,
-                                                                                                 savepath)
+                                                                                                 savepath,
+                                                                                                 cache_dir=cache_dir)
 
             included_grids = ukv_values_from_SA_analysis.average_model_grids(included_grids,
                                                                              DOYstart_mod,
@@ -90,17 +124,7 @@ def retrieve_UKV(run_choices,
             model_site_dict = False
             percentage_vals_dict = False
 
-            file_dict_ukv = find_model_files.find_UKV_files(DOYstart_mod,
-                                                               DOYstop_mod,
-                                                               site,
-                                                               'ukv',
-                                                               run,
-                                                               variable,
-                                                               model_path="//rdg-home.ad.rdg.ac.uk/research-nfs/basic/micromet/Tier_processing/rv006011/new_data_storage/"
-                                                               # model_path='C:/Users/beths/OneDrive - University of Reading/local_runs_data/data_wifi_problems/data/'
-                                                               )
-
-            files_ukv = find_model_files.order_model_stashes(file_dict_ukv, variable)
+            files_ukv = find_model_files.align_stash_files(batch_index[site], variable)
 
             # height still hardcoded 0 as it's a surface stash code
             ukv = read_premade_model_files.extract_model_data(files_ukv,
@@ -111,34 +135,26 @@ def retrieve_UKV(run_choices,
                                                                  0,
                                                                  site,
                                                                  savepath,
-                                                                 grid_choice=grid_letter)
+                                                                 grid_choice=grid_letter,
+                                                                 columnar=True,
+                                                                 cache_dir=cache_dir,
+                                                                 memmap_dir=memmap_dir)
 
-            H_list = [ukv[5], ukv[6], ukv[0], ukv[1], ukv[10]]
-            included_H = {grid_number: H_list}
+            included_H = {grid_number: ukv}
 
             mod_time, mod_vals = read_premade_model_files.retrieve_arrays_model(included_H, grid_number)
             model_grid_vals[grid_number] = mod_vals
 
             if variable == 'kdown':
                 # push kdown vals forward by 15 mins - as model output is 15 min average time starting
-                model_grid_time[grid_number] = mod_time + dt.timedelta(minutes=15)
+                model_grid_time[grid_number] = mod_time + np.timedelta64(15, 'm')
 
             else:
                 model_grid_time[grid_number] = mod_time
 
     if variable == 'H' or variable == 'BL_H':  # even if var choice is just H, BL_H output is also currently included
 
-        file_dict_ukv_BL_H = find_model_files.find_UKV_files(DOYstart_mod,
-                                                                DOYstop_mod,
-                                                                site,
-                                                                'ukv',
-                                                                run,
-                                                                'BL_H',
-                                                                model_path="//rdg-home.ad.rdg.ac.uk/research-nfs/basic/micromet/Tier_processing/rv006011/new_data_storage/"
-                                                                # model_path='C:/Users/beths/OneDrive - University of Reading/local_runs_data/data_wifi_problems/data/'
-                                                                )
-
-        files_ukv_BL_H = find_model_files.order_model_stashes(file_dict_ukv_BL_H, 'BL_H')
+        files_ukv_BL_H = find_model_files.align_stash_files(batch_index[site], 'BL_H')
 
         # from scint_eval.functions import stats_of_BL_H
         # stats_of_BL_H.stats_BL_flux(files_ukv_13)
@@ -151,15 +167,17 @@ def retrieve_UKV(run_choices,
                                                                   run_choices['target_height'],
                                                                   site,
                                                                   savepath,
-                                                                  grid_choice=grid_letter)
+                                                                  grid_choice=grid_letter,
+                                                                  columnar=True,
+                                                                  cache_dir=cache_dir,
+                                                                  memmap_dir=memmap_dir)
 
-        BL_H_list = [ukv_BL_H[5], ukv_BL_H[6], ukv_BL_H[0], ukv_BL_H[1], ukv_BL_H[10]]
-        included_BL_H = {'BL_H': BL_H_list}
+        included_BL_H = {'BL_H': ukv_BL_H}
         mod_time, mod_vals = read_premade_model_files.retrieve_arrays_model(included_BL_H, 'BL_H')
         model_grid_vals['BL_H'] = mod_vals
         model_grid_time['BL_H'] = mod_time
 
-        BL_H_z = ukv_BL_H[10]
+        BL_H_z = ukv_BL_H['height_value']
 
         if variable == 'BL_H':
             model_site_dict = False
@@ -180,7 +198,8 @@ def retrieve_UKV(run_choices,
                 time=time,
                 sa_list=sa_list,
                 savepath=savepath,
-                csv_path=csv_dir)
+                csv_path=csv_dir,
+                store_path=sa_store_path(sa_store_dir, csv_dir))
 
             included_grids_kdown_all, model_site_kdown_all = ukv_values_from_SA_analysis.determine_which_model_files(
                 model_site_dict_all,
@@ -189,7 +208,8 @@ def retrieve_UKV(run_choices,
                 run,
                 variable,
                 0,
-                savepath)
+                savepath,
+                cache_dir=cache_dir)
 
             included_grids_kdown_all = ukv_values_from_SA_analysis.average_model_grids(included_grids_kdown_all,
                                                                                        DOYstart_mod,
@@ -223,17 +243,7 @@ def retrieve_UKV(run_choices,
 
     if variable == 'wind':
         # finding UKV files
-        file_dict_ukv_wind = find_model_files.find_UKV_files(DOYstart_mod,
-                                                             DOYstop_mod,
-                                                             site,
-                                                             'ukv',
-                                                             run,
-                                                             variable,
-                                                             model_path="//rdg-home.ad.rdg.ac.uk/research-nfs/basic/micromet/Tier_processing/rv006011/new_data_storage/"
-                                                             # model_path='C:/Users/beths/OneDrive - University of Reading/local_runs_data/data_wifi_problems/data/'
-                                                             )
-
-        files_ukv_wind = find_model_files.order_model_stashes(file_dict_ukv_wind, variable)
+        files_ukv_wind = find_model_files.align_stash_files(batch_index[site], variable)
 
         ukv_wind = read_premade_model_files.extract_model_data_wind(files_ukv_wind,
                                                                     DOYstart,
@@ -243,7 +253,8 @@ def retrieve_UKV(run_choices,
                                                                     run_choices['target_height'],
                                                                     site,
                                                                     savepath,
-                                                                    grid_choice=grid_letter)
+                                                                    grid_choice=grid_letter,
+                                                                    cache_dir=cache_dir)
 
         # define dict for included models
         included_models_ws = {}
@@ -277,6 +288,18 @@ def retrieve_UKV(run_choices,
             'percentage_vals_dict': percentage_vals_dict}
 
 
+def sa_store_path(sa_store_dir,
+                  csv_path):
+    """
+    :return: path of the SA grid percentages store for a csv, in sa_store_dir. False if sa_store_dir is False.
+    """
+
+    if not sa_store_dir:
+        return False
+
+    return os.path.join(sa_store_dir, os.path.splitext(os.path.basename(csv_path))[0] + '.sqlite')
+
+
 def UKV_df(ukv_data_dict,
            time_key='model_grid_time',
            val_key='model_grid_vals',
@@ -302,8 +325,8 @@ def UKV_df(ukv_data_dict,
             vals = UKV_vals[key]
             times = UKV_time[key]
 
-            df = pd.DataFrame.from_dict({'time': times, key: vals})
-            df = df.set_index('time')
+            # built on the arrays as they are (no copies), so memory-mapped series stay on disk
+            df = pd.DataFrame({key: vals}, index=pd.Index(times, name='time', copy=False), copy=False)
             list_of_UKV_df.append(df)
 
     else:
@@ -317,6 +340,9 @@ def UKV_df(ukv_data_dict,
             df = df.set_index('time')
             list_of_UKV_df.append(df)
 
-    UKV_df = pd.concat(list_of_UKV_df, axis=1)
+    if len(list_of_UKV_df) == 1:
+        UKV_df = list_of_UKV_df[0]
+    else:
+        UKV_df = pd.concat(list_of_UKV_df, axis=1)
 
     return UKV_df
@@ -0,0 +1,136 @@
+import os
+import re
+import datetime as dt
+import pandas as pd
+
+from model_eval_tools.sa_analysis_grids import ukv_values_from_SA_analysis
+
+# footprint file names end with the year, DOY, hour and (optionally) minute: e.g. BCT_IMU_15000_2016_142_05_00.tif
+footprint_name_pattern = re.compile(r'^(?P<name_start>.*?)(?P<year>\d{4})_(?P<DOY>\d{3})_(?P<hour>\d{2})'
+                                    r'(?:_(?P<minute>\d{2}))?\.tif$')
+
+
+def footprint_time(filename):
+    """
+    Gets the time of a footprint from its file name.
+    :param filename: footprint tif file name
+    :return: datetime, or None if the name isn't of a footprint
+    """
+
+    name_match = footprint_name_pattern.match(filename)
+
+    if name_match is None:
+        return None
+
+    minute = name_match.group('minute') or '00'
+
+    return dt.datetime.strptime(name_match.group('year') + name_match.group('DOY') + name_match.group('hour') + minute,
+                                '%Y%j%H%M')
+
+
+def scan_footprints(in_dir='C:/Users/beths/OneDrive - University of Reading/local_runs_data/fp_output/',
+                    name_start=False,
+                    DOYstart=False,
+                    DOYstop=False):
+    """
+    Finds all footprint tifs in a directory tree (e.g. fp_output/<DOY>/hourly/ for many days).
+    :param in_dir: top directory
+    :param name_start: if given, only files starting with this are used (e.g. 'BCT_IMU_15000_')
+    :param DOYstart: if given, only footprints from this day (YYYYjjj) on are used
+    :param DOYstop: if given, only footprints up to the end of this day (YYYYjjj) are used
+    :return: time - list of datetimes of the footprints (sorted), sa_list - list of their paths
+    """
+
+    footprints = {}
+
+    for dir_path, dir_names, filenames in os.walk(in_dir):
+        dir_names.sort()
+
+        for filename in sorted(filenames):
+            if name_start and not filename.startswith(name_start):
+                continue
+
+            hour = footprint_time(filename)
+
+            if hour is None:
+                continue
+
+            if DOYstart and int(hour.strftime('%Y%j')) < DOYstart:
+                continue
+            if DOYstop and int(hour.strftime('%Y%j')) > DOYstop:
+                continue
+
+            sa_path = os.path.join(dir_path, filename).replace('\\', '/')
+
+            # one footprint per time
+            if hour in footprints:
+                print('More than one footprint for ' + hour.strftime('%Y %j %H:%M') + ', using: ', footprints[hour])
+                print('not: ', sa_path)
+                continue
+
+            footprints[hour] = sa_path
+
+    time = sorted(footprints)
+    sa_list = [footprints[hour] for hour in time]
+
+    print('Footprints found: ' + str(len(time)))
+
+    return time, sa_list
+
+
+def ingest_footprints(savepath,
+                      in_dir='C:/Users/beths/OneDrive - University of Reading/local_runs_data/fp_output/',
+                      name_start=False,
+                      DOYstart=False,
+                      DOYstop=False,
+                      csv_path='../sa_analysis_grids/ukv_grid_sa_percentages.csv',
+                      store_path=False,
+                      n_workers=1,
+                      weights_csv=False):
+    """
+    Finds the SA grid percentages of all footprints in a directory tree, as one job, and puts them in one
+    hour x grid matrix of weights.
+    Hours already in the csv (or store) aren't calculated again (see
+    ukv_values_from_SA_analysis.prepare_model_grid_percentages).
+    See scan_footprints for:
+    :param in_dir:
+    :param name_start:
+    :param DOYstart:
+    :param DOYstop:
+    See ukv_values_from_SA_analysis.prepare_model_grid_percentages for:
+    :param savepath:
+    :param csv_path:
+    :param store_path:
+    :param n_workers:
+    :param weights_csv: if given, the weights matrix is saved to this csv
+    :return: dict of 'weights' - DataFrame of the percentage of each grid (columns 1 - 42, 0 if not in the SA) for
+        each hour (index), 'calculated_sum' - Series of the % of each hour's SA in the grids, and 'model_site_dict',
+        'percentage_vals_dict' (as from prepare_model_grid_percentages)
+    """
+
+    time, sa_list = scan_footprints(in_dir, name_start, DOYstart, DOYstop)
+
+    model_site_dict, percentage_vals_dict, percentage_covered_by_model = \
+        ukv_values_from_SA_analysis.prepare_model_grid_percentages(time=time,
+                                                                   sa_list=sa_list,
+                                                                   savepath=savepath,
+                                                                   csv_path=csv_path,
+                                                                   n_workers=n_workers,
+                                                                   store_path=store_path)
+
+    weights_df, included_df = ukv_values_from_SA_analysis.percentage_matrix(percentage_vals_dict, model_site_dict)
+    weights_df = weights_df.reindex(columns=range(1, 43), fill_value=0.0)
+    weights_df.index.name = 'hour'
+
+    calculated_sum = pd.Series(percentage_covered_by_model, dtype=float)
+    calculated_sum.index = pd.to_datetime(calculated_sum.index, format='%y%m%d%H')
+    calculated_sum = calculated_sum.reindex(weights_df.index)
+
+    if weights_csv:
+        weights_df.to_csv(weights_csv)
+        print('weights saved to: ', weights_csv)
+
+    return {'weights': weights_df,
+            'calculated_sum': calculated_sum,
+            'model_site_dict': model_site_dict,
+            'percentage_vals_dict': percentage_vals_dict}
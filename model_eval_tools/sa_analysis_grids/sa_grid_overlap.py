@@ -3,116 +3,370 @@ import numpy  # the array computation library
 import geopandas  # the GEOS-based vector package
 import matplotlib.pyplot as plt  # the visualization package
 import numpy as np
-from rasterio.mask import mask
+from rasterio.features import rasterize
+from rasterio.windows import Window
 import pylab
 import matplotlib as mpl
 import pandas as pd
+import os
 
+from model_eval_tools.retrieve_UKV import extraction_cache
+from model_eval_tools.sa_analysis_grids import ukv_grid_geometries
 
-def SA_grid_percentages(raster_path, save_path, time_string):
+
+# label rasters most recently used in this process: {key: label raster}, oldest first
+grid_label_cache = {}
+
+# most label rasters kept in grid_label_cache (each can be as large as a footprint)
+grid_label_cache_size = 4
+
+# rasters with more pixels than this are read in strips of rows, so the whole raster is never in memory at once
+footprint_max_pixels = 50 * 1000 ** 2
+
+# most pixels of a raster shown in the plot of a raster read in strips (it's read at a lower resolution for the plot)
+plot_max_pixels = 4 * 1000 ** 2
+
+
+def SA_grid_percentages(raster_path,
+                        save_path,
+                        time_string,
+                        gpkg_dir_path=ukv_grid_geometries.gpkg_dir_path,
+                        label_cache_dir=False,
+                        plot=True,
+                        grid_geometries=False,
+                        max_pixels=footprint_max_pixels):
     """
     A function to return the percentages from a a scintillometry SA raster file which fall within the UKV grid
     network in Model Eval
+    The raster is read once (see footprint_grid_sums): the total and the sum in each grid are taken from the same read.
     :param raster_path: A path to the raster file
-    :return:
+    :param save_path: where the plot is saved
+    :param time_string: used in the plot name
+    :param gpkg_dir_path: directory of the grid GeoPackage files (1.gpkg - 42.gpkg)
+    :param label_cache_dir: directory to save label rasters in, so they're only made once for each raster grid.
+        If False, they are only kept in memory.
+    :param plot: if True, a plot of the raster and grids is saved
+    :param grid_geometries: from ukv_grid_geometries.load_grid_geometries. If False, loaded from gpkg_dir_path (only
+        read once per process).
+    :param max_pixels: rasters with more pixels than this are read in strips of rows
+    :return: grid_vals - {grid number: % of the SA in the grid (nan if the grid has no pixels in the raster)},
+        calculated_sum - % of the SA in all the grids
     """
 
     # help from https://pysal.org/scipy2019-intermediate-gds/deterministic/gds2-rasters.html
 
-    raster = rasterio.open(raster_path)
-    SA_data = raster.read(1)
+    if not grid_geometries:
+        grid_geometries = ukv_grid_geometries.load_grid_geometries(gpkg_dir_path)
 
-    # value of the total values across all of the raster
-    total_SA_sum = np.nansum(SA_data)
+    with rasterio.open(raster_path) as raster:
+        grid_sums = footprint_grid_sums(raster, grid_geometries, label_cache_dir, max_pixels)
 
-    # construct the extent: raster.bounds
-    # matplotlib and geographic packages like rasterio and geopandas use different ordering conventions for
-    # their bounding box information.
-    # geographic information systems (bounds): (west, south, north, east)
-    # matplotlib (extent): (west, east, south, north)
-    # re-arrange the raster.bounds to extent form, expected by matplotlib:
-    raster_extent = numpy.asarray(raster.bounds)[[0, 2, 1, 3]]
+        # construct the extent: raster.bounds
+        # matplotlib and geographic packages like rasterio and geopandas use different ordering conventions for
+        # their bounding box information.
+        # geographic information systems (bounds): (west, south, north, east)
+        # matplotlib (extent): (west, east, south, north)
+        # re-arrange the raster.bounds to extent form, expected by matplotlib:
+        raster_extent = numpy.asarray(raster.bounds)[[0, 2, 1, 3]]
 
-    # Subsetting the raster
-    # To focus the raster down to a grid, we can use the grid data, which we converted into geographic information
-    gpkg_dir_path = 'C:/Users/beths/OneDrive - University of Reading/UKV_grid_objects/grid_gpkg_files/'
+        if plot:
+            SA_data = grid_sums['SA_data']
 
-    # plotting all grids against raster data
-    f = plt.figure(figsize=(20, 20))
+            # a raster read in strips is read again at a lower resolution for the plot
+            if SA_data is None:
+                plot_step = int(np.ceil(np.sqrt(raster.height * raster.width / plot_max_pixels)))
+                SA_data = raster.read(1, out_shape=(max(1, raster.height // plot_step),
+                                                    max(1, raster.width // plot_step)))
 
-    # SA_data = np.ma.masked_where(SA_data < (total_SA_sum / 10000), SA_data)
-    cmap = mpl.cm.jet
-    cmap.set_bad('white', 1.)
-    plt.imshow(SA_data, interpolation='none', cmap=cmap, extent=raster_extent)
+    # value of the total values across all of the raster
+    total_SA_sum = grid_sums['total_SA_sum']
 
-    # plt.colorbar(im, orientation='horizontal', pad=0.1)
+    summed_vals = grid_sums['summed_vals']
+    grid_pixels = grid_sums['grid_pixels']
 
     # makes list to see total value outside loop
     grid_vals = {}
 
     for i in range(1, 43):
+        if grid_pixels[i] == 0:
+            # the grid has no overlap of raster
+            grid_vals[i] = np.nan
+        else:
+            # as a percentage of the total raster, and rounded to 4 sig fig.
+            grid_vals[i] = round((summed_vals[i] / total_SA_sum) * 100, 4)
 
-        grid_num = str(i)
-        gpkg_file_name = grid_num + '.gpkg'
+    calculated_sum_list = []
+    for grid in sorted(grid_vals):
+        calculated_sum_list.append(grid_vals[grid])
 
-        gpkg_file = gpkg_dir_path + gpkg_file_name
-        grid_gpkg = geopandas.read_file(gpkg_file)
+    # sum calculated by adding the sums of all individual grids
+    calculated_sum = np.nansum(calculated_sum_list)
 
-        # bounding box for our grid is the total_bounds of our grid dataframe:
-        grid_bbox = grid_gpkg.total_bounds
+    if plot:
+        # plotting all grids against raster data
+        f = plt.figure(figsize=(20, 20))
 
-        # Subsetting raster data
-        # takes the coordinates from a bounding box and provides a rasterio.windows.Window object.
-        # We can use it directly from our grid_bbox data using *, the unpack operator
-        grid_window = raster.window(*grid_bbox)
+        cmap = mpl.cm.jet
+        cmap.set_bad('white', 1.)
+        plt.imshow(SA_data, interpolation='none', cmap=cmap, extent=raster_extent)
 
-        # Now, when we read() in our data, we can use this rasterio.windows.Window object to only read
-        # the data we want to analyze: that within the bounds of the grid:
-        grid_SA_data = raster.read(1, window=grid_window)
+        grids_gdf = geopandas.GeoSeries(list(grid_geometries['geometries']), crs=grid_geometries['crs'])
+        grids_gdf.boundary.plot(ax=plt.gca(), color='skyblue')
 
-        # adding to the all grid plot
-        grid_gpkg.boundary.plot(ax=plt.gca(), color='skyblue')
+        pylab.savefig(save_path + 'raster_grids_' + time_string + '.png', bbox_inches='tight')
 
-        # Summing the SA data within the grid box
-        # implementing zonal statistics using rasterio mask
-        grid_geometry = grid_gpkg.geometry
+        plt.close('all')
 
-        # try except Value error here because ValueError occurs when the grid has no overlap of raster
-        try:
-            masked, mask_transform = mask(dataset=raster,
-                                          shapes=grid_geometry, crop=True,
-                                          all_touched=False,
-                                          filled=False)
+    return grid_vals, calculated_sum
 
-            # The mask function returns an array with the shape (n_bands, n_rows, n_columns).
-            # Thus, when working with a single band, the mask function will output an array that has an 'extra'
-            # dimension; the array will be three-dimensional despite the output only having two effective dimensions.
-            # So, we must use squeeze() to remove extra dimensions that only have one element
-            masked = masked.squeeze()
 
-            # summing the values in this grid
-            summed_val = np.nansum(masked)
-            # as a percentage of the total raster, and rounded to 4 sig fig.
-            grid_sum = round((summed_val / total_SA_sum) * 100, 4)
+def footprint_grid_sums(raster,
+                        grid_geometries,
+                        label_cache_dir=False,
+                        max_pixels=footprint_max_pixels):
+    """
+    Reads a footprint raster once, and takes its total and the sum in each grid from what is read.
+    Rasters up to max_pixels are read whole. Larger rasters are read in strips of rows, each summed and then
+    discarded, with the labels of each strip read from the saved label raster (opened memory-mapped) if
+    label_cache_dir is given, or made for the strip if not.
+    :param raster: open rasterio dataset
+    :param grid_geometries: from ukv_grid_geometries.load_grid_geometries
+    :param label_cache_dir: directory of saved label rasters (see grid_label_raster)
+    :param max_pixels: rasters with more pixels than this are read in strips
+    :return: dict of 'total_SA_sum' - nansum of the whole raster, 'summed_vals' - sum of the SA in each grid (index is
+        the grid number, 0 is outside all grids), 'grid_pixels' - number of pixels in each grid, 'SA_data' - the
+        raster (None if it was read in strips)
+    """
 
-        except ValueError:
-            # traceback.print_exc()
-            grid_sum = np.nan
+    if raster.height * raster.width <= max_pixels:
+        SA_data = raster.read(1)
 
-        grid_vals[i] = grid_sum
+        labels = grid_label_raster(raster, grid_geometries, label_cache_dir)
 
-    calculated_sum_list = []
-    for grid in sorted(grid_vals):
-        calculated_sum_list.append(grid_vals[grid])
+        grid_sums = grid_tile_sums(SA_data, labels, raster.nodata)
+        grid_sums['SA_data'] = SA_data
 
-    # sum calculated by adding the sums of all individual grids
-    calculated_sum = np.nansum(calculated_sum_list)
+        return grid_sums
 
-    pylab.savefig(save_path + 'raster_grids_' + time_string + '.png', bbox_inches='tight')
+    if label_cache_dir:
+        labels = grid_label_raster(raster, grid_geometries, label_cache_dir, max_pixels=max_pixels)
+    else:
+        labels = None
+        shapes = grid_label_shapes(raster, grid_geometries)
 
-    plt.close('all')
+    total_SA_sum = 0.0
+    summed_vals = np.zeros(43)
+    grid_pixels = np.zeros(43, dtype=np.int64)
 
-    return grid_vals, calculated_sum
+    for window in footprint_windows(raster, max_pixels):
+        SA_tile = raster.read(1, window=window)
+
+        if labels is not None:
+            tile_labels = labels[window.row_off:window.row_off + window.height]
+        else:
+            tile_labels = rasterize_grids(shapes, SA_tile.shape, raster.window_transform(window))
+
+        tile_sums = grid_tile_sums(SA_tile, tile_labels, raster.nodata)
+
+        total_SA_sum += tile_sums['total_SA_sum']
+        summed_vals += tile_sums['summed_vals']
+        grid_pixels += tile_sums['grid_pixels']
+
+    return {'total_SA_sum': total_SA_sum, 'summed_vals': summed_vals, 'grid_pixels': grid_pixels, 'SA_data': None}
+
+
+def grid_tile_sums(SA_data,
+                   labels,
+                   nodata=None):
+    """
+    Sums a raster (or a strip of one) in each grid, in one pass with np.bincount.
+    :param SA_data: raster values
+    :param labels: label raster of the same shape (see grid_label_raster)
+    :param nodata: nodata value of the raster
+    :return: dict of 'total_SA_sum', 'summed_vals', 'grid_pixels' (see footprint_grid_sums)
+    """
+
+    # value of the total values across all of the raster
+    total_SA_sum = np.nansum(SA_data)
+
+    # nan and nodata pixels aren't counted in any grid
+    grid_SA_data = np.where(np.isnan(SA_data), 0, SA_data)
+    if nodata is not None:
+        grid_SA_data = np.where(SA_data == nodata, 0, grid_SA_data)
+
+    labels = np.asarray(labels).ravel()
+
+    # summing the SA data within each grid box: label 0 is outside all grids
+    summed_vals = np.bincount(labels, weights=grid_SA_data.ravel().astype(np.float64), minlength=43)
+    grid_pixels = np.bincount(labels, minlength=43)
+
+    return {'total_SA_sum': total_SA_sum, 'summed_vals': summed_vals, 'grid_pixels': grid_pixels}
+
+
+def footprint_windows(raster,
+                      max_pixels=footprint_max_pixels):
+    """
+    Splits a raster into strips of whole rows, of at most max_pixels each (at least one row).
+    :return: list of rasterio windows
+    """
+
+    rows_per_strip = max(1, max_pixels // raster.width)
+
+    return [Window(0, row_off, raster.width, min(rows_per_strip, raster.height - row_off))
+            for row_off in range(0, raster.height, rows_per_strip)]
+
+
+def grid_label_raster(raster,
+                      grid_geometries,
+                      label_cache_dir=False,
+                      max_pixels=False):
+    """
+    Makes a label raster for a raster's grid: the number of the UKV grid (1 - 42) each pixel is in, 0 if none.
+    A pixel is in a grid if its centre is (as rasterio.mask.mask with all_touched=False).
+    Label rasters are saved to label_cache_dir if given, so each is only made once for rasters on the same grid
+    (transform, shape and crs) with the same grid files. The last few used (grid_label_cache_size) are also kept in
+    memory: memory-mapped from the saved file if there is one, so processes share it rather than each holding a copy.
+    :param raster: open rasterio dataset
+    :param grid_geometries: from ukv_grid_geometries.load_grid_geometries
+    :param label_cache_dir: directory to save label rasters in. False to only keep them in memory.
+    :param max_pixels: for rasters too large to hold in memory: the label raster is made in strips of this many pixels
+        straight into the saved file, and returned memory-mapped (not kept in memory). Needs label_cache_dir.
+    :return: uint8 array with the shape of the raster
+    """
+
+    if grid_geometries['key']:
+        key = extraction_cache.cache_key([], [grid_geometries['key'], tuple(raster.transform), raster.shape,
+                                              raster.crs])
+    else:
+        key = False
+
+    if label_cache_dir and key:
+        label_path = os.path.join(label_cache_dir, 'grid_labels_' + key + '.npy')
+    else:
+        label_path = False
+
+    if key in grid_label_cache:
+        # moved to the end, as the most recently used
+        labels = grid_label_cache.pop(key)
+        grid_label_cache[key] = labels
+
+        # made without label_cache_dir: saved now, so other processes and later runs don't make it again
+        if label_path and not os.path.isfile(label_path):
+            save_grid_labels(labels, label_path)
+            labels = np.load(label_path, mmap_mode='r')
+            grid_label_cache[key] = labels
+
+        return labels
+
+    if label_path:
+        if os.path.isfile(label_path):
+            labels = np.load(label_path, mmap_mode='r')
+            keep_grid_labels(key, labels)
+            return labels
+
+    shapes = grid_label_shapes(raster, grid_geometries)
+
+    if max_pixels and label_path:
+        if not os.path.isdir(label_cache_dir):
+            os.makedirs(label_cache_dir, exist_ok=True)
+
+        # written to a temporary file first, so other processes never read a half written file
+        temp_path = label_path + '.' + str(os.getpid()) + '.tmp'
+        labels = np.lib.format.open_memmap(temp_path, mode='w+', dtype='uint8', shape=raster.shape)
+
+        for window in footprint_windows(raster, max_pixels):
+            labels[window.row_off:window.row_off + window.height] = rasterize_grids(
+                shapes, (window.height, window.width), raster.window_transform(window))
+
+        labels.flush()
+        del labels
+        os.replace(temp_path, label_path)
+
+        labels = np.load(label_path, mmap_mode='r')
+        keep_grid_labels(key, labels)
+        return labels
+
+    labels = rasterize_grids(shapes, raster.shape, raster.transform)
+
+    if label_path:
+        save_grid_labels(labels, label_path)
+
+        # the saved file is kept memory-mapped instead of the array made here
+        labels = np.load(label_path, mmap_mode='r')
+
+    if key:
+        keep_grid_labels(key, labels)
+
+    return labels
+
+
+def save_grid_labels(labels,
+                     label_path):
+    """
+    Saves a label raster to label_path (.npy), making its directory if needed.
+    :param labels: label raster
+    :param label_path: path of the file
+    :return:
+    """
+
+    label_dir = os.path.dirname(label_path)
+    if label_dir and not os.path.isdir(label_dir):
+        os.makedirs(label_dir, exist_ok=True)
+
+    # written to a temporary file first, so other processes never read a half written file
+    temp_path = label_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as temp_file:
+        np.save(temp_file, labels)
+    os.replace(temp_path, label_path)
+
+
+def keep_grid_labels(key,
+                     labels):
+    """
+    Adds a label raster to grid_label_cache, removing the least recently used once there are more than
+    grid_label_cache_size.
+    :param key: key of the label raster (from grid_label_raster)
+    :param labels: label raster
+    :return:
+    """
+
+    grid_label_cache[key] = labels
+
+    while len(grid_label_cache) > grid_label_cache_size:
+        del grid_label_cache[next(iter(grid_label_cache))]
+
+
+def grid_label_shapes(raster,
+                      grid_geometries):
+    """
+    :return: list of (geometry, grid number) of the grids which overlap a raster, for rasterize_grids
+    """
+
+    grid_indexes = ukv_grid_geometries.grids_in_bounds(grid_geometries, raster.bounds)
+
+    return [(grid_geometries['geometries'][i], int(grid_geometries['grid_numbers'][i])) for i in grid_indexes]
+
+
+def rasterize_grids(shapes,
+                    out_shape,
+                    transform):
+    """
+    Burns grid numbers into a label raster (0 outside all grids).
+    :param shapes: from grid_label_shapes
+    :param out_shape: shape of the raster (or strip)
+    :param transform: transform of the raster (or strip)
+    :return: uint8 array
+    """
+
+    if len(shapes) == 0:
+        return np.zeros(out_shape, dtype='uint8')
+
+    return rasterize(shapes,
+                     out_shape=out_shape,
+                     transform=transform,
+                     fill=0,
+                     all_touched=False,
+                     dtype='uint8')
 
 
 if __name__ == "__main__":
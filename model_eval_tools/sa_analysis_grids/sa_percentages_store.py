@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# columns of the store, as in ukv_grid_sa_percentages.csv: hour, calculated_sum, then the percentage of each grid
+store_columns = ['hour', 'calculated_sum'] + [str(i) for i in range(1, 43)]
+
+# most hours looked up in one query (sqlite has a limit on the number of parameters)
+query_batch_size = 500
+
+
+def open_store(store_path,
+               csv_path=False):
+    """
+    Opens a store of SA grid percentages: an sqlite database with one row per hour, looked up by its hour key
+    ('%y%m%d%H'). Made if it doesn't exist, with the rows of csv_path if given.
+    :param store_path: path of the store
+    :param csv_path: csv of grid percentages (e.g. ukv_grid_sa_percentages.csv) to fill a new store from
+    :return: sqlite3 connection. Close when done.
+    """
+
+    new_store = not os.path.isfile(store_path)
+
+    store_dir = os.path.dirname(store_path)
+    if store_dir and not os.path.isdir(store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+
+    # waits for other processes writing to the store
+    store = sqlite3.connect(store_path, timeout=60)
+
+    grid_columns = ', '.join('"' + column + '" REAL' for column in store_columns[2:])
+    with store:
+        store.execute('CREATE TABLE IF NOT EXISTS grid_percentages '
+                      '(hour TEXT PRIMARY KEY, calculated_sum REAL, ' + grid_columns + ')')
+
+    if new_store and csv_path and os.path.isfile(csv_path):
+        import_csv(store, csv_path)
+
+    return store
+
+
+def import_csv(store,
+               csv_path):
+    """
+    Adds the rows of a grid percentages csv to the store. Blank rows are skipped, and hours already in the store are
+    kept (as the first row of an hour is the one used from a csv).
+    :param store: from open_store
+    :param csv_path: csv of grid percentages
+    :return: number of rows added
+    """
+
+    csv_df = pd.read_csv(csv_path)
+    csv_df = csv_df[csv_df.hour.notna()]
+
+    rows = csv_df[store_columns].to_numpy(dtype=float)
+
+    return append_rows(store, rows)
+
+
+def hour_key(hour_value):
+    """
+    :param hour_value: hour as written in the first column of a row (e.g. 16052112 or 16052112.0)
+    :return: hour key string ('%y%m%d%H')
+    """
+
+    return str(int(hour_value)).zfill(8)
+
+
+def append_rows(store,
+                rows):
+    """
+    Adds rows to the store, all in one transaction: either all rows are added or none are.
+    Hours already in the store are kept.
+    :param store: from open_store
+    :param rows: list of rows (see ukv_values_from_SA_analysis.grid_percentage_row): hour, calculated_sum, then the
+        percentage of each grid 1 - 42
+    :return: number of rows added
+    """
+
+    if len(rows) == 0:
+        return 0
+
+    values = []
+    for row in rows:
+        row_values = [hour_key(row[0])]
+        for value in row[1:]:
+            row_values.append(None if np.isnan(value) else float(value))
+        values.append(row_values)
+
+    placeholders = ', '.join(['?'] * len(store_columns))
+
+    with store:
+        before = store.total_changes
+        store.executemany('INSERT OR IGNORE INTO grid_percentages VALUES (' + placeholders + ')', values)
+        added = store.total_changes - before
+
+    return added
+
+
+def read_hours(store,
+               time_keys):
+    """
+    Looks up hours in the store.
+    :param store: from open_store
+    :param time_keys: list of hour keys ('%y%m%d%H')
+    :return: {hour key: [model_site, percentage_vals, calculated_sum]} for the hours in the store, where model_site is
+        the list of grids (strings) with a percentage, and percentage_vals their percentages
+    """
+
+    time_keys = sorted(set(time_keys))
+
+    stored_hours = {}
+
+    for start in range(0, len(time_keys), query_batch_size):
+        batch = time_keys[start:start + query_batch_size]
+
+        cursor = store.execute('SELECT * FROM grid_percentages WHERE hour IN (' + ', '.join(['?'] * len(batch)) + ')',
+                               batch)
+
+        for row in cursor:
+            calculated_sum = np.nan if row[1] is None else row[1]
+            grid_values = [np.nan if value is None else value for value in row[2:]]
+
+            # grids with no overlap are 0
+            model_site = [grid for grid, value in zip(store_columns[2:], grid_values) if value != 0]
+            percentage_vals = [value for value in grid_values if value != 0]
+
+            stored_hours[row[0]] = [model_site, percentage_vals, calculated_sum]
+
+    return stored_hours
+
+
+def export_csv(store,
+               csv_path):
+    """
+    Writes the whole store to a csv, in the layout of ukv_grid_sa_percentages.csv (rows in the order they were added).
+    The csv is replaced in one step, so it is never left half written.
+    :param store: from open_store
+    :param csv_path: path of the csv
+    :return: number of rows written
+    """
+
+    store_df = pd.read_sql_query('SELECT * FROM grid_percentages ORDER BY rowid', store)
+    store_df['hour'] = store_df['hour'].astype(int)
+
+    temp_path = csv_path + '.' + str(os.getpid()) + '.tmp'
+    store_df.to_csv(temp_path, index=False)
+    os.replace(temp_path, csv_path)
+
+    return len(store_df)
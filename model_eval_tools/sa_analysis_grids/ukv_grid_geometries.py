@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import geopandas
+import shapely
+
+from model_eval_tools.retrieve_UKV import extraction_cache
+
+# grid GeoPackage files: 1.gpkg - 42.gpkg
+gpkg_dir_path = 'C:/Users/beths/OneDrive - University of Reading/UKV_grid_objects/grid_gpkg_files/'
+
+# grid geometries already loaded in this process: {key: grid geometries}
+grid_geometry_cache = {}
+
+
+def load_grid_geometries(gpkg_dir_path=gpkg_dir_path,
+                         consolidated_path=False):
+    """
+    Loads the polygons of all 42 UKV grids, once per process: later calls return the same loaded geometries (unless the
+    files have changed).
+    :param gpkg_dir_path: directory of the grid GeoPackage files (1.gpkg - 42.gpkg)
+    :param consolidated_path: a single file of all grids, from consolidate_grid_geometries. Used instead of
+        gpkg_dir_path if given.
+    :return: dict of:
+        'grid_numbers' - array of grid numbers (1 - 42),
+        'geometries' - array of the shapely geometry of each grid (in the order of grid_numbers),
+        'bounds' - (42, 4) array of the bounds of each grid (minx, miny, maxx, maxy),
+        'tree' - shapely STRtree of the geometries (query results are indexes into grid_numbers),
+        'crs' - crs of the geometries,
+        'key' - identifies the files the geometries came from
+    """
+
+    if consolidated_path:
+        source_paths = [consolidated_path]
+    else:
+        source_paths = [gpkg_dir_path + str(i) + '.gpkg' for i in range(1, 43)]
+
+    key = extraction_cache.cache_key(source_paths, ['ukv_grid_geometries'])
+
+    if key and key in grid_geometry_cache:
+        return grid_geometry_cache[key]
+
+    if consolidated_path:
+        grids_gdf = geopandas.read_file(consolidated_path)
+        crs = grids_gdf.crs
+
+        grid_numbers = np.unique(grids_gdf['GRID_NUM'].astype(int))
+        geometries = [shapely.union_all(grids_gdf.geometry[grids_gdf['GRID_NUM'].astype(int) == grid].values)
+                      for grid in grid_numbers]
+
+    else:
+        grid_numbers = np.arange(1, 43)
+        geometries = []
+        crs = None
+        for gpkg_file in source_paths:
+            grid_gpkg = geopandas.read_file(gpkg_file)
+            crs = grid_gpkg.crs
+            geometries.append(shapely.union_all(grid_gpkg.geometry.values))
+
+    geometries = np.asarray(geometries, dtype=object)
+
+    grid_geometries = {'grid_numbers': grid_numbers,
+                       'geometries': geometries,
+                       'bounds': shapely.bounds(geometries),
+                       'tree': shapely.STRtree(geometries),
+                       'crs': crs,
+                       'key': key}
+
+    if key:
+        grid_geometry_cache[key] = grid_geometries
+
+    return grid_geometries
+
+
+def consolidate_grid_geometries(consolidated_path,
+                                gpkg_dir_path=gpkg_dir_path):
+    """
+    Writes all 42 grid GeoPackages to one file (one row per grid, with its number in GRID_NUM), which is quicker to load.
+    :param consolidated_path: file to write (e.g. 'ukv_grids.gpkg')
+    :param gpkg_dir_path: directory of the grid GeoPackage files (1.gpkg - 42.gpkg)
+    :return:
+    """
+
+    grid_geometries = load_grid_geometries(gpkg_dir_path)
+
+    grids_gdf = geopandas.GeoDataFrame({'GRID_NUM': grid_geometries['grid_numbers']},
+                                       geometry=list(grid_geometries['geometries']),
+                                       crs=grid_geometries['crs'])
+
+    consolidated_dir = os.path.dirname(consolidated_path)
+    if consolidated_dir and not os.path.isdir(consolidated_dir):
+        os.makedirs(consolidated_dir, exist_ok=True)
+
+    grids_gdf.to_file(consolidated_path, driver='GPKG')
+
+
+def grids_in_bounds(grid_geometries,
+                    bounds):
+    """
+    Finds the grids which intersect a bounding box, using the spatial index.
+    :param grid_geometries: from load_grid_geometries
+    :param bounds: (minx, miny, maxx, maxy), e.g. the bounds of a raster
+    :return: array of the indexes (into grid_geometries['grid_numbers']) of the grids, sorted
+    """
+
+    return np.sort(grid_geometries['tree'].query(shapely.box(*bounds), predicate='intersects'))
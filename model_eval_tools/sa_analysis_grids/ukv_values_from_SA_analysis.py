@@ -1,11 +1,14 @@
 import numpy as np
 import pandas as pd
 import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from model_eval_tools import look_up
 from model_eval_tools.retrieve_UKV import find_model_files
 from model_eval_tools.retrieve_UKV import read_premade_model_files
 from model_eval_tools.sa_analysis_grids import sa_grid_overlap
+from model_eval_tools.sa_analysis_grids import sa_percentages_store
 
 
 def append_grids_to_csv(time_key,
@@ -18,8 +21,17 @@ def append_grids_to_csv(time_key,
     :return:
     """
 
-    # reads the csv
-    existing_df = pd.read_csv(csv_path)
+    append_grid_rows_to_csv([grid_percentage_row(time_key, model_site, percentage_vals, calculated_sum)], csv_path)
+
+
+def grid_percentage_row(time_key,
+                        model_site,
+                        percentage_vals,
+                        calculated_sum):
+    """
+    Makes the csv row of one hour: hour, calculated_sum, then the percentage of each grid (1 - 42, 0 if not in the SA)
+    :return: array of the row
+    """
 
     # creates array of 0's with the same length as time, calculated_sum, then number of grids (42) - total = 44
     zeros_array = np.zeros(44)
@@ -34,18 +46,36 @@ def append_grids_to_csv(time_key,
         # get the index of where the percentage is going to go in the dataframe
         # this would normally be - take away 1 from the grid (grid 1 - 42 = index 0 - 41)
         # but as I have time as my first index, then WD, then L, so I am adding 2
-        index = grid + 1
+        index = int(grid) + 1
 
         # replace the zero in the array with the correct percent for grids which have a value here
         zeros_array[index] = percent
 
+    return zeros_array
+
+
+def append_grid_rows_to_csv(rows,
+                            csv_path='../sa_analysis_grids/ukv_grid_sa_percentages.csv'):
+    """
+    Appends rows from grid_percentage_row to the csv, all at once (the csv is read and written once).
+    :param rows: list of rows
+    :param csv_path: path to the csv
+    :return:
+    """
+
+    if len(rows) == 0:
+        return
+
+    # reads the csv
+    existing_df = pd.read_csv(csv_path)
+
     # creates coloumn names for the dataframe: hour, then grid numbers
     column_list = ['hour', 'calculated_sum']
     for i in range(1, 43):
         column_list.append(str(i))
 
     # creates dataframe object
-    dfObj = pd.DataFrame([zeros_array], columns=column_list)
+    dfObj = pd.DataFrame(rows, columns=column_list)
 
     # combines the old and new dataframe
     new_df = pd.concat([existing_df, dfObj])
@@ -57,15 +87,38 @@ def append_grids_to_csv(time_key,
 def prepare_model_grid_percentages(time,
                                    sa_list,
                                    savepath,
-                                   csv_path='../sa_analysis_grids/ukv_grid_sa_percentages.csv'):
+                                   csv_path='../sa_analysis_grids/ukv_grid_sa_percentages.csv',
+                                   n_workers=1,
+                                   store_path=False):
     """
     Function which goes through each observation source area (SA) and determines calls other functions which determine
     the percentage ovserlap between SA and model grid.
+    Hours already in the csv are read from it. The rest are calculated (see sa_grid_overlap.SA_grid_percentages),
+    and added to the csv all at once at the end.
+    :param n_workers: number of processes used to calculate the hours not in the csv. If 1, hours are calculated one
+        after the other.
+    :param store_path: if given, an sqlite store (see sa_percentages_store) is used instead of the csv. A new store is
+        filled from csv_path first. The csv isn't changed: see sa_percentages_store.export_csv.
     :return:
     """
 
-    # reads the csv
-    existing_df = pd.read_csv(csv_path)
+    if store_path:
+        store = sa_percentages_store.open_store(store_path, csv_path)
+        stored_hours = sa_percentages_store.read_hours(store, [hour.strftime("%y%m%d%H")
+                                                               for hour, sa in zip(time, sa_list)])
+        existing_index = {}
+
+    else:
+        stored_hours = {}
+
+        # reads the csv
+        existing_df = pd.read_csv(csv_path)
+
+        # row of each hour in the csv (the first, if an hour is in more than once)
+        existing_hours = existing_df.hour.astype(str).str[0:8].tolist()
+        existing_index = {}
+        for exists_index, existing_hour in enumerate(existing_hours):
+            existing_index.setdefault(existing_hour, exists_index)
 
     # defines dicts
     # will have hours as keys, and then list of grid numbers or grid percentages
@@ -73,37 +126,68 @@ def prepare_model_grid_percentages(time,
     percentage_vals_dict = {}
     percentage_covered_by_model = {}
 
+    # hours to calculate: {time_key: [SA path, hour string]}
+    new_hours = {}
+
     for hour, sa in zip(time, sa_list):
 
         time_key = hour.strftime("%y%m%d%H")
 
+        # check to see if time is in the store
+        if time_key in stored_hours:
+            model_site, percentage_vals, calculated_sum = stored_hours[time_key]
+
+            # append to dictionaries
+            model_site_dict[time_key] = model_site
+            percentage_vals_dict[time_key] = percentage_vals
+            percentage_covered_by_model[time_key] = calculated_sum
+
         # check to see if time is in csv
-        if time_key in existing_df.hour.astype(str).str[0:8].tolist():
+        elif time_key in existing_index:
 
             # value exists: gets the values from the csv
-            exists_index = np.where(np.asarray(existing_df.hour.astype(str).str[0:8].tolist()) == time_key)[0][0]
-
-            df_row = existing_df.iloc[[exists_index]]
+            df_row = existing_df.iloc[[existing_index[time_key]]]
 
-            # gets column names
-            # [1:] gets rid of 'hour'
-            no_zeros = df_row.loc[:, (df_row != 0).any(axis=0)]
+            calculated_sum = df_row['calculated_sum'].values.tolist()[0]
 
-            calculated_sum = no_zeros.values.tolist()[0][1]
+            # grids with no overlap are 0 (as in sa_percentages_store.read_hours)
+            grid_columns = sa_percentages_store.store_columns[2:]
+            grid_values = df_row[grid_columns].values.tolist()[0]
 
-            model_site = list(no_zeros.columns)[2:]
-            percentage_vals = no_zeros.values.tolist()[0][2:]
+            model_site = [grid for grid, value in zip(grid_columns, grid_values) if value != 0]
+            percentage_vals = [value for value in grid_values if value != 0]
 
             # append to dictionaries
             model_site_dict[time_key] = model_site
             percentage_vals_dict[time_key] = percentage_vals
             percentage_covered_by_model[time_key] = calculated_sum
 
-
         else:
-            # gets the percentage values for each grid
-            grid_vals, calculated_sum = sa_grid_overlap.SA_grid_percentages(sa, savepath, hour.strftime('%H'))
+            # if an hour is given more than once, the last SA is used
+            new_hours[time_key] = [sa, hour.strftime('%H')]
+
+    new_keys = list(new_hours)
+    sa_paths = [new_hours[time_key][0] for time_key in new_keys]
+    hour_strings = [new_hours[time_key][1] for time_key in new_keys]
+
+    # gets the percentage values for each grid
+    if n_workers > 1 and len(new_keys) > 1:
+        # hours in chunks, so each process reuses its grid geometries and label rasters
+        chunksize = max(1, len(new_keys) // (n_workers * 4))
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+        sa_results = pool.map(sa_grid_overlap.SA_grid_percentages,
+                              sa_paths,
+                              repeat(savepath),
+                              hour_strings,
+                              chunksize=chunksize)
+    else:
+        pool = None
+        sa_results = map(sa_grid_overlap.SA_grid_percentages, sa_paths, repeat(savepath), hour_strings)
+
+    new_rows = []
 
+    try:
+        for time_key, (grid_vals, calculated_sum) in zip(new_keys, sa_results):
             # calculated sum is the % of the total footprint captured falling within the model grids
 
             # new dict for grids to be included
@@ -144,8 +228,28 @@ def prepare_model_grid_percentages(time,
             percentage_vals_dict[time_key] = percentage_vals
             percentage_covered_by_model[time_key] = calculated_sum
 
-            # append to a csv - to cut-down on processing time
-            append_grids_to_csv(time_key, model_site, percentage_vals, calculated_sum)
+            new_rows.append(grid_percentage_row(time_key, model_site, percentage_vals, calculated_sum))
+
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+        # append to the store or csv - to cut-down on processing time
+        # hours done before an error are kept, so they aren't calculated again
+        try:
+            if store_path:
+                sa_percentages_store.append_rows(store, new_rows)
+            else:
+                append_grid_rows_to_csv(new_rows, csv_path)
+        finally:
+            if store_path:
+                store.close()
+
+    # puts the hours back in the order they were given
+    hour_order = dict.fromkeys(hour.strftime("%y%m%d%H") for hour, sa in zip(time, sa_list))
+    model_site_dict = {time_key: model_site_dict[time_key] for time_key in hour_order}
+    percentage_vals_dict = {time_key: percentage_vals_dict[time_key] for time_key in hour_order}
+    percentage_covered_by_model = {time_key: percentage_covered_by_model[time_key] for time_key in hour_order}
 
     return model_site_dict, percentage_vals_dict, percentage_covered_by_model
 
@@ -156,10 +260,19 @@ def determine_which_model_files(model_site_dict,
                                 run,
                                 variable,
                                 disheight,
-                                savepath):
+                                savepath,
+                                plot=False,
+                                cache_dir=False,
+                                dry_run=False):
     """
     finds all the grids which will be needed - looks through the whole model site dict and gets all grid numbers
     across whole time range chosen
+    The files to read are planned up front (see plan_model_files): each file is read once, and its values are
+    given to every grid of its site which uses it.
+    plot: passed to read_premade_model_files.extract_model_data. Not plotted by default, as this is run for each
+    grid (and plots of grids at the same site would overwrite each other).
+    cache_dir: passed to read_premade_model_files.extract_model_file_all_grids.
+    dry_run: if True, the plan of files is printed and returned instead of reading any files: returns plan, model_site
     """
 
     # list which will include all grid numbers
@@ -180,6 +293,37 @@ def determine_which_model_files(model_site_dict,
     for item in model_site_sorted:
         model_site.append(str(item))
 
+    # finds files for every site which includes any of the grids, for all dates, in one pass of the model store
+    all_sites = []
+    for grid in model_site:
+        for item in look_up.grid_dict[int(grid)]:
+            site_present = item.split(' ')[0]
+            if site_present not in all_sites:
+                all_sites.append(site_present)
+
+    batch_index = find_model_files.find_UKV_files_batch(DOYstart_mod,
+                                                        DOYstop_mod,
+                                                        all_sites,
+                                                        'ukv',
+                                                        run,
+                                                        [variable],
+                                                        # model_path="//rdg-home.ad.rdg.ac.uk/research-nfs/basic/micromet/Tier_processing/rv006011/new_data_storage/"
+                                                        model_path='C:/Users/beths/OneDrive - University of Reading/local_runs_data/data_wifi_problems/data/'
+                                                        )
+
+    # Plans which file to read for each grid and day
+    plan = plan_model_files(model_site, batch_index, variable)
+    print_model_file_plan(plan)
+
+    if dry_run:
+        return plan, model_site
+
+    # reads each planned file once, for all 9 grids of its 3x3: {file path: {grid letter: values}}
+    all_grid_results = {}
+    for file_path in sorted(plan['files']):
+        all_grid_results[file_path] = read_premade_model_files.extract_model_file_all_grids(
+            file_path, variable, 'ukv', disheight, plan['files'][file_path]['site'], cache_dir=cache_dir)
+
     # dictionary to append model data to, for all sites chosen.
     included_grids = {}
 
@@ -195,279 +339,33 @@ def determine_which_model_files(model_site_dict,
         # changes to int
         grid = int(grid)
 
-        # For this grid:
-
-        # calling grid_dict from look_up to see what sites include this grid as part of their 3x3
-        print('Options with this grid number are: ', look_up.grid_dict[grid])
-
-        # Step 1:
-        # makes lists for sites and grid litters for all items called from look_up,
-        # in order to find files for them (based on what is present in the grid_dict)
+        if len(plan['grids'][grid]) == 0:
+            print('No files for grid: ', grid)
+            continue
 
-        # list of sites
-        sites_present = []
-        # list of corresponding grid letters
-        grid_letters = []
+        # Splits the days up into chunks of consecutive days using the same site, as extract_model_data can only take
+        # one site/ grid letter at once: list of [site, grid letter, {key: path}]
+        clusters = []
+        for day_key, site, grid_letter, file_path in plan['grids'][grid]:
+            if len(clusters) == 0 or clusters[-1][0] != site:
+                clusters.append([site, grid_letter, {}])
+            clusters[-1][2][day_key] = file_path
 
-        # for each site which includes the chosen grid
-        for item in look_up.grid_dict[grid]:
-            # split the items present in the dict to get a site name and a grid letter
-            site_present = item.split(' ')[0]
-            grid_letter = item.split(' ')[1]
-
-            # append them to the lists above
-            sites_present.append(site_present)
-            grid_letters.append(grid_letter)
-
-        # Step 2:
-        # finds files for all sites containing the current grid choice
-
-        # list to append found file dicts to
-        dict_list = []
-        # list to append the keys of the found file dicts to
-        # keys are strings of like, model type and date
-        key_list = []
-
-        # for every site which includes our grid in it's 3x3
-        for sitei in sites_present:
-            # finds the files for the site
-            print(' ')
-
-            print(' ')
-            print('FINDING FILES FOR SITE: ', sitei)
-
-            file_dict_ukv = find_model_files.find_UKV_files(DOYstart_mod,
-                                                            DOYstop_mod,
-                                                            sitei,
-                                                            'ukv',
-                                                            run,
-                                                            variable,
-                                                            # model_path="//rdg-home.ad.rdg.ac.uk/research-nfs/basic/micromet/Tier_processing/rv006011/new_data_storage/"
-                                                            model_path='C:/Users/beths/OneDrive - University of Reading/local_runs_data/data_wifi_problems/data/'
-                                                            )
-
-            # append the keys to key_list
-            list_of_keys = file_dict_ukv.keys()
-            key_list.append(list_of_keys)
-
-        # append the dictionaries to dict_list
-        dict_list.append(file_dict_ukv)
-
-        # Step 3: Put together a collection of unique files found for each day chosen, for this grid.
-        # This maximises the data availability for the model -
-        # As one site (example, IMU) may have it's grid A matching with our chosen grid, and another site (BCT)
-        # may have it's grid E also matching, but files are available for IMU which aren't for BCT...
-
-        # Takes the key_list, which is a list of lists (list of lists of keys for all sites' files found)
-        # and then finds all the unique items (gets rid of keys which appear more than once throughout all the
-        # sites
-        unique_keys = list(set(x for l in key_list for x in l))
-
-        # Creates a dictionary to keep a collection of as-complete-as-possible files found for this grid
-        complete_files = {}
-
-        # for each unique key
-        for item in unique_keys:
-
-            # for dicts in list of dicts (one for each site)
-            for dict in dict_list:
-
-                # if the unique key is in this dict
-                if item in dict:
-
-                    # define unique item in new dict
-                    complete_files[item] = dict[item]
-
-                    # and then this item has been found, so no longer need to look for this unique key
-                    # break the loop here
-                    break
-
-                # if the item was not in this dict, keep looking
-                else:
-                    pass
-
-        # Step 4: Find the corresponding sites and grid letters which this new collection of unique file items
-        # correspond to
-
-        # Finding the site string for each site used in the unique collection
-        # defines a list of sites used
-        sites_used = []
-
-        # for every item in the unique file collection
-        for item in sorted(complete_files):
-            # get the site which corresponds to this key
-            # split by underscore, get the last item: example KSSW.nc, use [:-3] to get rid of .nc
-            site_here = complete_files[item][0].split('_')[-1][:-3]
-
-            # append to list of sites used
-            sites_used.append(site_here)
-
-        # Finding the grid letter for each site used in the unique collection
-        # defines a list of letters used
-        grid_letters_used = []
-
-        # for every site used
-        for item in sites_used:
-            # find where this appears in sites present, and from that, can get the letter
-            letter = np.asarray(grid_letters)[np.where(np.asarray(sites_present) == item)][0]
-
-            # append to list
-            grid_letters_used.append(letter)
-
-        # Step 5: Finding where site changes occur
-        # eventually will contribute to splitting up the complete dictionary up into chunks of the same site.
-        # This is because the sort_models function can only take one site/ grid letter at once.
-
-        # define list of indexes where site changes within the sites_used list
-        # (sites_used being a list of sites included within the complete collection)
-        site_change = []
-        # for the index between 0 and the length of the complete collection
-        for i in range(0, len(sites_used)):
-
-            # if it is not the first index
-            if i != 0:
-
-                # if the current site is not the same as the previous site, there is a site change and the index (i)
-                # is appended
-                if sites_used[i] != sites_used[i - 1]:
-                    site_change.append(i)
-
-        # if there are no changes, the site change list == []
-        # so need to append a 0 to get first and only site used
-        if len(site_change) == 0:
-            site_change.append(0)
-
-        # Step 6: Splits up the complete dictionary KEYS up into chunks of the same site.
-
-        # creating a list of lists
-        # This will be be lists of keys from the complete collection - separated by differing sites used
-        list_of_lists = []
-
-        # if the length of the site changes is more than one
-        # meaning more than one site is included here
-        if len(site_change) != 1:
-
-            # Defining the first list (for the first site)
-            # append all keys until the first index change
-            list_of_lists.append(sorted(complete_files.keys())[:site_change[0]])
-
-            # Defining all the middle lists
-            # makes list of tuples of 2 indices to slice by
-            indices_tuple = []
-            # for all indices in between the first and last
-            for i in range(1, len(site_change)):
-                # defines pair of indicies to slice by (in form of tuple)
-                tuple = site_change[i - 1], site_change[i]
-                # appends
-                indices_tuple.append(tuple)
-            # slice list by these tuples
-            for item in [sorted(complete_files.keys())[s:e] for s, e in indices_tuple]:
-                # append to list of lists
-                list_of_lists.append(item)
-
-            # Defining the last list
-            # append all the keys from the last index change to the end of the complete keys
-            list_of_lists.append(sorted(complete_files.keys())[site_change[-1]:])
-
-        # If only one site is included
-        else:
-            list_of_lists.append(sorted(complete_files.keys())[site_change[-1]:])
-
-        # Step 7: Splits up the complete dictionary (no longer just keys, but values too)
-        # up into chunks of the same site.
-
-        # creates list to append dictionaries to (one for each site used in chunks)
-        list_of_dicts = []
-
-        # for every list in list of lists, or, for every chunk of consecutive sites used in complete collection:
-        for listi in list_of_lists:
-            # define a dictionary
-            temp_dict = {}
-            # for every item (which is a key in the complete collection) in this current list
-            for item in listi:
-                # defines an item in the new dictionary, by calling the item from the original dictionary
-                temp_dict[item] = complete_files[item]
-            # append this temporary dictionary to my list of dictionaries.
-            list_of_dicts.append(temp_dict)
-
-        # Step 8: Gets a list of sites and grid letters - one for each dictionary of files for
-        # each site (one for each cluster)
-
-        # Creates lists of sites and grid letters which the list of dicts correspond to
-        # so one site and grid letter per dictionary of files
-
-        # defines lists of sites and grid letters
-        list_of_sites_for_final = []
-        list_of_grids_for_final = []
-
-        # append the first item
-        list_of_sites_for_final.append(sites_used[0])
-        list_of_grids_for_final.append(grid_letters_used[0])
-
-        # appends the further items, using list of indicies where changes occured
-        for item in site_change:
-            list_of_sites_for_final.append(sites_used[item])
-            list_of_grids_for_final.append(grid_letters_used[item])
-
-        # Step 9: Defines empty lists for the output of sort_models to be appended to.
-
-        # dict of datetimes
-        # time_dict
-        combined_ukv0_list = []
-        # dict of temps
-        # var_dict
-        combined_ukv1_list = []
-        # dict of variable (all 9 grids average)
-        # var_dict_9
-        combined_ukv2_list = []
-        # dict of variable 0 (at height 1 level below target)
-        # var_dict_0
-        combined_ukv3_list = []
-        # dict of variable 2 (at height 1 level above target)
-        # var_dict_2
-        combined_ukv4_list = []
-        # list of strings time
-        # key_name_times
-        combined_ukv5_list = []
-        # list of strings temp
-        # key_names_vars
-        combined_ukv6_list = []
-        # list of strings variable 9
-        # key_names_vars_9
-        combined_ukv7_list = []
-        # list of strings variable 0
-        # key_names_vars_0
-        combined_ukv8_list = []
-        # list of strings variable 2
-        # key_names_vars_2
-        combined_ukv9_list = []
-
-        # ToDo: I REALLY NEED TO CHANGE THIS!
-        # Heights atm are changing with grid because of the sites are different - so I need to change this
-        # This will be the case when a stash code is used which ISN'T from the surface
+        # Defines empty lists for the output of extract_model_data to be appended to (one per cluster)
+        combined_ukv_lists = [[] for i in range(14)]
 
-        # height of model
-        # height_value
-        combined_ukv10_list = []
-        # height of model0
-        # height_value_0
-        combined_ukv11_list = []
-        # height of model2
-        # height_value_2
-        combined_ukv12_list = []
-        # all_times
-        combined_ukv13_list = []
-
-        # Step 10: Runs sort models for each cluster of files, and appends output.
-
-        for file_dict_ukv, site_item, grid_item in zip(list_of_dicts, list_of_sites_for_final,
-                                                       list_of_grids_for_final):
+        # Runs extract_model_data for each cluster of files, from the values already read, and appends output.
+        for site_item, grid_item, files_ukv in clusters:
             # pulls the start and stop DOY for this cluster from the dictionary key
-            DOYstart_temp = int(list(file_dict_ukv.keys())[0][3:])
-            DOYstop_temp = int(list(file_dict_ukv.keys())[-1][3:])
+            DOYstart_temp = int(sorted(files_ukv.keys())[0][3:])
+            DOYstop_temp = int(sorted(files_ukv.keys())[-1][3:])
 
-            # ordering UKV model files
-            files_ukv = find_model_files.order_model_stashes(file_dict_ukv, variable)
+            file_results = []
+            for file_path in sorted(files_ukv.values()):
+                if all_grid_results[file_path] is None:
+                    file_results.append(None)
+                else:
+                    file_results.append(all_grid_results[file_path][grid_item])
 
             # sort models
             ukv = read_premade_model_files.extract_model_data(files_ukv,
@@ -478,62 +376,42 @@ def determine_which_model_files(model_site_dict,
                                                               disheight,
                                                               site_item,
                                                               savepath,
-                                                              grid_choice=grid_item
+                                                              grid_choice=grid_item,
+                                                              plot=plot,
+                                                              file_results=file_results
                                                               )
 
             # appends outputs to lists
-            combined_ukv0_list.append(ukv[0])
-            combined_ukv1_list.append(ukv[1])
-            combined_ukv2_list.append(ukv[2])
-            combined_ukv3_list.append(ukv[3])
-            combined_ukv4_list.append(ukv[4])
-            combined_ukv5_list.append(ukv[5])
-            combined_ukv6_list.append(ukv[6])
-            combined_ukv7_list.append(ukv[7])
-            combined_ukv8_list.append(ukv[8])
-            combined_ukv9_list.append(ukv[9])
-            combined_ukv10_list.append(ukv[10])
-            combined_ukv11_list.append(ukv[11])
-            combined_ukv12_list.append(ukv[12])
-            combined_ukv13_list.append(ukv[13])
-
-        # Step 11: Combines outputs into one item for each output
+            for combined_list, output in zip(combined_ukv_lists, ukv):
+                combined_list.append(output)
+
+        # Combines outputs into one item for each output
 
         # combines dictionaries
-        combined_ukv0 = {}
-        for d in combined_ukv0_list:
-            combined_ukv0.update(d)
-        combined_ukv1 = {}
-        for d in combined_ukv1_list:
-            combined_ukv1.update(d)
-        combined_ukv2 = {}
-        for d in combined_ukv2_list:
-            combined_ukv2.update(d)
-        combined_ukv3 = {}
-        for d in combined_ukv3_list:
-            combined_ukv3.update(d)
-        combined_ukv4 = {}
-        for d in combined_ukv4_list:
-            combined_ukv4.update(d)
+        # time_dict, var_dict, var_dict_9, var_dict_0, var_dict_2
+        combined_ukv = {}
+        for i in range(5):
+            combined_ukv[i] = {}
+            for d in combined_ukv_lists[i]:
+                combined_ukv[i].update(d)
 
         # combines lists
-        combined_ukv5 = sum(combined_ukv5_list, [])
-        combined_ukv6 = sum(combined_ukv6_list, [])
-        combined_ukv7 = sum(combined_ukv7_list, [])
-        combined_ukv8 = sum(combined_ukv8_list, [])
-        combined_ukv9 = sum(combined_ukv9_list, [])
-        combined_ukv13 = sum(combined_ukv13_list, [])
+        # key_name_times, key_names_vars
+        combined_ukv[5] = sum(combined_ukv_lists[5], [])
+        combined_ukv[6] = sum(combined_ukv_lists[6], [])
 
+        # ToDo: I REALLY NEED TO CHANGE THIS!
+        # Heights atm are changing with grid because of the sites are different - so I need to change this
+        # This will be the case when a stash code is used which ISN'T from the surface
         # takes the height (currently botched)
-        # ToDo: edit this - as multiple sites will have more than one height
-        temp_height_botch = combined_ukv10_list[0]
+        temp_height_botch = combined_ukv_lists[10][0]
 
-        # Step 12: Appends the outputs into the included_grids dictionary (one grouped output per grid)
+        # Appends the outputs into the included_grids dictionary (one grouped output per grid)
         # This then acts as 'included_models'
 
         # groups the outputs for the time series plots
         # [ key_name_times,  key_names_vars,  time_dict,    var_dict,    height_value   ]
-        group_ukv = [combined_ukv5, combined_ukv6, combined_ukv0, combined_ukv1, temp_height_botch]
+        group_ukv = [combined_ukv[5], combined_ukv[6], combined_ukv[0], combined_ukv[1], temp_height_botch]
 
         # appends to dictionary
         included_grids[grid] = group_ukv
@@ -541,6 +419,103 @@ def determine_which_model_files(model_site_dict,
     return included_grids, model_site
 
 
+def plan_model_files(model_site,
+                     batch_index,
+                     variable):
+    """
+    Plans the set of files (one per site and day, for the stash code of the variable) to read for every chosen grid on
+    every day with a file for it, with each file read once.
+    Each grid uses the last site listed for it in look_up.grid_dict, the site its values were always taken from. The
+    site's altitude sets the model level and height_value, so keeping to it keeps them. Days that site has no file for
+    are filled from the sites listed before it (the last of them with a file), which give the same grid from their
+    own 3x3 at their own altitude. Grids sharing a site share its file, which is read once for all of them.
+    :param model_site: list of grid numbers (strings)
+    :param batch_index: output of find_model_files.find_UKV_files_batch, for all sites of the chosen grids
+    :param variable: single stash code variable
+    :return: plan dict of:
+        'files' - {path: {'site', 'day_key', 'grids': {grid number: grid letter}}} - the files to read,
+        'grids' - {grid number: list of (day_key, site, grid letter, path) sorted by day} - where each grid's values
+            come from,
+        'n_per_grid_files' - number of files that would be read resolving each grid on its own
+    """
+
+    # site files for the variable: {site: {day_key: path}}
+    site_files = {}
+
+    # which sites (and grid letters) can give each grid, in the order of look_up.grid_dict
+    grid_sites = {}
+
+    for grid in model_site:
+        grid = int(grid)
+        grid_sites[grid] = []
+
+        for item in look_up.grid_dict[grid]:
+            site, grid_letter = item.split(' ')
+            grid_sites[grid].append((site, grid_letter))
+
+            if site not in site_files:
+                site_files[site] = find_model_files.align_stash_files(batch_index[site], variable)
+
+    # every day with a file for any site
+    all_days = set([])
+    for site in site_files:
+        all_days.update(site_files[site].keys())
+
+    plan_files = {}
+    plan_grids = {grid: [] for grid in grid_sites}
+    n_per_grid_files = 0
+
+    for day_key in sorted(all_days):
+        for grid in sorted(grid_sites):
+
+            # the last listed site with a file this day
+            for site, grid_letter in reversed(grid_sites[grid]):
+                if day_key in site_files[site]:
+                    file_path = site_files[site][day_key]
+                    plan_grids[grid].append((day_key, site, grid_letter, file_path))
+                    n_per_grid_files += 1
+
+                    if file_path not in plan_files:
+                        plan_files[file_path] = {'site': site, 'day_key': day_key, 'grids': {}}
+                    plan_files[file_path]['grids'][grid] = grid_letter
+                    break
+
+    return {'files': plan_files, 'grids': plan_grids, 'n_per_grid_files': n_per_grid_files}
+
+
+def print_model_file_plan(plan):
+    """
+    Prints a report of a plan from plan_model_files.
+    :param plan: output of plan_model_files
+    :return:
+    """
+
+    print(' ')
+    print('-----------------------------------------------------------------------------------------------------------')
+    print('Model file plan:')
+    print('files to read: ' + str(len(plan['files'])) + ' (' + str(plan['n_per_grid_files']) +
+          ' if each grid were resolved on its own)')
+
+    # files read for each site
+    site_counts = {}
+    for file_path in plan['files']:
+        site = plan['files'][file_path]['site']
+        site_counts[site] = site_counts.get(site, 0) + 1
+    for site in sorted(site_counts):
+        print(site + ': ' + str(site_counts[site]) + ' files')
+
+    # where each grid's values come from
+    for grid in sorted(plan['grids']):
+        sources = []
+        for day_key, site, grid_letter, file_path in plan['grids'][grid]:
+            if len(sources) == 0 or sources[-1][0] != site + ' ' + grid_letter:
+                sources.append([site + ' ' + grid_letter, day_key, day_key])
+            sources[-1][2] = day_key
+        print('grid ' + str(grid) + ': ' + ', '.join(source[0] + ' (' + source[1][3:] + ' - ' + source[2][3:] + ')'
+                                                     for source in sources))
+    print(' ')
+
+
 def average_model_grids(included_grids,
                         DOYstart_mod,
                         DOYstop_mod,
@@ -549,54 +524,31 @@ def average_model_grids(included_grids,
                         model_site):
     """
     Takes an average and a weighted average of model grids based on their dynamic overlap with observation SAs.
-    :param included_grids:
+    All hours are averaged at once: an (hours x grids) matrix of model values is multiplied by an (hours x grids)
+    matrix of SA percentages. Each hour is averaged over the grids in model_site_dict for that hour.
+    Only hours with model values, grids and percentages are kept: model_site_dict and percentage_vals_dict are cut down
+    to these hours.
+    :param included_grids: from determine_which_model_files
     :param DOYstart_mod:
     :param DOYstop_mod:
-    :param percentage_vals_dict:
-    :param model_site_dict:
-    :param model_site:
-    :return:
+    :param percentage_vals_dict: from prepare_model_grid_percentages
+    :param model_site_dict: from prepare_model_grid_percentages
+    :param model_site: all grids in included_grids
+    :return: included_grids, with 'Average' and 'WAverage' added
     """
 
-    # Defining a big list for averaging values
-    list_to_average = []
     list_of_times = []
-    list_of_var_strings = []
-    list_of_time_strings = []
     list_of_heights = []
 
     for grid in sorted(included_grids):
-        # appends to appropriate lists
-        key_name_times = included_grids[grid][0]
-        key_names_vars = included_grids[grid][1]
-        time_dict = included_grids[grid][2]
-        var_dict = included_grids[grid][3]
-        height_value = included_grids[grid][4]
-
-        list_of_times.append(time_dict)
-        list_to_average.append(var_dict)
-        list_of_var_strings.append(key_names_vars)
-        list_of_time_strings.append(key_name_times)
-        list_of_heights.append(height_value)
+        list_of_times.append(included_grids[grid][2])
+        list_of_heights.append(included_grids[grid][4])
 
     # tests to see if all the times are the same between all the grids chosen
-    # defines function to do this
-    def all_same(items):
-        return all(x == items[0] for x in items)
-
-    # tests the times
-    if all_same(list_of_times):
-        # if all the same, continue on
-        pass
-    else:
+    if not all(grid_times == list_of_times[0] for grid_times in list_of_times):
         # if times are different
         raise ValueError('THERES A PROBLEM! TIMES ARE DIFFERENT!')
 
-    # because all the sting lists are the same, I can take the first one:
-
-    # error with missing observations - cannot take the index of empty list
-    strings = list_of_var_strings[0]
-
     # gets datetime objects of the day(s) I want
     DOYstart_dt = dt.datetime.strptime(str(DOYstart_mod), '%Y%j')
     DOYstop_dt = dt.datetime.strptime(str(DOYstop_mod + 2),
@@ -604,214 +556,144 @@ def average_model_grids(included_grids,
     # And another + 1 because these times are at midnight
     # (so I need midnight of next dat
 
-    new_list_of_times = []
-    new_list_to_average = []
-
-    # list_of_times = list of dictionaries, keys as day. Each dictionary is a grid
-    for grid_time, grid_val in zip(list_of_times, list_to_average):
-
-        grid_dict_times = {}
-        grid_dict_vals = {}
-
-        for day_time, day_val in zip(list_of_time_strings[0],
-                                     list_of_var_strings[0]):  # is the same as the rest (as passed the test above)
-
-            temp_day_time = []
-            temp_day_vals = []
-
-            for time, val in zip(grid_time[day_time], grid_val[day_val]):
-
-                if DOYstart_dt <= time < DOYstop_dt:
-                    temp_day_time.append(time)
-                    temp_day_vals.append(val)
+    # model values: (hours x grids)
+    values_df = model_grid_matrix(included_grids, DOYstart_dt, DOYstop_dt)
 
-            # prevents empty dicts (as I'm getting rid of midnight from the end DOY - this causes empty lists
-            if len(temp_day_time) != 0:
-                grid_dict_times[day_time] = temp_day_time
-                grid_dict_vals[day_val] = temp_day_vals
+    # SA percentages of the grids included each hour, and which grids are included: (hours x grids)
+    weights_df, included_df = percentage_matrix(percentage_vals_dict, model_site_dict)
 
-        new_list_of_times.append(grid_dict_times)
-        new_list_to_average.append(grid_dict_vals)
+    # lines up hours and grids: only hours with values and percentages are kept
+    # grids in the SA without model values are NaN
+    grid_columns = weights_df.columns.union(values_df.columns)
+    values_df = values_df.reindex(columns=grid_columns)
+    weights_df = weights_df.reindex(columns=grid_columns, fill_value=0.0)
+    included_df = included_df.reindex(columns=grid_columns, fill_value=False)
 
-    # dict to average by hour - key is date string for each hour included, values are QH vals for each grid
-    hour_dict = {}
+    values_df, weights_df = values_df.align(weights_df, join='inner', axis=0)
+    included_df = included_df.loc[values_df.index]
 
-    for grid in new_list_of_times:
+    hour_keys = set(values_df.index.strftime('%y%m%d%H'))
+    dropped_keys = set(model_site_dict).union(percentage_vals_dict).difference(hour_keys)
 
-        # for each day (or day string)
-        # gets rid of the last day string (as it used to just contain midnight which now isn't a thing)
-        for day in list_of_time_strings[0]:
-
-            for hour in grid[day]:
-                time_string = hour.strftime("%y%m%d%H")
-                hour_dict[time_string] = []
-
-    for grid_time, grid_val in zip(new_list_of_times, new_list_to_average):
-
-        # for each day (or day string)
-        for day_time, day_val in zip(list_of_time_strings[0], strings):
-
-            for hour_time, hour_val in zip(grid_time[day_time], grid_val[day_val]):
-                time_string = hour_time.strftime("%y%m%d%H")
-
-                hour_dict[time_string].append(hour_val)
-
-    if sorted(percentage_vals_dict) == sorted(model_site_dict) == sorted(hour_dict):
-        pass
-    else:
+    if len(dropped_keys) != 0:
         print(' ')
         print("KEYS DON'T MATCH")
+        print('hours without model values, grids or percentages: ', sorted(dropped_keys))
         print(' ')
-        print(sorted(percentage_vals_dict))
-        print(' ')
-        print(sorted(model_site_dict))
-        print(' ')
-        print(sorted(hour_dict))
-
-        if model_site_dict == percentage_vals_dict:
-            pass
-        else:
-            mutual_keys_1 = list(set(model_site_dict).intersection(percentage_vals_dict))
-
-            to_delete_1a = set(model_site_dict.keys()).difference(mutual_keys_1)
-            to_delete_1b = set(percentage_vals_dict.keys()).difference(mutual_keys_1)
-
-            print(' ')
-            print('to_delete_1a: ', to_delete_1a)
-            print('to_delete_1b: ', to_delete_1b)
-
-            for d in to_delete_1a:
-                del model_site_dict[d]
-
-            for d in to_delete_1b:
-                del percentage_vals_dict[d]
 
-        if hour_dict == percentage_vals_dict:
-            pass
-        else:
-            # hour_dict = list(set(hour_dict).intersection(percentage_vals_dict))
-
-            mutual_keys_2 = list(set(hour_dict).intersection(percentage_vals_dict))
-
-            to_delete_2a = set(hour_dict.keys()).difference(mutual_keys_2)
-            to_delete_2b = set(percentage_vals_dict.keys()).difference(mutual_keys_2)
+        for d in dropped_keys:
+            model_site_dict.pop(d, None)
+            percentage_vals_dict.pop(d, None)
 
-            print(' ')
-            print('to_delete_2a: ', to_delete_2a)
-            print('to_delete_2b: ', to_delete_2b)
+    # grids not in the SA this hour don't count (even if their value is NaN)
+    included = included_df.to_numpy()
+    weights = weights_df.to_numpy()
+    values = np.where(included, values_df.to_numpy(), 0.0)
 
-            for d in to_delete_2a:
-                del hour_dict[d]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        av_per_hour = values.sum(axis=1) / included.sum(axis=1)
+        w_av_per_hour = (values * weights).sum(axis=1) / weights.sum(axis=1)
 
-            for d in to_delete_2b:
-                del percentage_vals_dict[d]
-
-        if hour_dict == model_site_dict:
-            pass
-        else:
-            # hour_dict = list(set(hour_dict).intersection(model_site_dict))
+    # getting it back into the correct format: dictionaries with a key for each day
+    # I want a string for the day before the content is forcatsed for (as it's a forecast the day before)
+    hours = values_df.index.to_pydatetime()
+    date_strings = [str(int(doy_string) - 1) for doy_string in values_df.index.strftime('%Y%j')]
 
-            mutual_keys_3 = list(set(hour_dict).intersection(model_site_dict))
-
-            to_delete_3a = set(hour_dict.keys()).difference(mutual_keys_3)
-            to_delete_3b = set(model_site_dict.keys()).difference(mutual_keys_3)
-
-            print(' ')
-            print('to_delete_3a: ', to_delete_3a)
-            print('to_delete_3b: ', to_delete_3b)
+    w_averaged_dict = {}
+    average_dict = {}
+    average_dict_time = {}
 
-            for d in to_delete_3a:
-                del hour_dict[d]
+    for date_string in sorted(set(date_strings)):
+        average_dict['var_' + date_string] = []
+        w_averaged_dict['var_' + date_string] = []
+        average_dict_time['time_' + date_string] = []
 
-            for d in to_delete_3b:
-                del model_site_dict[d]
+    for date_string, hour, av, w_av in zip(date_strings, hours, av_per_hour.tolist(), w_av_per_hour.tolist()):
+        average_dict['var_' + date_string].append(av)
+        w_averaged_dict['var_' + date_string].append(w_av)
+        average_dict_time['time_' + date_string].append(hour)
 
+    w_averaged_dict_time = {key: list(average_dict_time[key]) for key in average_dict_time}
 
-    # all grid - to get order
-    inclu_av_grids = {}
+    # grouping thr average values
+    # [ key_name_times,  key_names_vars,  time_dict,    var_dict,    height_value   ]
+    average_grouped = [sorted(average_dict_time.keys()), sorted(average_dict.keys()), average_dict_time, average_dict,
+                       list_of_heights[0]]
 
-    for hour in sorted(hour_dict):
+    included_grids['Average'] = average_grouped
 
-        inclu_av_grids[hour] = []
+    # weighted average groups
+    # [ key_name_times,  key_names_vars,  time_dict,    var_dict,    height_value   ]
+    w_average_grouped = [sorted(w_averaged_dict_time.keys()), sorted(w_averaged_dict.keys()), w_averaged_dict_time,
+                         w_averaged_dict,
+                         list_of_heights[0]]
 
-        for grid_num in model_site_dict[hour]:
-            index_of_grid = np.where(np.asarray(model_site) == grid_num)[0][0]
-            inclu_av_grids[hour].append(hour_dict[hour][index_of_grid])
-
-    w_av_per_hour = {}
-    av_per_hour = {}
-    for hour in sorted(hour_dict):
-        print(hour)
-        print(hour_dict[hour])
-        print(model_site)
-        print(model_site_dict[hour])
-        print(percentage_vals_dict[hour])
-        print(inclu_av_grids[hour])
-        print(np.average(inclu_av_grids[hour], axis=0, weights=percentage_vals_dict[hour]))
-        print(np.average(inclu_av_grids[hour], axis=0))
-        print(' ')
+    included_grids['WAverage'] = w_average_grouped
 
-        w_av_per_hour[hour] = np.average(inclu_av_grids[hour], axis=0, weights=percentage_vals_dict[hour])
-        av_per_hour[hour] = np.average(inclu_av_grids[hour], axis=0)
+    return included_grids
 
-    # getting it back into the correct format
-    w_averaged_dict = {}
-    w_averaged_dict_time = {}
 
-    # # dictionary of averaged values for each day
-    average_dict = {}
-    average_dict_time = {}
+def model_grid_matrix(included_grids,
+                      DOYstart_dt,
+                      DOYstop_dt):
+    """
+    Puts the model values of each grid into one DataFrame: a row for each hour, and a column for each grid.
+    :param included_grids: from determine_which_model_files
+    :param DOYstart_dt: first time kept
+    :param DOYstop_dt: times before this are kept
+    :return: DataFrame of values (NaN where missing), index of hours (datetimes to the hour)
+    """
 
-    for hour in sorted(w_av_per_hour):
-        dt_ob = dt.datetime.strptime(hour, '%y%m%d%H')
-        # I want a string for the day before the content is forcatsed for (as it's a forecast the day before)
-        doy_string = dt_ob.strftime("%Y%j")
+    grid_columns = {}
 
-        doy_num = int(doy_string) - 1  # - 1 because I want the day before - as it's a forcast
-        date_string = str(doy_num)
+    for grid in sorted(included_grids):
+        key_name_times, key_names_vars, time_dict, var_dict = included_grids[grid][:4]
 
-        string_construct = 'var_' + date_string
-        string_construct_time = 'time_' + date_string
+        times = []
+        values = []
+        for day_time, day_val in zip(key_name_times, key_names_vars):
+            times += time_dict[day_time]
+            values += [np.nan if value is np.ma.masked else value for value in var_dict[day_val]]
 
-        w_averaged_dict[string_construct] = []
-        w_averaged_dict_time[string_construct_time] = []
+        grid_series = pd.Series(np.asarray(values, dtype=float), index=pd.DatetimeIndex(times).floor('h'))
 
-        average_dict[string_construct] = []
-        average_dict_time[string_construct_time] = []
+        in_range = (grid_series.index >= DOYstart_dt) & (grid_series.index < DOYstop_dt)
+        grid_series = grid_series[in_range]
 
-    for hour in sorted(w_av_per_hour):
-        dt_ob = dt.datetime.strptime(hour, '%y%m%d%H')
-        doy_string = dt_ob.strftime("%Y%j")
+        # one value per hour
+        grid_columns[int(grid)] = grid_series[~grid_series.index.duplicated()]
 
-        doy_num = int(doy_string) - 1  # - 1 because I want the day before - as it's a forcast
-        date_string = str(doy_num)
+    return pd.DataFrame(grid_columns)
 
-        string_construct = 'var_' + date_string
-        string_construct_time = 'time_' + date_string
 
-        w_averaged_dict[string_construct].append(w_av_per_hour[hour])
-        average_dict[string_construct].append(av_per_hour[hour])
+def percentage_matrix(percentage_vals_dict,
+                      model_site_dict):
+    """
+    Puts the SA percentages of each grid into one DataFrame: a row for each hour, and a column for each grid.
+    :param percentage_vals_dict: from prepare_model_grid_percentages
+    :param model_site_dict: from prepare_model_grid_percentages
+    :return: DataFrame of percentages (0 for grids not in the SA), and DataFrame of which grids are in the SA, both
+    with an index of hours (datetimes) for the hours in both dictionaries
+    """
 
-        w_averaged_dict_time[string_construct_time].append(dt_ob)
-        average_dict_time[string_construct_time].append(dt_ob)
+    hour_keys = sorted(set(model_site_dict).intersection(percentage_vals_dict))
 
-    # grouping thr average values
-    # [ key_name_times,  key_names_vars,  time_dict,    var_dict,    height_value   ]
-    # average_grouped = [list_of_time_strings[0], strings, new_list_of_times[0], average_dict, list_of_heights[0]]
-    average_grouped = [sorted(average_dict_time.keys()), sorted(average_dict.keys()), average_dict_time, average_dict,
-                       list_of_heights[0]]
+    # every (hour, grid, percentage) as flat arrays
+    grids_per_hour = [len(model_site_dict[hour]) for hour in hour_keys]
+    hour_rows = np.repeat(np.arange(len(hour_keys)), grids_per_hour)
+    grids = np.asarray([int(grid) for hour in hour_keys for grid in model_site_dict[hour]], dtype=int)
+    percentages = np.asarray([val for hour in hour_keys for val in percentage_vals_dict[hour]], dtype=float)
 
-    included_grids['Average'] = average_grouped
+    grid_columns = np.unique(grids)
+    grid_cols = np.searchsorted(grid_columns, grids)
 
-    # weighted average groups
-    # [ key_name_times,  key_names_vars,  time_dict,    var_dict,    height_value   ]
-    # w_average_grouped = [list_of_time_strings[0], strings, new_list_of_times[0], w_averaged_dict,
-    #                      list_of_heights[0]]
+    weights = np.zeros((len(hour_keys), len(grid_columns)))
+    weights[hour_rows, grid_cols] = percentages
 
-    w_average_grouped = [sorted(w_averaged_dict_time.keys()), sorted(w_averaged_dict.keys()), w_averaged_dict_time,
-                         w_averaged_dict,
-                         list_of_heights[0]]
+    included = np.zeros((len(hour_keys), len(grid_columns)), dtype=bool)
+    included[hour_rows, grid_cols] = True
 
-    included_grids['WAverage'] = w_average_grouped
+    hour_index = pd.to_datetime(hour_keys, format='%y%m%d%H')
 
-    return included_grids
+    return (pd.DataFrame(weights, index=hour_index, columns=grid_columns),
+            pd.DataFrame(included, index=hour_index, columns=grid_columns))